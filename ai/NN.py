@@ -1,35 +1,109 @@
-from keras.models import Sequential, load_model
+from keras.models import Sequential, load_model, clone_model
 from keras.layers import Dense
 from keras.optimizers import RMSprop
-from numpy import array, arange, random, fromiter
-from random import randint
+from numpy import array, arange, random, fromiter, asarray, tanh, maximum, float32
+from copy import copy
+
+
+def _sigmoid(x):
+    # same as 1 / (1 + exp(-x)), without overflowing for large negative x
+    return 0.5 * (tanh(0.5 * x) + 1)
+
+
+def _linear(x):
+    return x
+
+
+def _relu(x):
+    return maximum(x, 0)
+
+
+_NUMPY_ACTIVATIONS = {
+    "sigmoid": _sigmoid,
+    "linear": _linear,
+    "relu": _relu,
+    "tanh": tanh
+}
 
 
 class NN:
     INITIALIZER = "lecun_normal"
     INITIALIZER_BIAS = "zeros"
     ACTIVATION = "sigmoid"
+    # largest difference allowed between the predictions of Keras and of the NumPy mirror
+    MIRROR_TOLERANCE = 1e-4
 
     def __init__(self, load_file=None,
                  input_dim: int =0,
                  hidden_layers=None,
                  output_dim: int =0,
-                 batch_size: int =1):
+                 batch_size: int =1,
+                 numpy_inference: bool =True,
+                 mirror_refresh_interval: int =1,
+                 layers=None,
+                 rng: random.Generator = None):
         """
         :param load_file: a tuple of size 2 with 2 files: one for model and one for NN class remaining attributes
         :param hidden_layers: number of units on each hidden layer
         :param input_dim: input layer dimension(number of units)
         :param output_dim: number of units on output layer
+        :param numpy_inference: predict with a NumPy copy of the weights instead of calling Keras
+        :param mirror_refresh_interval: number of updates between two refreshes of the NumPy copy
+        :param layers: a list of (units, activation) for each layer, as returned by get_layers;
+                       if given, used instead of hidden_layers and output_dim
+        :param rng: the generator used to decorrelate the training batches (default: an unseeded generator)
         """
         self.model = None
+        self.rng = rng if rng is not None else random.default_rng()
+        # NumPy copy of the network: a (weights, bias, activation) tuple for each layer
+        self.mirror = None
+        self.numpy_inference = numpy_inference
+        self.mirror_refresh_interval = mirror_refresh_interval
+        # check the mirror against Keras after each refresh, not only once the network is built (for debugging)
+        self.verify_refreshes = False
+        self.__updates_since_refresh = 0
+        # increased each time the weights of the Keras model change, and copied when the mirror is refreshed
+        self.__weights_version = 0
+        self.__mirror_version = 0
         if load_file is not None:
             self.__load(load_file)
+            self.refresh_mirror()
+            self.verify_mirror()
+            return
+        if layers is not None:
+            self.batch_size = batch_size
+            self.model = Sequential([Dense(units=units,
+                                           activation=activation,
+                                           kernel_initializer=NN.INITIALIZER,
+                                           bias_initializer=NN.INITIALIZER_BIAS,
+                                           **(dict(input_dim=input_dim) if i == 0 else {}))
+                                     for i, (units, activation) in enumerate(layers)])
+            self.compiled = False
+            self.refresh_mirror()
+            self.verify_mirror()
             return
         assert len(hidden_layers) > 0, "NN must contain at least one hidden layer"
         assert output_dim > 0, "NN must contain at least one unit on output layer "
         self.batch_size = batch_size
         self.model = Sequential(self.__build_stack_of_layers(input_dim, hidden_layers, output_dim))
         self.compiled = False
+        self.refresh_mirror()
+        self.verify_mirror()
+
+    @property
+    def input_dim(self):
+        return self.model.input_shape[-1]
+
+    @property
+    def output_dim(self):
+        return self.model.output_shape[-1]
+
+    @property
+    def predictions_version(self):
+        """
+        Changes whenever the predictions for a state may change, e.g. to know if cached predictions are still valid
+        """
+        return self.__mirror_version if self.numpy_inference else self.__weights_version
 
     @staticmethod
     def __build_stack_of_layers(input_dim, hidden_layers, output_dim):
@@ -72,22 +146,128 @@ class NN:
                            loss="mean_squared_error",
                            metrics=["accuracy"])
 
+    def refresh_mirror(self):
+        """
+        Copies the current weights of the Keras model into the NumPy mirror
+        """
+        mirror = []
+        for layer in self.model.layers:
+            activation = layer.get_config()["activation"]
+            if activation not in _NUMPY_ACTIVATIONS:
+                print("no NumPy version of activation {}, predicting with Keras".format(activation))
+                self.numpy_inference = False
+                self.mirror = None
+                return
+            weights, bias = layer.get_weights()
+            mirror.append((weights.astype(float32), bias.astype(float32), _NUMPY_ACTIVATIONS[activation]))
+        self.mirror = mirror
+        self.__updates_since_refresh = 0
+        self.__mirror_version = self.__weights_version
+        if self.verify_refreshes:
+            self.verify_mirror()
+
+    def __predict_numpy(self, states):
+        output = asarray(states, dtype=float32)
+        for weights, bias, activation in self.mirror:
+            output = activation(output @ weights + bias)
+        return output
+
+    def check_mirror(self, states):
+        """
+        :param states: a matrix with one state on each row
+        :return: the largest absolute difference between the predictions of Keras and of the NumPy mirror
+        """
+        return float(abs(self.model.predict_on_batch(array(states)) - self.__predict_numpy(states)).max())
+
+    def verify_mirror(self, states=None):
+        """
+        Raises a RuntimeError if the NumPy mirror does not predict like Keras (e.g. an activation it computes wrongly)
+        :param states: a matrix with one state on each row (default: a few random states)
+        """
+        if self.mirror is None:
+            return
+        if states is None:
+            # a generator of its own, so that checking does not change the random numbers of a seeded run
+            states = random.default_rng(0).standard_normal((8, self.input_dim)).astype(float32)
+        difference = self.check_mirror(states)
+        if difference > NN.MIRROR_TOLERANCE:
+            raise RuntimeError("the NumPy mirror differs from Keras by {} (more than {}), predict with Keras instead"
+                               .format(difference, NN.MIRROR_TOLERANCE))
+
     def predict_action(self, state):
         """
         :param state: must be a vector with all values that will represent a state
         :return: an array with q values for each possible action
         """
+        if self.numpy_inference:
+            return self.__predict_numpy(state)
         return self.model.predict_on_batch(array([state]))[0]
 
+    def predict_actions(self, states):
+        """
+        :param states: a matrix with one state on each row
+        :return: a matrix with the q values of each state on the corresponding row
+        """
+        if self.numpy_inference:
+            return self.__predict_numpy(states)
+        return self.model.predict_on_batch(array(states))
+
+    def get_weights(self):
+        """
+        :return: a list of arrays with the weights and biases of each layer
+        """
+        return self.model.get_weights()
+
+    def set_weights(self, weights):
+        """
+        :param weights: a list of arrays as returned by get_weights
+        """
+        self.model.set_weights(weights)
+        self.__weights_version += 1
+        self.refresh_mirror()
+
+    def get_layers(self):
+        """
+        :return: a list of (units, activation) for each layer, enough to rebuild the network with set_weights
+        """
+        return [(layer.get_config()["units"], layer.get_config()["activation"]) for layer in self.model.layers]
+
+    def clone(self):
+        """
+        :return: a compiled NN with the same layers and weights, that can be trained without changing this one
+        """
+        other = copy(self)
+        other.model = clone_model(self.model)
+        # the clone is trained on another thread, so it cannot share the generator
+        other.rng, = self.rng.spawn(1)
+        other.model.set_weights(self.model.get_weights())
+        other.compiled = False
+        other.compile()
+        other.refresh_mirror()
+        return other
+
     @staticmethod
-    def __shuffler(x, y, max_step_size=10):
-        step = randint(1, max_step_size)  # to be configured
+    def __shuffler(x, y, rng: random.Generator, max_step_size=10):
+        step = rng.integers(1, max_step_size, endpoint=True)  # to be configured
         idxs = arange(len(x) - 2)
-        random.shuffle(idxs)
+        rng.shuffle(idxs)
         idxs = idxs[::step]
         return array([x[i] for i in idxs] + [x[-2], x[-1]]), \
                array([y[i] for i in idxs] + [x[-2], x[-1]])
 
+    def train_batch(self, states, targets):
+        """
+        One gradient step on a whole batch, e.g. for offline training with large batches
+        :return: the loss on the batch
+        """
+        loss = self.model.train_on_batch(asarray(states, dtype=float32), asarray(targets, dtype=float32))
+        self.__weights_version += 1
+        self.__updates_since_refresh += 1
+        if self.__updates_since_refresh >= self.mirror_refresh_interval:
+            self.refresh_mirror()
+        # with metrics, train_on_batch returns [loss, metric, ...]
+        return float(loss[0] if isinstance(loss, (list, tuple)) else loss)
+
     def update(self, state, target, correlation_remove=True, epochs=1):
         """
         :param state: input of the model)
@@ -96,7 +276,7 @@ class NN:
         :param epochs
         """
         if correlation_remove:
-            state, target = NN.__shuffler(array(state), array(target))
+            state, target = NN.__shuffler(array(state), array(target), self.rng)
         batch_size = max(int(len(state) ** 0.5), 1)
         self.model.fit(x=state,
                        y=target,
@@ -104,3 +284,7 @@ class NN:
                        verbose=0,
                        epochs=epochs,
                        shuffle=not correlation_remove)
+        self.__weights_version += 1
+        self.__updates_since_refresh += 1
+        if self.__updates_since_refresh >= self.mirror_refresh_interval:
+            self.refresh_mirror()
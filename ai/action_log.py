@@ -0,0 +1,79 @@
+from numpy import zeros, arange, float32, int64
+
+
+class ActionLog:
+    """
+    Has, for the last actions chosen by the players (player after player, oldest first):
+        The state in which the actions were chosen
+        The predictions of the network for that state, later updated in place to become training targets
+        The indexes of the chosen actions
+        The total reward of the player before the actions were chosen
+    All stored in preallocated ring buffers, so that the rewards received since each action
+    can be computed for the whole log with a few array operations.
+    """
+
+    def __init__(self, capacity: int, state_size: int, actions_number: int, max_actions: int, players: int = 2):
+        """
+        :param capacity: maximum number of entries (for all players together)
+        :param state_size: length of a state
+        :param actions_number: length of a prediction
+        :param max_actions: maximum number of actions chosen at once by a player
+        :param players: number of players choosing actions in turn
+        """
+        assert capacity % players == 0, "capacity must hold the same number of entries for each player"
+        self.capacity = capacity
+        self.players = players
+        self.states = zeros((capacity, state_size), dtype=float32)
+        self.predictions = zeros((capacity, actions_number), dtype=float32)
+        self.actions_idxs = zeros((capacity, max_actions), dtype=int64)
+        self.rewards_before = zeros(capacity)
+        self.reward_totals = zeros(players)
+        # number of actions chosen at once; the same for all entries
+        self.actions_count = 0
+        self.count = 0
+        self.next_idx = 0
+        self.__order = arange(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+        self.next_idx = 0
+        self.reward_totals[:] = 0
+
+    def append(self, state, prediction, actions_idxs):
+        if self.count == 0:
+            self.actions_count = len(actions_idxs)
+        assert len(actions_idxs) == self.actions_count, "all entries must have the same number of actions"
+
+        idx = self.next_idx
+        # entries alternate between players and capacity is a multiple of the number of players,
+        # so each slot always belongs to the same player
+        self.states[idx] = state
+        self.predictions[idx] = prediction
+        self.actions_idxs[idx, :self.actions_count] = actions_idxs
+        self.rewards_before[idx] = self.reward_totals[idx % self.players]
+
+        self.next_idx = (idx + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def add_rewards(self, rewards):
+        """
+        :param rewards: the reward received by each player
+        """
+        self.reward_totals += rewards
+
+    def order(self):
+        """
+        :return: the slots of all entries, oldest first
+        """
+        if self.count < self.capacity:
+            return self.__order[:self.count]
+        return (self.__order + self.next_idx) % self.capacity
+
+    def rewards_since(self, slots):
+        """
+        :return: for each slot, the total reward received by its player since (and including) its actions
+        """
+        return self.reward_totals[slots % self.players] - self.rewards_before[slots]
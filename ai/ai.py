@@ -1,10 +1,13 @@
-from numpy import array, arange, argmax
-from numpy.random import choice
+from numpy import array, arange, argmax, concatenate, array_equal, float32
+from numpy.random import Generator, default_rng
 from itertools import product
 from ai.NN import NN
+from ai.replay_memory import ReplayMemory
+from ai.action_log import ActionLog
+from ai.learner import Learner
+from ai import checkpoint
 import pickle
-from random import random, randrange, randint
-from collections import deque
+import os
 from math import floor
 
 
@@ -18,6 +21,18 @@ class AI:
                  angle_velocity=None,
                  hidden_layers=(100, 100),
                  log_size=10,
+                 memory_size: int = MEMORY_DIMENSION,
+                 prioritized_memory: bool = False,
+                 background_learning: bool = False,
+                 learner_queue_size: int = 8,
+                 learner_sync_interval: int = 10,
+                 blocking_learner: bool = False,
+                 accept_stale_predictions: bool = False,
+                 checkpoint_path: str = None,
+                 session_path: str = None,
+                 memory_path: str = None,
+                 read_only_memory: bool = False,
+                 rng: Generator = None,
                  nn_file: str = "save.model",
                  actions_file: str = "save.actions"):
         """
@@ -27,15 +42,36 @@ class AI:
         :param offset: represents a vector with scalars that will move rod to left/right
         :param angle_velocity: represents a vector with rates of change of a rodsman angle
         :param hidden_layers: a vector of values that represents how many units have each layer
+        :param log_size: how many past actions of each player are updated with the received rewards
+        :param memory_size: how many (state, target) pairs are kept for memory replay
+        :param prioritized_memory: replay memories with a large error more often
+        :param background_learning: fit a copy of the network on a background thread instead of
+                                    blocking update; the network used for acting is synced with it periodically
+        :param learner_queue_size: maximum number of batches waiting for the background learner
+        :param learner_sync_interval: number of background fits between two syncs of the acting network
+        :param blocking_learner: wait for the background learner when its queue is full instead of dropping batches,
+                                 so that it trains on every batch, like update does without it
+        :param accept_stale_predictions: reuse the predictions made by update for the next action selection
+                                         even if the network was trained in between, so that the network
+                                         is evaluated once per tick instead of twice, and the actions trail
+                                         the training by one fit
+        :param checkpoint_path: with load, load from this checkpoint (or the newest one in this directory)
+                                instead of nn_file and actions_file
+        :param session_path: with load, resume the training session saved by save_session in this directory,
+                             including the replay memory
+        :param memory_path: a directory for a memory-mapped replay memory, reopened if it already exists
+        :param read_only_memory: open the memory in memory_path without changing it, e.g. in another process
+        :param rng: the generator of the random actions; the network and the memory get generators spawned from it
+                    (default: an unseeded generator)
         :param nn_file: file to save neural network
         :param actions_file: file to save actions_file
         """
         self.actions = None
         self.model = None
-        self.last_predictions = deque(maxlen=2 * log_size)
-        self.last_states = deque(maxlen=2 * log_size)
-        self.last_actions_index = deque(maxlen=2 * log_size)
-        self.last_reward_sums = deque([0, 0], maxlen=2 * log_size + 2)
+        self.rng = rng if rng is not None else default_rng()
+        model_rng, memory_rng = self.rng.spawn(2)
+        # the last actions of both players, created once the state size and the number of actions are known
+        self.log: ActionLog = None
         self.log_size = log_size
         self.lamda = 0.6
         self.alpha = 0.9
@@ -45,13 +81,39 @@ class AI:
         # to not make anymore random choices
         self.__decreasing_rate = 0.99997
 
-        # memory replay
-        self.memory_state = deque(maxlen=AI.MEMORY_DIMENSION)
-        self.memory_target = deque(maxlen=AI.MEMORY_DIMENSION)
+        # memory replay, created once the state size and the number of actions are known
+        self.memory: ReplayMemory = None
         # with save_probability save a memory with consist of a state and a target
         self.save_probability = 0.3
+        # trains the network on a background thread if background_learning is set
+        self.learner: Learner = None
+        # the predictions made by update for the new states, reused to choose the next actions
+        self.accept_stale_predictions = accept_stale_predictions
+        self.__cached_states = None
+        self.__cached_predictions = None
+        self.__cached_version = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # number of calls of update and update_from_transitions (and of offline batches), over all the runs
+        # resumed from a checkpoint or a session; checkpoints are named after it
+        self.updates = 0
         if load:
-            self.__load(nn_file, actions_file)
+            if session_path is not None:
+                self.__load_session(session_path)
+                memory_path = os.path.join(session_path, "memory")
+            elif checkpoint_path is not None:
+                self.__load_checkpoint(checkpoint_path)
+            else:
+                self.__load(nn_file, actions_file)
+            self.model.rng = model_rng
+            self.memory = ReplayMemory(memory_size, self.model.input_dim, len(self.actions), prioritized_memory,
+                                       path=memory_path, read_only=read_only_memory and memory_path is not None,
+                                       rng=memory_rng)
+            # the log starts empty, even when resuming a session: a resumed session starts a new game,
+            # and the actions of the previous game must not receive its rewards
+            self.log = ActionLog(2 * self.log_size, self.model.input_dim, len(self.actions), self.rods_number)
+            if background_learning:
+                self.learner = Learner(self.model, learner_queue_size, learner_sync_interval, blocking_learner)
             return
 
         self.rods_number = rods_number
@@ -64,9 +126,16 @@ class AI:
         self.model = NN(input_dim=state_size,
                         hidden_layers=hidden_layers,
                         output_dim=len(self.actions),
-                        batch_size=self.batch_size)
+                        batch_size=self.batch_size,
+                        rng=model_rng)
 
         self.model.compile()
+        self.memory = ReplayMemory(memory_size, state_size, len(self.actions), prioritized_memory,
+                                   path=memory_path, read_only=read_only_memory and memory_path is not None,
+                                   rng=memory_rng)
+        self.log = ActionLog(2 * log_size, state_size, len(self.actions), rods_number)
+        if background_learning:
+            self.learner = Learner(self.model, learner_queue_size, learner_sync_interval, blocking_learner)
 
     def __load(self, nn_file, actions_file):
         self.model = NN(load_file=nn_file)
@@ -76,6 +145,7 @@ class AI:
         fd.close()
 
     def save(self, nn_file: str="save.model", actions_file: str="save.actions"):
+        self.__sync_learner()
         self.model.save(nn_file)
         print("saving ai...")
         fd = open(actions_file, "wb")
@@ -83,9 +153,67 @@ class AI:
         pickle.dump(to_save, fd, protocol=0)  # protocol 0 for compatibility
         fd.close()
 
-    def __compute_and_backup(self, state):
-        self.last_predictions.append(self.model.predict_action(state))
-        self.last_states.append(state)
+    def __load_checkpoint(self, path):
+        weights, metadata = checkpoint.read_checkpoint(path)
+        self.rods_number = metadata["rods_number"]
+        self.actions = array(metadata["actions"])
+        self.epsilon = metadata["epsilon"]
+        self.lamda = metadata["lamda"]
+        self.batch_size = metadata["batch_size"]
+        self.model = NN(input_dim=metadata["input_dim"], layers=metadata["layers"], batch_size=self.batch_size)
+        self.model.set_weights(weights)
+        self.model.verify_mirror()
+        self.model.compile()
+        # checkpoints are named after updates, so that the checkpoints of a resumed run follow the loaded one
+        self.updates = metadata["step"]
+        print("loaded checkpoint of step {}".format(metadata["step"]))
+        return metadata
+
+    def __checkpoint_metadata(self, step):
+        return dict(step=step,
+                    rods_number=int(self.rods_number),
+                    actions=self.actions.tolist(),
+                    epsilon=self.epsilon,
+                    lamda=self.lamda,
+                    batch_size=self.batch_size,
+                    input_dim=self.model.input_dim,
+                    layers=self.model.get_layers())
+
+    def save_checkpoint(self, checkpointer: checkpoint.Checkpointer):
+        """
+        Queues a checkpoint of the network and of the attributes saved by save, named after updates;
+        does not wait for it to be written
+        """
+        self.__sync_learner()
+        checkpointer.save(self.updates, self.model.get_weights(), self.__checkpoint_metadata(self.updates))
+
+    def __load_session(self, directory):
+        session = self.__load_checkpoint(os.path.join(directory, "network"))["session"]
+        self.__epsilon_backup = session["epsilon_backup"]
+        self.__decreasing_rate = session["decreasing_rate"]
+        self.log_size = session["log_size"]
+
+    def save_session(self, directory):
+        """
+        Saves everything needed to resume training: the network, the exploration and learning rates
+        and the replay memory (as memory-mapped arrays in directory/memory).
+        The action log is not saved, since the game in progress is not saved either
+        """
+        self.__sync_learner()
+        os.makedirs(directory, exist_ok=True)
+        memory_path = os.path.join(directory, "memory")
+        if self.memory.path is not None and os.path.abspath(self.memory.path) == os.path.abspath(memory_path):
+            self.memory.flush()
+        else:
+            self.memory.copy_to(memory_path)
+
+        metadata = self.__checkpoint_metadata(self.updates)
+        metadata["session"] = dict(epsilon_backup=self.__epsilon_backup,
+                                   decreasing_rate=self.__decreasing_rate,
+                                   log_size=self.log_size)
+        # written last, so that the network metadata of a new session only exists once everything else was saved
+        checkpoint.write_checkpoint(os.path.join(directory, "network"), self.model.get_weights(), metadata)
+        print("saved session in {}".format(directory))
 
     # noinspection PyMethodMayBeStatic
     def one_action(self, q_values):
@@ -104,80 +232,102 @@ class AI:
         :param action_selector: may be one of the following functions: ane_action, multiple_actions
         :return:
         """
-        self.__compute_and_backup(state)
-        self.last_actions_index.append(action_selector(self.last_predictions[-1]))
-        return [self.actions[i] for i in self.last_actions_index[-1]]
+        q_values = self.model.predict_action(state)
+        actions_idxs = action_selector(q_values)
+        self.log.append(state, q_values, actions_idxs)
+        return [self.actions[i] for i in actions_idxs]
 
     def one_action_off_policy(self, rand, q_values):
         if rand:
-            return [randrange(0, len(self.actions))]
+            return [self.rng.integers(0, len(self.actions))]
         else:
             return self.one_action(q_values)
 
     def multiple_actions_off_policy(self, rand, q_values):
         slice_size = int(len(self.actions) // self.rods_number)
         if rand:
-            return [i * slice_size + randrange(0, slice_size)
+            return [i * slice_size + self.rng.integers(0, slice_size)
                     for i
                     in range(self.rods_number)]
         else:
             return self.multiple_actions(q_values)
 
     def get_action_off_policy(self, state, action_selector):
-        self.__compute_and_backup(state)
+        q_values = self.model.predict_action(state)
 
-        if random() < self.epsilon:  # should choose an action random
+        if self.rng.random() < self.epsilon:  # should choose an action random
             self.epsilon *= self.__decreasing_rate
-            self.last_actions_index.append(action_selector(True, None))
-            return [self.actions[i] for i in self.last_actions_index[-1]]
+            actions_idxs = action_selector(True, None)
+        else:
+            actions_idxs = action_selector(False, q_values)
+        self.log.append(state, q_values, actions_idxs)
+        return [self.actions[i] for i in actions_idxs]
+
+    def get_actions_off_policy(self, states, action_selector):
+        """
+        Same as get_action_off_policy for the states of all players, with a single network evaluation
+        :param states: the state of each player, in the order expected by update
+        :param action_selector: may be one of the following functions: one_action_off_policy,
+                                multiple_actions_off_policy
+        :return: a list with the actions of each player
+        """
+        return [[self.actions[i] for i in actions_idxs]
+                for actions_idxs in self.get_actions_idxs_off_policy(states, action_selector)]
 
-        self.last_actions_index.append(action_selector(False, self.last_predictions[-1]))
-        return [self.actions[i] for i in self.last_actions_index[-1]]
+    def get_actions_idxs_off_policy(self, states, action_selector):
+        """
+        Same as get_actions_off_policy, but returns the indexes (in self.actions) of the chosen actions,
+        e.g. for Simulation.apply_action_indices
+        """
+        actions_idxs = []
+        for state, q_values in zip(states, self.__predict_actions(states)):
+            if self.rng.random() < self.epsilon:  # should choose an action random
+                self.epsilon *= self.__decreasing_rate
+                actions_idxs.append(action_selector(True, None))
+            else:
+                actions_idxs.append(action_selector(False, q_values))
+            self.log.append(state, q_values, actions_idxs[-1])
+        return actions_idxs
 
     def update(self, action_based_reward, new_states):
         assert len(action_based_reward) == len(new_states), "must have reward for each new_state"
         assert len(action_based_reward) == 2, "exactly 2 players supported ATM"
 
-        for idx in range(0, len(self.last_reward_sums), 2):
-            self.last_reward_sums[idx] += action_based_reward[0]
-            self.last_reward_sums[idx + 1] += action_based_reward[1]
-
-        self.last_reward_sums.extend(action_based_reward)
-
-        q_values = [[self.last_predictions[i][j]
-                    for j in self.last_actions_index[i]]
-                    for i in range(len(self.last_actions_index))]
-        action_selector = self.one_action if len(q_values[0]) == 1 else self.multiple_actions
-
-        for i in range(len(q_values) - 2):
-            next_q_values = q_values[i + 2]
-            q_values_updated = [
-                # TODO: not sure about self.last_rewards[i]
-                (1 - self.alpha) * q + self.alpha * (self.last_reward_sums[i] / ((len(q_values) + 1 - i) // 2)
-                    + (self.lamda * next_q))
-               for q, next_q
-               in zip(q_values[i], next_q_values)]
-
-            for j, update in zip(self.last_actions_index[i], q_values_updated):
-                self.last_predictions[i][j] = update
-
-        for i in range(len(new_states)):
-            next_max_q_values = action_selector(self.model.predict_action(new_states[i]))
-
-            q_values_updated = [
-                (1 - self.alpha) * q + self.alpha * (action_based_reward[i] + self.lamda * next_q)
-                for q, next_q
-                in zip(q_values[-2 + i], next_max_q_values)]
-
-            for j, update in zip(self.last_actions_index[-2 + i], q_values_updated):
-                self.last_predictions[-2 + i][j] = update
-
-        if random() < self.save_probability:
-            self.memory_state.append(self.last_states[-1])
-            self.memory_target.appendleft(self.last_predictions[-1])
+        self.__sync_learner()
+        self.updates += 1
+        log = self.log
+        log.add_rewards(action_based_reward)
+        if len(log) < 2:
+            return
 
-        if random() <= 0.5:
-            self.model.update(self.last_states, self.last_predictions)
+        # oldest entry first; entries alternate between the players, the last two are the newest actions
+        slots = log.order()
+        count = len(slots)
+        rows = slots[:, None]
+        actions_idxs = log.actions_idxs[rows, arange(log.actions_count)]
+        q_values = log.predictions[rows, actions_idxs]
+
+        # each action is followed by the next action of the same player,
+        # and the newest actions by the best actions in the new states
+        action_selector = self.one_action if log.actions_count == 1 else self.multiple_actions
+        next_predictions = self.__predict_actions(new_states)
+        next_max_q_values = [next_predictions[i][action_selector(next_predictions[i])]
+                             for i in range(len(new_states))]
+        next_q_values = concatenate((q_values[2:], next_max_q_values))
+
+        # mean reward received by the player since each action
+        # TODO: not sure about the mean
+        steps = (count + 1 - arange(count)) // 2
+        rewards = log.rewards_since(slots) / steps
+
+        log.predictions[rows, actions_idxs] = \
+            (1 - self.alpha) * q_values + self.alpha * (rewards[:, None] + self.lamda * next_q_values)
+
+        if self.rng.random() < self.save_probability:
+            self.memory.append(log.states[slots[-1]], log.predictions[slots[-1]])
+
+        if self.rng.random() <= 0.5:
+            self.__fit(log.states[slots], log.predictions[slots])
         else:
             self.from_memory_update()
         # we trust more in next move when network learn more
@@ -186,14 +336,80 @@ class AI:
             print("lambda = {}".format(self.lamda))
             self.lamda = 1
 
+    def update_from_transitions(self, states, actions_idxs, rewards, next_states):
+        """
+        Trains on transitions gathered outside of this AI (e.g. by actor processes)
+        :param states: matrix with the states in which the actions were chosen, one on each row
+        :param actions_idxs: matrix with the indexes (in self.actions) of the chosen actions, one row for each state
+        :param rewards: vector with the reward received after each action
+        :param next_states: matrix with the states reached after each action
+        """
+        self.__sync_learner()
+        self.updates += 1
+        states = array(states)
+        actions_idxs = array(actions_idxs)
+        targets = self.model.predict_actions(states)
+        next_q_values = self.model.predict_actions(next_states)
+
+        action_selector = self.one_action if actions_idxs.shape[1] == 1 else self.multiple_actions
+        next_actions_idxs = array([action_selector(q_values) for q_values in next_q_values])
+        rows = arange(len(states))[:, None]
+
+        targets[rows, actions_idxs] = \
+            (1 - self.alpha) * targets[rows, actions_idxs] + \
+            self.alpha * (array(rewards)[:, None] + self.lamda * next_q_values[rows, next_actions_idxs])
+
+        for state, target in zip(states, targets):
+            if self.rng.random() < self.save_probability:
+                self.memory.append(state, target)
+
+        self.__fit(states, targets, False)
+        if self.rng.random() <= 0.5:
+            self.from_memory_update()
+
+        self.lamda += self.lamda * 1.e-7
+        if self.lamda > 1:
+            self.lamda = 1
+
     def predict_action(self, state, action_selector):
         actions_idxs = action_selector(self.model.predict_action(state))
         return [self.actions[i] for i in actions_idxs]
 
+    def predict_actions(self, states, action_selector):
+        """
+        Same as predict_action for the states of all players, with a single network evaluation
+        :return: a list with the actions of each player
+        """
+        return [[self.actions[i] for i in actions_idxs]
+                for actions_idxs in self.predict_actions_idxs(states, action_selector)]
+
+    def predict_actions_idxs(self, states, action_selector):
+        """
+        Same as predict_actions, but returns the indexes (in self.actions) of the chosen actions
+        """
+        return [action_selector(q_values) for q_values in self.__predict_actions(states)]
+
+    def __predict_actions(self, states):
+        """
+        Same as NN.predict_actions, but remembers the last predictions and reuses them for the same states,
+        as long as the network did not change (or accept_stale_predictions is set)
+        """
+        version = self.model.predictions_version
+        if self.__cached_states is not None \
+                and (self.accept_stale_predictions or version == self.__cached_version) \
+                and len(states) == len(self.__cached_states) \
+                and all(array_equal(state, cached) for state, cached in zip(states, self.__cached_states)):
+            self.cache_hits += 1
+            return self.__cached_predictions
+        self.cache_misses += 1
+        predictions = self.model.predict_actions(states)
+        self.__cached_states = array(states, dtype=float32)
+        self.__cached_predictions = predictions
+        self.__cached_version = version
+        return predictions
+
     def flush_last_actions(self):
-        self.last_states.clear()
-        self.last_actions_index.clear()
-        self.last_predictions.clear()
+        self.log.clear()
 
     def switch_random_action(self, activate):
         if not activate:
@@ -203,11 +419,39 @@ class AI:
             self.epsilon = self.__epsilon_backup
 
     def from_memory_update(self):
-        if len(self.memory_state) < 1000:
+        if len(self.memory) < 1000:
+            return
+        size = self.rng.integers(200, 1000, endpoint=True)
+        idxs, states, targets = self.memory.sample(size)
+        self.__fit(states, targets, False, 3, idxs if self.memory.prioritized else None)
+
+    def __fit(self, states, targets, correlation_remove=True, epochs=1, memory_idxs=None):
+        """
+        Same as NN.update, on the background learner if there is one
+        :param memory_idxs: indexes of the memories in a prioritized memory, whose priorities must be updated
+        """
+        if self.learner is not None:
+            self.learner.submit(states, targets, correlation_remove, epochs, memory_idxs, self.memory.written)
+            return
+        self.model.update(states, targets, correlation_remove, epochs)
+        if memory_idxs is not None:
+            errors = abs(self.model.predict_actions(states) - targets).max(axis=1)
+            self.memory.update_priorities(memory_idxs, errors)
+
+    def __sync_learner(self):
+        if self.learner is None:
+            return
+        self.learner.sync(self.model)
+        while self.learner.priorities:
+            self.memory.update_priorities(*self.learner.priorities.popleft())
+
+    def stop_learner(self):
+        """
+        Stops the background learner, if there is one, and copies its last weights in the acting network
+        """
+        if self.learner is None:
             return
-        idxs = arange(len(self.memory_state))
-        size = randint(200, 1000)
-        sample = choice(idxs, size, replace=False)
-        self.model.update(array([self.memory_state[i] for i in sample]),
-                          array([self.memory_target[i] for i in sample]),
-                          False, 3)
+        self.learner.stop()
+        self.__sync_learner()
+        print("learner: {}".format(self.learner.stats()))
+        self.learner = None
@@ -0,0 +1,155 @@
+import numpy as np
+import threading
+import queue
+import json
+import os
+import re
+
+_NAME = "checkpoint-{:012d}"
+_NAME_PATTERN = re.compile(r"^checkpoint-(\d{12})\.json$")
+
+
+def _replace_atomically(path, write):
+    """
+    Writes a file next to path with write(file), then renames it to path,
+    so that readers never see a partially written file
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fd:
+        write(fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_path, path)
+
+
+def list_checkpoints(directory):
+    """
+    :return: the paths (without extension) of the complete checkpoints in directory, oldest first.
+             They are ordered by the time they were written, not by step,
+             since a run resumed from an older checkpoint writes smaller steps than the ones already there
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = [os.path.join(directory, _NAME.format(int(match.group(1))))
+             for match in map(_NAME_PATTERN.match, os.listdir(directory))
+             if match is not None]
+    # the JSON file is written last, so its modification time is the time the checkpoint was completed
+    written = []
+    for path in paths:
+        try:
+            written.append((os.stat(path + ".json").st_mtime_ns, path))
+        except FileNotFoundError:
+            # removed meanwhile by another Checkpointer
+            pass
+    return [path for _, path in sorted(written)]
+
+
+def latest_checkpoint(directory):
+    """
+    :return: the path of the newest complete checkpoint in directory, or None if there is none
+    """
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def write_checkpoint(path, weights, metadata):
+    """
+    Writes path.npz with the weight arrays and path.json with the metadata.
+    The metadata is written last, so a checkpoint is complete once its JSON file exists.
+    :param weights: a list of arrays as returned by NN.get_weights
+    :param metadata: a dict that can be serialized to JSON
+    """
+    _replace_atomically(path + ".npz",
+                        lambda fd: np.savez(fd, **{"w{}".format(i): weight for i, weight in enumerate(weights)}))
+    _replace_atomically(path + ".json",
+                        lambda fd: fd.write(json.dumps(metadata, indent=4).encode()))
+
+
+def read_checkpoint(path):
+    """
+    :param path: a checkpoint path as returned by latest_checkpoint, or a directory with checkpoints
+    :return: a tuple (weights, metadata)
+    """
+    if os.path.isdir(path):
+        directory = path
+        path = latest_checkpoint(directory)
+        if path is None:
+            raise FileNotFoundError("no checkpoint in {}".format(directory))
+    with open(path + ".json", "rt") as fd:
+        metadata = json.load(fd)
+    with np.load(path + ".npz") as arrays:
+        weights = [arrays["w{}".format(i)] for i in range(len(arrays.files))]
+    return weights, metadata
+
+
+class Checkpointer:
+    """
+    Has:
+        A directory where checkpoints are written, named after the step at which they were taken
+        (AI.updates, which continues from the loaded checkpoint)
+        A background thread that writes them, so that saving never blocks the simulation
+    Only the newest pending checkpoint is written if the thread falls behind,
+    and only the last keep written checkpoints are kept.
+    """
+
+    def __init__(self, directory, keep: int = 5):
+        """
+        :param directory: where the checkpoints are written; created if missing
+        :param keep: number of checkpoints kept, older ones are deleted
+        """
+        assert keep > 0, "Checkpointer must keep at least one checkpoint"
+        self.directory = directory
+        self.keep = keep
+        self.written = 0
+        self.skipped = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__pending = queue.Queue(maxsize=1)
+        self.__thread = threading.Thread(target=self.__run, name="checkpointer", daemon=True)
+        self.__thread.start()
+
+    def save(self, step: int, weights, metadata):
+        """
+        Queues a checkpoint; returns immediately
+        :param weights: a list of arrays, that must not be changed afterwards (e.g. from NN.get_weights)
+        :param metadata: a dict that can be serialized to JSON
+        """
+        item = (step, weights, metadata)
+        try:
+            self.__pending.put_nowait(item)
+        except queue.Full:
+            # replace the checkpoint that was not written yet by the newer one
+            try:
+                self.__pending.get_nowait()
+                self.skipped += 1
+            except queue.Empty:
+                pass
+            self.__pending.put_nowait(item)
+
+    def close(self):
+        """
+        Writes the pending checkpoint, if any, and stops the thread
+        """
+        self.__pending.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            item = self.__pending.get()
+            if item is None:
+                return
+            step, weights, metadata = item
+            try:
+                write_checkpoint(os.path.join(self.directory, _NAME.format(step)), weights, metadata)
+                self.written += 1
+                self.__remove_old()
+            except OSError as e:
+                print("could not write checkpoint {}: {}".format(step, e))
+
+    def __remove_old(self):
+        for path in list_checkpoints(self.directory)[:-self.keep]:
+            # the JSON file first, so that a checkpoint is never seen without its weights
+            for extension in (".json", ".npz"):
+                try:
+                    os.remove(path + extension)
+                except FileNotFoundError:
+                    pass
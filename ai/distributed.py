@@ -0,0 +1,242 @@
+from ai.ai import AI
+from ai.state_template import StateTemplate
+from sim import simulation
+from sim import table
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+import queue
+import signal
+import time
+
+
+class WeightsBroadcast:
+    """
+    Has:
+        A shared memory block with the weights of all layers, flattened
+        A version number, increased each time new weights are published
+    """
+
+    def __init__(self, shapes, version, name=None):
+        """
+        :param shapes: the shapes of the weight arrays, as in NN.get_weights
+        :param version: a multiprocessing.Value("l") shared by all processes
+        :param name: the name of an existing shared memory block; if None, a new block is created
+        """
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.version = version
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name,
+                                              create=self.owner,
+                                              size=max(sum(self.sizes), 1) * 4)
+        self.buffer = np.ndarray((sum(self.sizes),), dtype=np.float32, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, weights):
+        with self.version.get_lock():
+            start = 0
+            for weight, size in zip(weights, self.sizes):
+                self.buffer[start:start + size] = np.ravel(weight)
+                start += size
+            self.version.value += 1
+
+    def read(self, known_version):
+        """
+        :param known_version: the version the caller already has
+        :return: a tuple (version, weights); weights is None if there is nothing newer than known_version
+        """
+        with self.version.get_lock():
+            version = self.version.value
+            if version == known_version:
+                return version, None
+            weights = []
+            start = 0
+            for shape, size in zip(self.shapes, self.sizes):
+                weights.append(self.buffer[start:start + size].reshape(shape).copy())
+                start += size
+        return version, weights
+
+    def close(self):
+        # the array must not outlive the buffer it points into
+        self.buffer = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _pack(transitions):
+    states, actions_idxs, rewards, next_states = zip(*transitions)
+    return (np.array(states, dtype=np.float32),
+            np.array(actions_idxs),
+            np.array(rewards, dtype=np.float32),
+            np.array(next_states, dtype=np.float32))
+
+
+def _run_actor(table_info_dict, ai_kwargs, transitions, weights_name, shapes, version, stop,
+               batch_size, dt, seed_sequence):
+    # the learner handles Ctrl+C and stops the actors through the stop event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sim_seed, ai_seed = seed_sequence.spawn(2)
+    sim = simulation.Simulation(table.TableInfo.from_dict(table_info_dict), np.random.default_rng(sim_seed))
+    state_template = StateTemplate(sim)
+    # actors never train, so they do not need a background learner nor to write in the memory
+    brain = AI(**dict(ai_kwargs, background_learning=False, read_only_memory=True,
+                      rng=np.random.default_rng(ai_seed)))
+    sim.set_actions(brain.actions)
+    weights = WeightsBroadcast(shapes, version, name=weights_name)
+    weights_version = -1
+
+    reset_deferred = False
+
+    def defer_reset():
+        nonlocal reset_deferred
+        reset_deferred = True
+
+    last_rewards = [0, 0]
+
+    def on_reset():
+        last_rewards[0] = 0
+        last_rewards[1] = 0
+
+    sim.on_goal.append(lambda _: defer_reset())
+    sim.on_oob.append(lambda: defer_reset())
+    sim.on_reset.append(brain.flush_last_actions)
+    sim.on_reset.append(on_reset)
+
+    batch = []
+    while not stop.is_set():
+        weights_version, new_weights = weights.read(weights_version)
+        if new_weights is not None:
+            brain.model.set_weights(new_weights)
+
+        states = state_template.get_states_from_sim(sim)
+        actions_idxs = brain.get_actions_idxs_off_policy(states, brain.multiple_actions_off_policy)
+        for side, side_actions_idxs in enumerate(actions_idxs):
+            sim.apply_action_indices(side, side_actions_idxs)
+
+        sim.tick(dt)
+
+        new_states = state_template.get_states_from_sim(sim)
+        for side, (reward, penalty) in enumerate(sim.get_rewards()):
+            batch.append((states[side], actions_idxs[side], reward - last_rewards[side] + penalty, new_states[side]))
+            last_rewards[side] = reward
+
+        if reset_deferred:
+            sim.reset()
+            reset_deferred = False
+
+        if len(batch) >= batch_size:
+            packed = _pack(batch)
+            batch = []
+            while not stop.is_set():
+                try:
+                    transitions.put(packed, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    weights.close()
+
+
+def run(brain: AI, ai_kwargs, table_info_dict, actors=None, publish_interval=10, batch_size=64,
+        max_steps=None, max_seconds=None, report_interval=10.0, dt=1 / 60, seed_sequence=None):
+    """
+    Trains brain with transitions from several actor processes.
+    Each actor runs its own Simulation, StateTemplate and AI (used only to choose epsilon-greedy actions)
+    and sends the transitions it sees on a queue; this process consumes them, updates brain and
+    every publish_interval updates copies the new weights in shared memory, from where the actors take them.
+    Returns when the budget is exhausted or on Ctrl+C, then saves brain.
+
+    :param brain: the AI that is trained (the learner)
+    :param ai_kwargs: arguments used by each actor to build its own AI; must describe the same network as brain
+    :param table_info_dict: the table, as accepted by TableInfo.from_dict
+    :param actors: number of actor processes; defaults to the number of CPUs minus one
+    :param publish_interval: number of learner updates between two weight broadcasts
+    :param batch_size: number of transitions sent by an actor at once
+    :param max_steps: stop after this many learner updates (None for no limit)
+    :param max_seconds: stop after this many wall-clock seconds (None for no limit)
+    :param report_interval: seconds between two progress reports
+    :param dt: simulation time of one actor step, in seconds
+    :param seed_sequence: a numpy.random.SeedSequence from which each actor gets its own seeds
+                          (default: seeded from fresh entropy)
+    """
+    if actors is None:
+        actors = max(multiprocessing.cpu_count() - 1, 1)
+
+    # Keras does not survive a fork, so every actor starts a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    transitions = context.Queue(maxsize=4 * actors)
+    stop = context.Event()
+    version = context.Value("l", 0)
+
+    initial_weights = brain.model.get_weights()
+    weights = WeightsBroadcast([w.shape for w in initial_weights], version)
+    weights.publish(initial_weights)
+
+    if seed_sequence is None:
+        seed_sequence = np.random.SeedSequence()
+    processes = [context.Process(target=_run_actor,
+                                 args=(table_info_dict, ai_kwargs, transitions, weights.name,
+                                       weights.shapes, version, stop, batch_size, dt, actor_seed),
+                                 daemon=True)
+                 for actor_seed in seed_sequence.spawn(actors)]
+    for process in processes:
+        process.start()
+
+    interrupted = False
+
+    # noinspection PyUnusedLocal
+    def on_interrupt(signum, frame):
+        nonlocal interrupted
+        print("Interrupted, stopping actors")
+        interrupted = True
+
+    steps = 0
+    received = 0
+    start_time = time.perf_counter()
+    last_report_time = start_time
+    old_handler = signal.signal(signal.SIGINT, on_interrupt)
+    try:
+        while not interrupted:
+            if max_steps is not None and steps >= max_steps:
+                break
+            if max_seconds is not None and time.perf_counter() - start_time >= max_seconds:
+                break
+
+            try:
+                batch = transitions.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            brain.update_from_transitions(*batch)
+            steps += 1
+            received += len(batch[0])
+
+            if steps % publish_interval == 0:
+                weights.publish(brain.model.get_weights())
+
+            now = time.perf_counter()
+            if now - last_report_time >= report_interval:
+                print("{} updates; {:.2f} transitions/sec".format(steps, received / (now - start_time)))
+                last_report_time = now
+    finally:
+        signal.signal(signal.SIGINT, old_handler)
+        stop.set()
+        # keep draining, or actors blocked on a full queue never exit
+        while any(process.is_alive() for process in processes):
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in processes:
+            process.join()
+        weights.close()
+
+    elapsed = time.perf_counter() - start_time
+    print("Done: {} updates, {} transitions in {:.2f} s".format(steps, received, elapsed))
+    brain.stop_learner()
+    brain.save()
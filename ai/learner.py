@@ -0,0 +1,118 @@
+from ai.NN import NN
+from collections import deque
+import threading
+import queue
+
+
+class Learner:
+    """
+    Has:
+        Its own copy of the network, trained on a background thread
+        A bounded queue of training batches; when it is full, new batches are dropped
+        (or, if blocking, wait for room, so that every batch is fitted at the cost of slowing the simulation)
+        A snapshot of the trained weights, taken every sync_interval fits, that the acting network copies
+    Lets the simulation keep running while the network is fitted.
+    """
+
+    def __init__(self, model: NN, queue_size: int = 8, sync_interval: int = 10, blocking: bool = False):
+        """
+        :param model: the network used for acting; the learner trains a copy of it
+        :param queue_size: maximum number of batches waiting to be fitted
+        :param sync_interval: number of fits between two snapshots of the trained weights
+        :param blocking: wait for room in the queue instead of dropping batches
+        """
+        self.model = model.clone()
+        # only the acting network predicts often enough to need a NumPy mirror, so the copy never refreshes one
+        self.model.numpy_inference = False
+        self.model.mirror_refresh_interval = float("inf")
+        self.sync_interval = sync_interval
+        self.blocking = blocking
+        self.batches = queue.Queue(maxsize=queue_size)
+        # (idxs, errors, written) of the replayed memories, for the prioritized memory owned by the acting thread
+        self.priorities = deque()
+
+        self.submitted = 0
+        self.dropped = 0
+        self.fitted = 0
+        self.version = 0
+        self.synced_version = 0
+        self.__weights = None
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="learner", daemon=True)
+        self.__thread.start()
+
+    def submit(self, states, targets, correlation_remove=True, epochs=1, memory_idxs=None, memory_written=None):
+        """
+        Queues a batch for NN.update, without waiting for it to be fitted (unless blocking and the queue is full)
+        :param memory_idxs: if the batch was sampled from a prioritized memory, the indexes of the memories;
+                            their new errors are then put in self.priorities
+        :param memory_written: ReplayMemory.written when the memories were sampled, put in self.priorities too
+        :return: False if the queue was full and the batch was dropped
+        """
+        self.submitted += 1
+        item = (states, targets, correlation_remove, epochs, memory_idxs, memory_written)
+        if self.blocking:
+            self.batches.put(item)
+            return True
+        try:
+            self.batches.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def sync(self, model: NN):
+        """
+        Copies the last snapshot of the trained weights into model, if there is a new one
+        Must be called from the thread that uses model.
+        :return: True if the weights of model changed
+        """
+        with self.__lock:
+            if self.version == self.synced_version:
+                return False
+            version, weights = self.version, self.__weights
+        model.set_weights(weights)
+        self.synced_version = version
+        return True
+
+    def stats(self):
+        """
+        :return: a dict with the counters of the learner
+        """
+        return dict(queue_depth=self.batches.qsize(),
+                    submitted=self.submitted,
+                    dropped=self.dropped,
+                    drop_rate=self.dropped / max(self.submitted, 1),
+                    fitted=self.fitted,
+                    version=self.version,
+                    synced_version=self.synced_version)
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread after the current fit and takes a last snapshot of the weights
+        """
+        self.__stop.set()
+        self.__thread.join(timeout)
+        self.__snapshot()
+
+    def __snapshot(self):
+        weights = self.model.get_weights()
+        with self.__lock:
+            self.__weights = weights
+            self.version += 1
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                states, targets, correlation_remove, epochs, memory_idxs, memory_written = \
+                    self.batches.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.model.update(states, targets, correlation_remove, epochs)
+            if memory_idxs is not None:
+                errors = abs(self.model.predict_actions(states) - targets).max(axis=1)
+                self.priorities.append((memory_idxs, errors, memory_written))
+            self.fitted += 1
+            if self.fitted % self.sync_interval == 0:
+                self.__snapshot()
@@ -0,0 +1,199 @@
+from ai.NN import NN
+from sim.recorder import TrajectoryReader
+from numpy import zeros, ones, arange, concatenate, argmax, float32
+from numpy import random
+import threading
+import queue
+
+
+def encode_chunk(state_template, columns, first_ticks=()):
+    """
+    :param state_template: a StateTemplate (or StateTemplatev2) of the recorded table
+    :param columns: the columns of a recorded chunk, as returned by TrajectoryReader.read_chunk
+    :param first_ticks: the ticks of the chunk (counted from its start) that begin an episode;
+                        a template that follows the foosmen between ticks (StateTemplatev2) is reset before them,
+                        as it is when the simulation is reset during online training
+    :return: a float32 array (ticks, 2, state_size) with the state of both players after each tick
+    """
+    ball = columns["ball"]
+    rods = columns["rods"]
+    reset = getattr(state_template, "reset", None)
+    first_ticks = set(first_ticks)
+    states = zeros((len(ball), 2, state_template.state_size), dtype=float32)
+    for tick in range(len(ball)):
+        if reset is not None and tick in first_ticks:
+            reset()
+        state_template.encode_arrays(ball[tick], rods[tick], states[tick])
+    return states
+
+
+def read_transitions(reader: TrajectoryReader, state_template):
+    """
+    Reads a recording chunk after chunk
+    :return: an iterator of (states, actions_idxs, rewards, next_states) arrays, one row for each
+             (tick, player) where the player applied actions: the state it saw, the actions it chose,
+             the reward it received after the next tick (as main's post_tick_function computes it)
+             and the state after that tick
+    """
+    episode_starts = set(reader.index["episode_starts"])
+    # the last tick of the previous chunk
+    last_states = None
+    last_rewards = None
+    start = 0
+    if hasattr(state_template, "reset"):
+        state_template.reset()
+    for columns in reader.chunks():
+        ticks = len(columns["ball"])
+        first_ticks = [tick - start for tick in range(start, start + ticks) if tick in episode_starts]
+        states = encode_chunk(state_template, columns, first_ticks)
+        rewards = columns["rewards"]
+
+        if last_states is None:
+            previous_states = concatenate((states[:1], states[:-1]))
+            previous_rewards = concatenate((zeros((1, 2), dtype=float32), rewards[:-1, :, 0]))
+        else:
+            previous_states = concatenate((last_states[None], states[:-1]))
+            previous_rewards = concatenate((last_rewards[None], rewards[:-1, :, 0]))
+        # the reward of the last tick of an episode does not count for the next one
+        previous_rewards[first_ticks] = 0
+        shaped_rewards = rewards[:, :, 0] - previous_rewards + rewards[:, :, 1]
+
+        # the state before the first tick of an episode was not recorded
+        valid = ones(ticks, dtype=bool)
+        valid[first_ticks] = False
+        if last_states is None:
+            valid[0] = False
+
+        actions = columns["actions"]
+        for player in range(2):
+            player_actions = actions[:, player]
+            rows = valid & (player_actions[:, 0] >= 0)
+            yield (previous_states[rows, player],
+                   player_actions[rows],
+                   shaped_rewards[rows, player],
+                   states[rows, player])
+
+        last_states = states[-1]
+        last_rewards = rewards[-1, :, 0]
+        start += ticks
+
+
+def shuffle_batches(transitions, batch_size: int, buffer_size: int, rng=random):
+    """
+    :param transitions: an iterator of (states, actions_idxs, rewards, next_states) arrays, as read_transitions
+    :param buffer_size: number of transitions mixed together; when the buffer is full,
+                        it is shuffled and its first half is split in batches
+    :return: an iterator of (states, actions_idxs, rewards, next_states) batches of batch_size transitions
+             (except the last one)
+    """
+    assert buffer_size >= 2 * batch_size, "the shuffle buffer must hold at least two batches"
+    buffer = None
+    actions_count = None
+    for states, actions_idxs, rewards, next_states in transitions:
+        if len(states) == 0:
+            continue
+        # only keep the transitions with as many actions as the first one
+        counts = (actions_idxs >= 0).sum(axis=1)
+        if actions_count is None:
+            actions_count = int(counts[0])
+        keep = counts == actions_count
+        part = (states[keep], actions_idxs[keep, :actions_count], rewards[keep], next_states[keep])
+        buffer = part if buffer is None else tuple(concatenate(columns) for columns in zip(buffer, part))
+
+        if len(buffer[0]) >= buffer_size:
+            order = rng.permutation(len(buffer[0]))
+            buffer = tuple(column[order] for column in buffer)
+            emitted = (len(buffer[0]) - buffer_size // 2) // batch_size * batch_size
+            for batch_start in range(0, emitted, batch_size):
+                yield tuple(column[batch_start:batch_start + batch_size] for column in buffer)
+            buffer = tuple(column[emitted:] for column in buffer)
+
+    if buffer is None:
+        return
+    order = rng.permutation(len(buffer[0]))
+    buffer = tuple(column[order] for column in buffer)
+    for batch_start in range(0, len(buffer[0]), batch_size):
+        yield tuple(column[batch_start:batch_start + batch_size] for column in buffer)
+
+
+def prefetch(iterator, depth: int = 8):
+    """
+    Runs iterator on a background thread, up to depth items ahead of the caller
+    :return: an iterator over the same items
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterator:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def compute_targets(model: NN, states, actions_idxs, rewards, next_states, alpha, lamda):
+    """
+    Same one-step targets as AI.update_from_transitions. They differ from the targets of AI.update,
+    which also moves each action of its log towards the mean reward received since (a trace over several ticks)
+    :return: the predictions of model for states, with the chosen actions moved towards
+             reward + lamda * the best q values of the next state
+    """
+    targets = model.predict_actions(states)
+    next_q_values = model.predict_actions(next_states)
+    rows = arange(len(states))[:, None]
+
+    # one action chosen among all actions, or one action chosen in the slice of each rod
+    actions_count = actions_idxs.shape[1]
+    slice_size = next_q_values.shape[1] // actions_count
+    next_actions_idxs = argmax(next_q_values.reshape(len(states), actions_count, slice_size), axis=2) + \
+        arange(actions_count) * slice_size
+
+    targets[rows, actions_idxs] = \
+        (1 - alpha) * targets[rows, actions_idxs] + \
+        alpha * (rewards[:, None] + lamda * next_q_values[rows, next_actions_idxs])
+    return targets
+
+
+def train(model: NN, readers, state_template, alpha, lamda,
+          epochs: int = 1, batch_size: int = 4096, buffer_size: int = 65536, prefetch_depth: int = 8,
+          report_interval: int = 100, rng=random):
+    """
+    Trains model on recorded trajectories, without running the simulation
+    :param readers: TrajectoryReaders of the recordings
+    :param state_template: a StateTemplate of the recorded table, with the state size of model
+    :param alpha: as AI.alpha
+    :param lamda: as AI.lamda
+    :param report_interval: number of batches between two progress reports
+    :param rng: the generator used to shuffle the transitions, as in shuffle_batches
+    :return: a tuple (transitions, batches) with the number of transitions and of batches trained on
+    """
+    def all_transitions():
+        for _ in range(epochs):
+            for reader in readers:
+                yield from read_transitions(reader, state_template)
+
+    trained = 0
+    idx = -1
+    batches = prefetch(shuffle_batches(all_transitions(), batch_size, buffer_size, rng), prefetch_depth)
+    for idx, (states, actions_idxs, rewards, next_states) in enumerate(batches):
+        targets = compute_targets(model, states, actions_idxs, rewards, next_states, alpha, lamda)
+        loss = model.train_batch(states, targets)
+        trained += len(states)
+        if (idx + 1) % report_interval == 0:
+            print("{} batches, {} transitions; loss {:.4f}".format(idx + 1, trained, loss))
+    return trained, idx + 1
@@ -0,0 +1,213 @@
+from numpy import zeros, arange, float32, minimum, unique
+from numpy import random
+from numpy.lib.format import open_memmap
+import json
+import os
+
+
+class SumTree:
+    """
+    Has:
+        A complete binary tree stored in an array (root at index 1),
+        where each leaf is the priority of an item and each inner node is the sum of its children
+    Allows sampling items proportionally to their priority in O(log n).
+    """
+
+    def __init__(self, capacity: int):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.nodes = zeros(2 * self.leaves)
+
+    @property
+    def total(self):
+        return self.nodes[1]
+
+    def update(self, idxs, priorities):
+        """
+        :param idxs: vector of leaf indexes
+        :param priorities: vector with the new priority of each leaf
+        """
+        if len(idxs) == 0:
+            return
+        positions = idxs + self.leaves
+        self.nodes[positions] = priorities
+        while positions[0] > 1:
+            positions = unique(positions // 2)
+            self.nodes[positions] = self.nodes[2 * positions] + self.nodes[2 * positions + 1]
+
+    def find(self, values):
+        """
+        :param values: vector of values in [0, total]
+        :return: for each value, the index of the leaf whose priority interval contains it
+        """
+        values = values.copy()
+        positions = zeros(len(values), dtype=int) + 1
+        while positions[0] < self.leaves:
+            left = 2 * positions
+            left_sums = self.nodes[left]
+            go_right = values > left_sums
+            values -= left_sums * go_right
+            positions = left + go_right
+        return positions - self.leaves
+
+
+class ReplayMemory:
+    """
+    Has:
+        Preallocated arrays for states, targets and priorities, used as a ring buffer:
+        when full, the oldest memory is overwritten
+        Optionally a SumTree over the priorities, to sample important memories more often
+    The arrays can be memory-mapped .npy files in a directory, so that the memory can be larger than RAM,
+    survive restarts and be read by other processes.
+    """
+
+    ARRAYS = ("states", "targets", "priorities")
+
+    def __init__(self, capacity: int, state_size: int, target_size: int,
+                 prioritized: bool = False,
+                 priority_exponent: float = 0.6,
+                 min_priority: float = 1e-3,
+                 path: str = None,
+                 read_only: bool = False,
+                 rng: random.Generator = None):
+        """
+        :param capacity: maximum number of memories
+        :param state_size: length of a state
+        :param target_size: length of a target (the number of actions)
+        :param prioritized: if True, sample memories proportionally to their priority instead of uniformly
+        :param priority_exponent: how much the priorities matter (0 means uniform sampling)
+        :param min_priority: added to every error, so that every memory can still be sampled
+        :param path: a directory for memory-mapped arrays; if it already has a memory, that memory is opened
+                     (with its own capacity and sizes), otherwise a new one is created
+        :param read_only: open the memory in path without changing it, e.g. to sample it from another process
+        :param rng: the generator used for sampling (default: an unseeded generator)
+        """
+        assert capacity > 0, "ReplayMemory must have a positive capacity"
+        assert path is not None or not read_only, "only a memory in a directory can be opened read-only"
+        self.path = path
+        self.read_only = read_only
+        self.rng = rng if rng is not None else random.default_rng()
+        self.prioritized = prioritized
+        self.priority_exponent = priority_exponent
+        self.min_priority = min_priority
+        self.max_priority = 1.0
+        self.count = 0
+        self.next_idx = 0
+        # number of memories appended by this object, to know which sampled slots were overwritten since
+        self.written = 0
+
+        if path is None:
+            self.states = zeros((capacity, state_size), dtype=float32)
+            self.targets = zeros((capacity, target_size), dtype=float32)
+            self.priorities = zeros(capacity, dtype=float32)
+        elif os.path.exists(os.path.join(path, "meta.json")):
+            self.__open(path)
+        else:
+            assert not read_only, "no memory to open in {}".format(path)
+            os.makedirs(path, exist_ok=True)
+            shapes = ((capacity, state_size), (capacity, target_size), (capacity,))
+            for name, shape in zip(ReplayMemory.ARRAYS, shapes):
+                setattr(self, name, open_memmap(os.path.join(path, name + ".npy"), "w+", float32, shape))
+            self.flush()
+        self.capacity = len(self.states)
+
+        self.tree = SumTree(self.capacity) if prioritized else None
+        if self.tree is not None:
+            self.tree.update(arange(self.count), self.priorities[:self.count])
+
+    def __open(self, path):
+        for name in ReplayMemory.ARRAYS:
+            setattr(self, name, open_memmap(os.path.join(path, name + ".npy"), "r" if self.read_only else "r+"))
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reads the number of memories again from the directory, e.g. to see the memories flushed by another process
+        """
+        with open(os.path.join(self.path, "meta.json"), "rt") as fd:
+            meta = json.load(fd)
+        self.count = meta["count"]
+        self.next_idx = meta["next_idx"]
+        self.max_priority = meta["max_priority"]
+
+    def flush(self):
+        """
+        Writes the memory-mapped arrays and the number of memories to the directory
+        """
+        if self.path is None or self.read_only:
+            return
+        for name in ReplayMemory.ARRAYS:
+            getattr(self, name).flush()
+        meta_path = os.path.join(self.path, "meta.json")
+        with open(meta_path + ".tmp", "wt") as fd:
+            json.dump(dict(count=self.count, next_idx=self.next_idx, max_priority=self.max_priority), fd)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def __len__(self):
+        return self.count
+
+    def copy_to(self, path):
+        """
+        Writes a copy of this memory as memory-mapped arrays in the directory path, that can be opened with path
+        """
+        other = ReplayMemory(self.capacity, self.states.shape[1], self.targets.shape[1], path=path)
+        assert other.states.shape == self.states.shape and other.targets.shape == self.targets.shape, \
+            "{} has a memory of another size".format(path)
+        for name in ReplayMemory.ARRAYS:
+            getattr(other, name)[...] = getattr(self, name)
+        other.count = self.count
+        other.next_idx = self.next_idx
+        other.max_priority = self.max_priority
+        other.flush()
+
+    def append(self, state, target):
+        assert not self.read_only, "cannot append to a read-only memory"
+        idx = self.next_idx
+        self.states[idx] = state
+        self.targets[idx] = target
+        # new memories are sampled at least once before their real priority is known
+        self.priorities[idx] = self.max_priority
+        if self.tree is not None:
+            self.tree.update(arange(idx, idx + 1), self.priorities[idx:idx + 1])
+
+        self.next_idx = (idx + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.written += 1
+
+    def sample(self, size: int):
+        """
+        :param size: how many memories to sample; without replacement when uniform and size <= len(self),
+                     with replacement otherwise (a memory with a large priority can be sampled several times)
+        :return: a tuple (idxs, states, targets)
+        """
+        assert self.count > 0, "cannot sample an empty memory"
+        if self.tree is None:
+            idxs = self.rng.choice(self.count, size, replace=size > self.count)
+        else:
+            # one value in each of size equal segments of the total priority
+            segment = self.tree.total / size
+            values = (arange(size) + self.rng.random(size)) * segment
+            idxs = minimum(self.tree.find(values), self.count - 1)
+        return idxs, self.states[idxs], self.targets[idxs]
+
+    def update_priorities(self, idxs, errors, written=None):
+        """
+        :param idxs: indexes returned by sample
+        :param errors: vector with the current error of the network on each of the memories
+        :param written: self.written when idxs were sampled, if the errors come later (e.g. from a background learner);
+                        the memories overwritten since then keep the priority of their new memory
+        """
+        if self.tree is None or self.read_only:
+            return
+        if written is not None and written != self.written:
+            # the slots written since, oldest first, are next_idx - (self.written - written), ..., next_idx - 1
+            overwritten = (self.next_idx - idxs - 1) % self.capacity < self.written - written
+            idxs = idxs[~overwritten]
+            errors = errors[~overwritten]
+            if len(idxs) == 0:
+                return
+        priorities = (abs(errors) + self.min_priority) ** self.priority_exponent
+        self.priorities[idxs] = priorities
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(idxs, self.priorities[idxs])
@@ -1,6 +1,21 @@
 from sim.simulation import Simulation
-from numpy import array, sign
-from math import cos, pi
+from numpy import array, zeros, cumsum, arange, repeat, cos, clip, add, dot, negative, subtract, \
+    float32
+from math import pi
+
+
+def _read_state(sim: Simulation, ball, rods):
+    """
+    Copies the game state of sim into preallocated arrays
+    :param ball: vector of size 4: x, y, velocity x, velocity y
+    :param rods: matrix (rods, 2, 2) with ((offset, offset velocity), (angle, angle velocity)) on each row
+    """
+    position, velocity = sim.state.ball
+    ball[0] = position.real
+    ball[1] = position.imag
+    ball[2] = velocity.real
+    ball[3] = velocity.imag
+    rods[...] = sim.state.rods
 
 
 class StateTemplate:
@@ -17,74 +32,155 @@ class StateTemplate:
             self.rev_foosmans.insert(0, (table_length - x, foo_count, foo_dist))
         self.max_position = complex(table_length, 1)
 
-    @staticmethod
-    def __complex_to_tuple(c: complex):
-        return c.real, c.imag
-
-    def get_states_from_sim(self, sim: Simulation):
+        rods_number = len(sim.table_info.rods)
+        self.state_size = 4 + 4 * rods_number
+
+        self.__ball = zeros(4, dtype=float32)
+        self.__rods = zeros((rods_number, 4), dtype=float32)
+        self.__buffer = zeros((2, self.state_size), dtype=float32)
+
+        # the second player sees the table mirrored, so its state is state_1 @ mirror + mirror_shift:
+        # x -> length - x, y -> 1 - y, velocities negated
+        # rods in reverse order, offset -> 1 - offset, angles and velocities negated
+        self.__mirror = zeros((self.state_size, self.state_size), dtype=float32)
+        self.__mirror_shift = zeros(self.state_size, dtype=float32)
+        for i in range(4):
+            self.__mirror[i, i] = -1
+        self.__mirror_shift[0] = table_length
+        self.__mirror_shift[1] = 1
+        for i in range(rods_number):
+            rev_start = 4 + 4 * (rods_number - 1 - i)
+            for j in range(4):
+                self.__mirror[rev_start + j, 4 + 4 * i + j] = -1
+            self.__mirror_shift[4 + 4 * i] = 1
+
+    def encode(self, sim: Simulation, out):
+        """
+        Writes the states of both players in out, without allocating
+        :param out: C-contiguous float32 matrix of shape (2, state_size), e.g. a slice of a (N, 2, state_size) batch
+        """
+        _read_state(sim, self.__ball, self.__rods.reshape(-1, 2, 2))
+        self.encode_arrays(self.__ball, self.__rods, out)
+
+    def encode_arrays(self, ball, rods, out):
+        """
+        Same as encode, for a state given as arrays
+        :param ball: vector (x, y, velocity x, velocity y)
+        :param rods: matrix (rods, 4) with (offset, offset velocity, angle, angle velocity) on each row
+        :param out: C-contiguous float32 matrix of shape (2, state_size)
+        """
         # TODO: this is not properly reversed.
         # Notably, rod angle and possibly offset are wrong.
         # Probably also ball position?
         # Also inputs!
-        state_1 = list(StateTemplate.__complex_to_tuple(sim.state.ball[0])) +\
-                  list(StateTemplate.__complex_to_tuple(sim.state.ball[1]))
-        # Mirror this:
-        # x = sim.table.length - x
-        # y = 1 - x
-        state_2 = list(StateTemplate.__complex_to_tuple(
-             self.max_position - sim.state.ball[0])) +\
-                  list(StateTemplate.__complex_to_tuple(-sim.state.ball[1]))
+        out[0, :4] = ball
+        out[0, 4:] = rods.reshape(-1)
+        dot(out[0], self.__mirror, out=out[1])
+        out[1] += self.__mirror_shift
 
-        # rods for player 1
-        def unpack(p):
-            return p[0][0], p[0][1], p[1][0], p[1][1]
-
-        for i, ai_rod in zip(sim.state.rods, self.foosmans):
-            state_1.extend(unpack(i))
-            # state_1.extend(ai_rod)
-
-        # rods for player 2
-        # both angles and offsets (incl velocities) must be reversed
-
-        def neg_unpack(state_rod):
-            (offset, offset_vel), (angle, angle_vel) = state_rod
-            # offset is 0 - 1
-            # angle is -1 - 1
-            # velocities must be negated
-            return 1 - offset, -offset_vel, -angle, -angle_vel
-
-        for i, ai_rod in zip(reversed(sim.state.rods), self.rev_foosmans):
-            state_2.extend(neg_unpack(i))
-            # state_2.extend(ai_rod)
+    def get_states_from_sim(self, sim: Simulation):
+        self.encode(sim, self.__buffer)
+        return self.__buffer[0].copy(), self.__buffer[1].copy()
+
+
+def _get_layout(counts):
+    """
+    :param counts: number of foosmen of each rod, in the order of the state
+    :return: the positions in a StateTemplatev2 state of each rod's x, of each foosman edge
+             and of each rod's (offset velocity, angle velocity)
+    """
+    # each rod has x, 2 edges for each foosman, offset velocity and angle velocity
+    rod_sizes = 3 + 2 * counts
+    rod_starts = 4 + cumsum(rod_sizes) - rod_sizes
+    x_idxs = rod_starts
+    edge_idxs = array([start + 1 + i for start, count in zip(rod_starts, counts) for i in range(2 * count)])
+    vel_idxs = array([[start + 1 + 2 * count, start + 2 + 2 * count] for start, count in zip(rod_starts, counts)])
+    return x_idxs, edge_idxs, vel_idxs
+
+
+class _Foosmen:
+    """
+    Has:
+        The x coordinate of each rod (changed by the angle of the rod)
+        The y coordinates of the edges of all foosmen, rod after rod, 2 for each foosman
+    """
+
+    def __init__(self, xs, edges_by_rod, foosman_height):
+        self.xs = array(xs, dtype=float32)
+        self.initial_xs = self.xs.copy()
+        self.edges = array([edge for edges in edges_by_rod for edge in edges], dtype=float32)
+        counts = array([len(edges) for edges in edges_by_rod])
+        self.first_edges = cumsum(counts) - counts
+        self.last_edges = cumsum(counts) - 1
+        self.edge_rods = repeat(arange(len(counts)), counts)
+        self.foosman_height = foosman_height
+        self.min_xs = self.initial_xs - foosman_height
+        self.max_xs = self.initial_xs + foosman_height
+
+        self.__deltas = zeros(len(counts), dtype=float32)
+        self.__limits = zeros(len(counts), dtype=float32)
+
+    def apply_offset(self, offsets):
+        # offsets must be in order from X = 0 to X = max_X
+        # move each rod's foosmen by its offset, but never past 0 or 1
+        deltas = self.__deltas
+        limits = self.__limits
+        subtract(1, self.edges[self.last_edges], out=limits)
+        clip(offsets, -self.edges[self.first_edges], limits, out=deltas)
+        self.edges += deltas[self.edge_rods]
+
+    def apply_angles(self, angles):
+        # angles a list of angles between [-1, 1]
+        # -1 meaning max angle to my goal
+        # 1 meaning max angle to opponent goal
+        # transform from [-90, 90] (or [-pi / 2, pi / 2]) to [0, 180] (or [0, pi])
+        # and move the rod on X axis by the adjacent side of the angle
+        # (self.foosman_height is the hypotenuse)
+        deltas = self.__deltas
+        add(angles, 1, out=deltas)
+        deltas *= pi / 2
+        cos(deltas, out=deltas)
+        negative(deltas, out=deltas)
+        deltas[abs(deltas) < 0.0001] = 0
+        deltas *= self.foosman_height
+        self.xs += deltas
+        # stick to the boundary if it was exceeded
+        clip(self.xs, self.min_xs, self.max_xs, out=self.xs)
 
-        return state_1, state_2
+    def reset(self):
+        # center the foosmen between the sides
+        # offset must be 0 if rods are in initial position
+        offsets = (1 - self.edges[self.last_edges] - self.edges[self.first_edges]) / 2
+        self.edges += offsets[self.edge_rods]
+        self.xs[...] = self.initial_xs
 
 
 class StateTemplatev2:
 
     def __init__(self, sim: Simulation):
-        self.foosmans = []
-        self.rev_foosmans = []
-        self._rods_initial_postion = []
-        self._rev_rods_initial_postion = []
         table_length = sim.table_info.length
         self.foosman_width = sim.table_info.foosman_size[1]
         self.foosman_height = sim.table_info.foosman_size[2]
-        for rod in sim.table_info.rods:
-            _, x, foo_count, foo_dist, foo_offset = rod
-            self.foosmans.append([x,
-                                  self.get_foosmans_positions(foo_count, foo_dist)])
-            self._rods_initial_postion.append(x)
-            self.rev_foosmans.insert(0, [table_length - x,
-                                         self.get_foosmans_positions(foo_count,
-                                                                     foo_dist)
-                                         ])
-            self._rev_rods_initial_postion.insert(0, table_length - x)
+
+        rods = sim.table_info.rods
+        xs = [rod[1] for rod in rods]
+        edges_by_rod = [self.get_foosmans_positions(rod[2], rod[3]) for rod in rods]
+        self.foosmans = _Foosmen(xs, edges_by_rod, self.foosman_height)
+        self.rev_foosmans = _Foosmen([table_length - x for x in reversed(xs)],
+                                     list(reversed(edges_by_rod)),
+                                     self.foosman_height)
         self.max_position = complex(table_length, 1)
 
-    @staticmethod
-    def __complex_to_tuple(c: complex):
-        return c.real, c.imag
+        counts = array([rod[2] for rod in rods])
+        self.__layout = _get_layout(counts)
+        self.__rev_layout = _get_layout(counts[::-1])
+        self.state_size = 4 + len(rods) * 3 + 2 * int(counts.sum())
+
+        self.__ball = zeros(4, dtype=float32)
+        self.__rods = zeros((len(rods), 4), dtype=float32)
+        self.__rev_offsets = zeros(len(rods), dtype=float32)
+        self.__buffer = zeros((2, self.state_size), dtype=float32)
+        self.__ball_mirror = array([table_length, 1, 0, 0], dtype=float32)
 
     def get_foosmans_positions(self, foo_count, foo_dist):
         half_foosman_width = self.foosman_width / 2
@@ -94,104 +190,52 @@ class StateTemplatev2:
                       for i in weight_centers
                       for j in [-1, 1]])
 
-    @staticmethod
-    def apply_offset(offsets, rods):
-        # offsets must be in order from X = 0 to X = max_X
-        assert len(offsets) == len(rods), \
-            "Offsets must have length {}".format(len(rods))
-        for offset, rod in zip(offsets, rods):
-            if offset < 0:
-                possible_offset = min(rod[1][0], abs(offset))
-                rod[1] -= possible_offset
-            else:
-                possible_offset = min(1 - rod[1][-1], offset)
-                rod[1] += possible_offset
-
-    def __get_offset_by_angle(self, angle):
-        # angle is between -1 and 1
-        # transform from [-90, 90] (or [-pi / 2, pi / 2]) to [0, 180] (or [0, pi])
-        # return a distance to move rod on X axis (simulating angle of rod)
-        # i.e the length of adjacent right with the angle (self.foosman_height is the hypotenuse)
-        angle = ((angle + 1) / 2) * pi
-        cos_res = -cos(angle)
-        if abs(cos_res) < 0.0001:
-            cos_res = 0
-        return cos_res * self.foosman_height
-
-    def apply_angles(self, angles, rods, initial_rods):
-        # angles a list of angles between [-1, 1]
-        # -1 meaning max angle to my goal
-        # 1 meaning max angle to opponent goal
-        assert len(angles) == len(rods)
-        for angle, rod, init_rod in zip(angles, rods, initial_rods):
-            rod[0] += self.__get_offset_by_angle(angle)
-            diff = rod[0] - init_rod
-            if abs(diff) > self.foosman_height:
-                # there is a exceeded boundary
-                # stick to the boundary
-                rod[0] = init_rod + sign(diff) * self.foosman_height
-
     def reset(self):
-        for foosman, init_rod_x in zip(self.foosmans, self._rods_initial_postion):
-            # check side distance
-            # must be 0 if rods are in initial position
-            offset = (1 - foosman[1][-1] - foosman[1][0]) / 2
-            foosman[1] += offset
-            foosman[0] = init_rod_x
-        for rev_foosman, rev_init_rod_x in zip(self.rev_foosmans,
-                                               self._rev_rods_initial_postion):
-            # check side distance
-            # must be 0 if rods are in initial position
-            offset = (1 - rev_foosman[1][-1] - rev_foosman[1][0]) / 2
-            rev_foosman[1] += offset
-            rev_foosman[0] = rev_init_rod_x
-
-    def get_states_from_sim(self, sim: Simulation):
+        self.foosmans.reset()
+        self.rev_foosmans.reset()
+
+    def encode(self, sim: Simulation, out):
+        """
+        Writes the states of both players in out, without allocating a state;
+        the foosmen still use a few temporary arrays of one value per rod or foosman
+        :param out: C-contiguous float32 matrix of shape (2, state_size), e.g. a slice of a (N, 2, state_size) batch
+        """
+        _read_state(sim, self.__ball, self.__rods.reshape(-1, 2, 2))
+        self.encode_arrays(self.__ball, self.__rods, out)
+
+    def encode_arrays(self, ball, rods, out):
+        """
+        Same as encode, for a state given as arrays
+        :param ball: vector (x, y, velocity x, velocity y)
+        :param rods: matrix (rods, 4) with (offset, offset velocity, angle, angle velocity) on each row
+        :param out: C-contiguous float32 matrix of shape (2, state_size)
+        """
         # TODO: this is not properly reversed.
         # Notably, rod angle and possibly offset are wrong.
         # Probably also ball position?
         # Also inputs!
-        state_1 = list(StateTemplatev2.__complex_to_tuple(sim.state.ball[0])) +\
-                  list(StateTemplatev2.__complex_to_tuple(sim.state.ball[1]))
-        # Mirror this:
-        # x = sim.table.length - x
-        # y = 1 - x
-        state_2 = list(StateTemplatev2.__complex_to_tuple(
-             self.max_position - sim.state.ball[0])) +\
-                  list(StateTemplatev2.__complex_to_tuple(-sim.state.ball[1]))
+        out[0, :4] = ball
+        subtract(self.__ball_mirror, ball, out=out[1, :4])
 
         # rods for player 1
-        def unpack(p):
-            return p[0][1], p[1][1]
-
-        self.apply_offset([rod[0][0] for rod in sim.state.rods],
-                          self.foosmans)
-        self.apply_angles([rod[1][0] for rod in sim.state.rods],
-                          self.foosmans,
-                          self._rods_initial_postion)
-        for i, ai_rod in zip(sim.state.rods, self.foosmans):
-            state_1.append(ai_rod[0])
-            state_1.extend(ai_rod[1])
-            state_1.extend(unpack(i))
+        self.foosmans.apply_offset(rods[:, 0])
+        self.foosmans.apply_angles(rods[:, 2])
+        x_idxs, edge_idxs, vel_idxs = self.__layout
+        out[0, x_idxs] = self.foosmans.xs
+        out[0, edge_idxs] = self.foosmans.edges
+        out[0, vel_idxs] = rods[:, 1::2]
 
         # rods for player 2
         # both angles and offsets (incl velocities) must be reversed
-        self.apply_offset([1 - rod[0][0] for rod in reversed(sim.state.rods)],
-                          self.rev_foosmans)
-        self.apply_angles([-rod[1][0] for rod in sim.state.rods],
-                          self.rev_foosmans,
-                          self._rev_rods_initial_postion)
-
-        def neg_unpack(state_rod):
-            (offset, offset_vel), (angle, angle_vel) = state_rod
-            # offset is 0 - 1
-            # angle is -1 - 1
-            # velocities must be negated
-            return -offset_vel, -angle_vel
-
-        for i, ai_rod in zip(reversed(sim.state.rods), self.rev_foosmans):
-            state_2.append(ai_rod[0])
-            state_2.extend(ai_rod[1])
-            state_2.extend(neg_unpack(i))
-
-        return state_1, state_2
\ No newline at end of file
+        subtract(1, rods[::-1, 0], out=self.__rev_offsets)
+        self.rev_foosmans.apply_offset(self.__rev_offsets)
+        # angles are negated but, as before, not reversed
+        self.rev_foosmans.apply_angles(-rods[:, 2])
+        x_idxs, edge_idxs, vel_idxs = self.__rev_layout
+        out[1, x_idxs] = self.rev_foosmans.xs
+        out[1, edge_idxs] = self.rev_foosmans.edges
+        out[1, vel_idxs] = -rods[::-1, 1::2]
+
+    def get_states_from_sim(self, sim: Simulation):
+        self.encode(sim, self.__buffer)
+        return self.__buffer[0].copy(), self.__buffer[1].copy()
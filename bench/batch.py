@@ -0,0 +1,69 @@
+from sim import simulation
+from sim import table
+from sim import batch_simulation
+import main
+import numpy as np
+import itertools
+import json
+import os
+import time
+
+
+def _get_actions():
+    with open(os.path.join(os.path.dirname(os.path.abspath(main.__file__)), "config"), "rt") as fd:
+        conf = json.load(fd)
+    return np.array(list(itertools.product(np.arange(conf["rods_number"]), conf["offset"], conf["angle_velocity"])))
+
+
+def time_pymunk(table_info: table.TableInfo, actions, steps: int):
+    """
+    :return: table ticks per second of one pymunk Simulation, reset when done
+    """
+    sim = simulation.Simulation(table_info, np.random.default_rng(0))
+    sim.set_actions(actions)
+    action_idxs = np.random.default_rng(1).integers(0, len(actions), (steps, 2, 1))
+    start = time.perf_counter()
+    for step in range(steps):
+        for side in range(2):
+            sim.apply_action_indices(side, action_idxs[step, side])
+        sim.tick(1 / 60)
+        if sim.tick_info.goal_side is not None or not sim.tick_info.inbounds:
+            sim.reset()
+    return steps / (time.perf_counter() - start)
+
+
+def time_batch(table_info: table.TableInfo, actions, count: int, steps: int):
+    """
+    :return: table ticks per second of a BatchSimulation of count tables, resetting the tables that are done
+    """
+    batch = batch_simulation.BatchSimulation(table_info, count, np.random.default_rng(0))
+    batch.set_actions(actions)
+    action_idxs = np.random.default_rng(1).integers(0, len(actions), (steps, 2, count, 1))
+    start = time.perf_counter()
+    for step in range(steps):
+        for side in range(2):
+            batch.apply_action_indices(side, action_idxs[step, side])
+        batch.tick(1 / 60)
+        batch.reset(batch.dones)
+    return count * steps / (time.perf_counter() - start)
+
+
+def run(count=1000, steps=1000, seeds=20):
+    table_info = table.TableInfo.from_dict(main._get_table_info())
+    actions = _get_actions()
+
+    pymunk_tps = time_pymunk(table_info, actions, steps)
+    batch_tps = time_batch(table_info, actions, count, steps)
+    print("pymunk: {:.0f} table ticks per second".format(pymunk_tps))
+    print("batch of {}: {:.0f} table ticks per second ({:.1f}x faster)".format(count, batch_tps,
+                                                                            batch_tps / pymunk_tps))
+
+    results = [batch_simulation.check_divergence(table_info, actions, rng=np.random.default_rng(seed))
+               for seed in range(seeds)]
+    diverged = [result["diverged_tick"] for result in results if result["diverged_tick"] is not None]
+    print("divergence over {} games: {} never diverged, {} ended the same way, first divergence at ticks {}".format(
+        seeds, seeds - len(diverged), sum(result["same_end"] for result in results), sorted(diverged)))
+
+
+if __name__ == '__main__':
+    run()
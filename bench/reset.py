@@ -0,0 +1,50 @@
+from sim import simulation
+from sim import table
+import main
+import pymunk
+import gc
+import time
+
+
+def time_rebuild(table_info: table.TableInfo, count: int):
+    """
+    :return: seconds per reset when every reset builds a new space (as Simulation.reset used to)
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        table_info.get_space()
+    return (time.perf_counter() - start) / count
+
+
+def time_reset(sim: simulation.Simulation, count: int):
+    """
+    :return: seconds per Simulation.reset
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        sim.reset()
+    return (time.perf_counter() - start) / count
+
+
+def count_live_spaces():
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, pymunk.Space))
+
+
+def run(count=1000):
+    table_info = table.TableInfo.from_dict(main._get_table_info())
+    sim = simulation.Simulation(table_info)
+
+    rebuild_s = time_rebuild(table_info, count)
+    reset_s = time_reset(sim, count)
+    print("rebuild space: {:.1f} us per reset".format(rebuild_s * 1e6))
+    print("in place reset: {:.1f} us per reset ({:.1f}x faster)".format(reset_s * 1e6, rebuild_s / reset_s))
+
+    for _ in range(count):
+        sim.tick(1 / 60)
+        sim.reset()
+    print("live pymunk spaces after {} more resets: {}".format(count, count_live_spaces()))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,262 @@
+from sim import simulation
+from sim import table
+from sim import vec_simulation
+from ai.ai import AI
+from ai.state_template import StateTemplate, StateTemplatev2
+import main
+import numpy as np
+import random
+import json
+import os
+import sys
+import time
+
+SEED = 1234
+
+
+def _seed():
+    random.seed(SEED)
+    np.random.seed(SEED)
+    try:
+        import keras
+        keras.utils.set_random_seed(SEED)
+    except (ImportError, AttributeError):
+        pass
+
+
+def measure(func, iterations: int, warmup: int):
+    """
+    Calls func warmup times, then iterations times while timing each call
+    :return: a dict with the mean and percentiles of the call time, in microseconds, and the calls per second
+    """
+    for _ in range(warmup):
+        func()
+    times = np.zeros(iterations)
+    for idx in range(iterations):
+        start = time.perf_counter()
+        func()
+        times[idx] = time.perf_counter() - start
+    times *= 1e6
+    return dict(iterations=iterations,
+                mean_us=float(times.mean()),
+                p50_us=float(np.percentile(times, 50)),
+                p90_us=float(np.percentile(times, 90)),
+                p99_us=float(np.percentile(times, 99)),
+                per_sec=float(1e6 / times.mean()))
+
+
+def _get_sim():
+    return simulation.Simulation(table.TableInfo.from_dict(main._get_table_info()), np.random.default_rng(SEED))
+
+
+def _get_ai(**kwargs):
+    with open(os.path.join(os.path.dirname(os.path.abspath(main.__file__)), "config"), "rt") as fd:
+        conf = json.load(fd)
+    return AI(state_size=conf["state_size"],
+              rods_number=conf["rods_number"],
+              offset=conf["offset"],
+              angle_velocity=conf["angle_velocity"],
+              log_size=conf.get("log_size", 100),
+              rng=np.random.default_rng(SEED),
+              **kwargs)
+
+
+def _reset_when_done(sim):
+    if sim.tick_info.goal_side is not None or not sim.tick_info.inbounds:
+        sim.reset()
+
+
+def _act(brain: AI, sim: simulation.Simulation, template):
+    states = template.get_states_from_sim(sim)
+    for side, actions_idxs in enumerate(brain.get_actions_idxs_off_policy(states, brain.multiple_actions_off_policy)):
+        sim.apply_action_indices(side, actions_idxs)
+
+
+def bench_tick(scale):
+    sim = _get_sim()
+
+    def tick():
+        sim.tick(1 / 60)
+        _reset_when_done(sim)
+
+    return measure(tick, 2000 * scale, 200)
+
+
+def bench_reset(scale):
+    sim = _get_sim()
+    return measure(sim.reset, 1000 * scale, 100)
+
+
+def _bench_template(template_type, scale):
+    sim = _get_sim()
+    template = template_type(sim)
+    for _ in range(10):
+        sim.tick(1 / 60)
+    return measure(lambda: template.get_states_from_sim(sim), 2000 * scale, 200)
+
+
+def bench_state_template(scale):
+    return _bench_template(StateTemplate, scale)
+
+
+def bench_state_template_v2(scale):
+    return _bench_template(StateTemplatev2, scale)
+
+
+def bench_nn_predict_action(scale):
+    brain = _get_ai()
+    state = np.random.random_sample(brain.model.input_dim).astype(np.float32)
+    return measure(lambda: brain.model.predict_action(state), 2000 * scale, 200)
+
+
+def bench_nn_predict_action_keras(scale):
+    brain = _get_ai()
+    brain.model.numpy_inference = False
+    state = np.random.random_sample(brain.model.input_dim).astype(np.float32)
+    return measure(lambda: brain.model.predict_action(state), 50 * scale, 10)
+
+
+def bench_ai_update(scale):
+    brain = _get_ai()
+    sim = _get_sim()
+    sim.set_actions(brain.actions)
+    template = StateTemplate(sim)
+    last_rewards = np.zeros(2)
+
+    def reset_rewards():
+        last_rewards[:] = 0
+
+    sim.on_reset.append(brain.flush_last_actions)
+    sim.on_reset.append(reset_rewards)
+
+    def update():
+        # rewards as main's post_tick_function gives them: the change of reward since the last tick plus the penalty
+        _act(brain, sim, template)
+        sim.tick(1 / 60)
+        rewards = sim.get_rewards()
+        brain.update(list(rewards[:, 0] - last_rewards + rewards[:, 1]), template.get_states_from_sim(sim))
+        last_rewards[:] = rewards[:, 0]
+        _reset_when_done(sim)
+
+    return measure(update, 30 * scale, 2 * brain.log_size)
+
+
+def bench_from_memory_update(scale):
+    brain = _get_ai()
+    states = np.random.random_sample((2000, brain.model.input_dim))
+    targets = np.random.random_sample((2000, len(brain.actions)))
+    for state, target in zip(states, targets):
+        brain.memory.append(state, target)
+    return measure(brain.from_memory_update, 5 * scale, 1)
+
+
+def bench_headless_training(scale):
+    """
+    Same steps as main with --headless, without printing
+    """
+    brain = _get_ai()
+    sim = _get_sim()
+    sim.set_actions(brain.actions)
+    sim.on_reset.append(brain.flush_last_actions)
+    template = StateTemplate(sim)
+    last_rewards = np.zeros(2)
+
+    def step():
+        nonlocal last_rewards
+        _act(brain, sim, template)
+        sim.tick(1 / 60)
+        rewards = sim.get_rewards()
+        brain.update(list(rewards[:, 0] - last_rewards + rewards[:, 1]), template.get_states_from_sim(sim))
+        last_rewards = rewards[:, 0].copy()
+        if sim.tick_info.goal_side is not None or not sim.tick_info.inbounds:
+            sim.reset()
+            last_rewards[:] = 0
+
+    return measure(step, 50 * scale, 10)
+
+
+def bench_vec_step(scale, count=16):
+    """
+    One step of count tables, with a single network evaluation for all their players
+    """
+    brain = _get_ai()
+    vec = vec_simulation.VecSimulation(table.TableInfo.from_dict(main._get_table_info()), count, StateTemplate,
+                                       rng=np.random.default_rng(SEED))
+    vec.set_actions(brain.actions)
+    observations = vec.reset()
+
+    def step():
+        nonlocal observations
+        q_values = brain.model.predict_actions(observations.reshape(2 * count, -1))
+        actions_idxs = np.array([brain.multiple_actions(player_q_values) for player_q_values in q_values])
+        observations, _, _ = vec.step_action_indices(actions_idxs.reshape(count, 2, -1))
+
+    return measure(step, 200 * scale, 20)
+
+
+CASES = {
+    "tick": bench_tick,
+    "reset": bench_reset,
+    "state_template": bench_state_template,
+    "state_template_v2": bench_state_template_v2,
+    "nn_predict_action": bench_nn_predict_action,
+    "nn_predict_action_keras": bench_nn_predict_action_keras,
+    "ai_update": bench_ai_update,
+    "from_memory_update": bench_from_memory_update,
+    "headless_training": bench_headless_training,
+    "vec_step": bench_vec_step,
+}
+
+
+def compare(results, baseline, threshold):
+    """
+    :param threshold: relative slowdown of the mean that counts as a regression, e.g. 0.1 for 10%
+                      (the mean, because training cases alternate between fast and slow steps)
+    :return: the names of the cases slower than in baseline by more than threshold
+    """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        change = stats["mean_us"] / baseline[name]["mean_us"] - 1
+        flag = "REGRESSION" if change > threshold else ""
+        print("{:<24} {:>12.1f} us -> {:>12.1f} us  {:+7.1%} {}".format(
+            name, baseline[name]["mean_us"], stats["mean_us"], change, flag))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def run():
+    """
+    Options:
+        --cases a,b: only run these cases (default: all of CASES)
+        --scale N: multiply the number of iterations (default 1)
+        --output FILE: write the results as JSON
+        --baseline FILE: compare with results written by --output; exit with status 1 on a regression
+        --threshold X: relative slowdown of the mean that counts as a regression (default 0.1)
+    """
+    names = main._get_arg("--cases", ",".join(CASES)).split(",")
+    scale = main._get_arg("--scale", 1, int)
+
+    results = {}
+    for name in names:
+        _seed()
+        results[name] = CASES[name](scale)
+        stats = results[name]
+        print("{:<24} mean {:>12.1f} us  p50 {:>12.1f} us  p99 {:>12.1f} us  {:>12.1f}/sec".format(
+            name, stats["mean_us"], stats["p50_us"], stats["p99_us"], stats["per_sec"]))
+
+    if "--output" in sys.argv:
+        with open(main._get_arg("--output"), "wt") as fd:
+            json.dump(results, fd, indent=4)
+
+    if "--baseline" in sys.argv:
+        with open(main._get_arg("--baseline"), "rt") as fd:
+            baseline = json.load(fd)
+        if compare(results, baseline, main._get_arg("--threshold", 0.1, float)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
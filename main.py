@@ -1,30 +1,60 @@
-from ui import custom_ui
+from ui import headless
 from sim import simulation
 from sim import table
+from sim import recorder
 from ai.ai import AI
+from ai import distributed
+from ai import checkpoint
 from ai.state_template import StateTemplate, StateTemplatev2
+import numpy as np
 import json
 import random
 import math
 import sys
+import time
+import atexit
+import cProfile
+import pstats
+import os
 
 
 conf = {}
+ai_kwargs = {}
 pef_brain : AI = None
 state_template = None
+# the root of all the generators of this run, see _get_rng
+seed_sequence: np.random.SeedSequence = None
 
 
 def main():
     global state_template
     global pef_brain
 
-    if "--load" in sys.argv:
+    if "--load" in sys.argv or "--load-checkpoint" in sys.argv or _get_saved_session() is not None:
         load()
     else:
         load_from_config()
+    if "--resume" in sys.argv and "--no-train" not in sys.argv:
+        atexit.register(pef_brain.save_session, _get_arg("--resume"))
+
+    if "--keras-inference" in sys.argv:
+        pef_brain.model.numpy_inference = False
+        # the mirror is not used, but a difference with Keras is worth knowing before comparing both
+        pef_brain.model.verify_mirror()
+    if "--check-mirror" in sys.argv:
+        pef_brain.model.verify_refreshes = True
+
+    if "--actors" in sys.argv:
+        distributed.run(pef_brain, ai_kwargs, _get_table_info(),
+                        actors=_get_arg("--actors", arg_type=int),
+                        max_steps=_get_arg("--steps", arg_type=int),
+                        max_seconds=_get_arg("--seconds", arg_type=float),
+                        seed_sequence=_get_seed_sequence())
+        return
 
     table_info = _get_table_info()
-    sim = simulation.Simulation(table.TableInfo.from_dict(table_info))
+    sim = simulation.Simulation(table.TableInfo.from_dict(table_info), _get_rng())
+    sim.set_actions(pef_brain.actions)
 
     sim.on_goal.append(lambda side: print("Goal for {}".format(1 - side)))
     sim.on_oob.append(lambda: print("WARNING: OOB, resetting"))
@@ -32,36 +62,137 @@ def main():
     sim.on_reset.append(lambda: print("Resetting board"))
     sim.on_reset.append(lambda: pef_brain.flush_last_actions())
 
+    if "--record" in sys.argv:
+        trajectory_recorder = recorder.TrajectoryRecorder(sim, _get_arg("--record"),
+                                                          chunk_size=_get_arg("--record-chunk", 10000, int))
+        atexit.register(trajectory_recorder.close)
+
     state_template = StateTemplate(sim)  # see better place (bogdan)
     # sim.on_reset.append(state_template.reset)
-    custom_ui.run(sim, _get_inputs_function(sim), _get_post_tick_function(sim), pef_brain)
+    if "--profile" in sys.argv:
+        _profile(sim, _get_arg("--profile", arg_type=int))
+    elif "--headless" in sys.argv:
+        headless.run(sim, _get_inputs_function(sim), _get_post_tick_function(sim), pef_brain,
+                     max_steps=_get_arg("--steps", arg_type=int),
+                     max_seconds=_get_arg("--seconds", arg_type=float),
+                     save_on_exit="--no-train" not in sys.argv,
+                     timings_file=_get_arg("--timings"))
+    else:
+        # imported here so that headless runs never load pygame
+        from ui import custom_ui
+        custom_ui.run(sim, _get_inputs_function(sim), _get_post_tick_function(sim), pef_brain,
+                      timings_file=_get_arg("--timings", "timings.json"),
+                      target_fps=_get_arg("--fps", 30, int))
+
+
+def _profile(sim: simulation.Simulation, steps):
+    """
+    Runs steps headless steps under cProfile, without saving the AI,
+    and writes the stats sorted by cumulative time to --profile-output (profile.txt by default)
+    """
+    output = _get_arg("--profile-output", "profile.txt")
+    profiler = cProfile.Profile()
+    profiler.enable()
+    headless.run(sim, _get_inputs_function(sim), _get_post_tick_function(sim), pef_brain,
+                 max_steps=steps,
+                 save_on_exit=False)
+    profiler.disable()
+    profiler.dump_stats(output + ".prof")
+    with open(output, "wt") as fd:
+        pstats.Stats(profiler, stream=fd).sort_stats("cumulative").print_stats(50)
+    print("Profile of {} steps written to {} (raw stats in {}.prof)".format(steps, output, output))
+
+
+def _get_arg(name, default=None, arg_type=str):
+    """
+    :param name: the flag, e.g. "--steps"
+    :return: the value following the flag in sys.argv, converted with arg_type, or default if missing
+    """
+    if name not in sys.argv:
+        return default
+    idx = sys.argv.index(name)
+    if idx + 1 >= len(sys.argv):
+        raise ValueError("{} requires a value".format(name))
+    return arg_type(sys.argv[idx + 1])
+
+
+def _get_seed_sequence():
+    """
+    :return: the SeedSequence of this run, created from --seed (or from fresh entropy) on the first call
+    """
+    global seed_sequence
+    if seed_sequence is None:
+        seed_sequence = np.random.SeedSequence(_get_arg("--seed", arg_type=int))
+    return seed_sequence
+
+
+def _get_rng():
+    """
+    :return: a new generator, independent of the ones returned before
+    """
+    return np.random.default_rng(_get_seed_sequence().spawn(1)[0])
 
 
 def load_from_config():
     fd = open("config", "rt")
-    global conf, pef_brain
+    global conf, ai_kwargs, pef_brain
     conf = json.load(fd)
-    pef_brain = AI(load=False,
-                   state_size=conf["state_size"],
-                   rods_number=conf["rods_number"],
-                   offset=conf["offset"],
-                   angle_velocity=conf["angle_velocity"],
-                   log_size=100)  # see hidden layers field
+    seed = _get_arg("--seed", arg_type=int)
+    if seed is not None:
+        # the initial weights of a new network come from the Keras generators
+        from keras.utils import set_random_seed
+        set_random_seed(seed)
+    ai_kwargs = dict(load=False,
+                     state_size=conf["state_size"],
+                     rods_number=conf["rods_number"],
+                     offset=conf["offset"],
+                     angle_velocity=conf["angle_velocity"],
+                     log_size=conf.get("log_size", 100),  # see hidden layers field
+                     background_learning="--background-learner" in sys.argv,
+                     blocking_learner="--blocking-learner" in sys.argv,
+                     accept_stale_predictions="--stale-predictions" in sys.argv,
+                     memory_path=_get_session_memory_path(),
+                     rng=_get_rng())
+    pef_brain = AI(**ai_kwargs)
     fd.close()
 
 
+def _get_saved_session():
+    """
+    :return: the --resume directory if a session was saved there, None otherwise
+    """
+    session_dir = _get_arg("--resume")
+    if session_dir is None or not os.path.exists(os.path.join(session_dir, "network.json")):
+        return None
+    return session_dir
+
+
+def _get_session_memory_path():
+    session_dir = _get_arg("--resume")
+    return None if session_dir is None else os.path.join(session_dir, "memory")
+
+
 def load():
-    global pef_brain
-    pef_brain = AI(load=True)
+    global ai_kwargs, pef_brain
+    ai_kwargs = dict(load=True,
+                     checkpoint_path=_get_arg("--load-checkpoint"),
+                     session_path=_get_saved_session(),
+                     memory_path=_get_session_memory_path(),
+                     background_learning="--background-learner" in sys.argv,
+                     blocking_learner="--blocking-learner" in sys.argv,
+                     accept_stale_predictions="--stale-predictions" in sys.argv,
+                     rng=_get_rng())
+    pef_brain = AI(**ai_kwargs)
 
 
 def get_actions(sim: simulation.Simulation):
-    state_1, state_2 = state_template.get_states_from_sim(sim)
-    player_1 = pef_brain.predict_action(state_1, pef_brain.multiple_actions)
-    player_2 = pef_brain.predict_action(state_2, pef_brain.multiple_actions)
-    ret = list(map(lambda x: (0, x), player_1))
-    ret.extend(map(lambda x: (1, x), player_2))
-    return ret
+    # the actions are applied directly on sim, so there are no (side, input) pairs left to return
+    global last_input
+    last_input = pef_brain.predict_actions_idxs(state_template.get_states_from_sim(sim),
+                                                pef_brain.multiple_actions)
+    for side, actions_idxs in enumerate(last_input):
+        sim.apply_action_indices(side, actions_idxs)
+    return []
 
 
 last_input = None
@@ -80,15 +211,12 @@ def _get_inputs_function(sim: simulation.Simulation):
 
         time += dt
 
-        state_1, state_2 = state_template.get_states_from_sim(sim)
-        player_1 = pef_brain.get_action_off_policy(state_1, pef_brain.multiple_actions_off_policy)
-        player_2 = pef_brain.get_action_off_policy(state_2, pef_brain.multiple_actions_off_policy)
-        ret = list(map(lambda x: (0, x), player_1))
-        ret.extend(map(lambda x: (1, x), player_2))
-        last_input = ret
+        last_input = pef_brain.get_actions_idxs_off_policy(state_template.get_states_from_sim(sim),
+                                                           pef_brain.multiple_actions_off_policy)
+        for side, actions_idxs in enumerate(last_input):
+            sim.apply_action_indices(side, actions_idxs)
 
-        return last_input
-        # return []
+        return []
     if "--no-train" not in sys.argv:
         return inputs_function_nn, lambda _: get_actions(sim)
     else:
@@ -104,8 +232,7 @@ def _get_post_tick_function(sim: simulation.Simulation):
         nonlocal last_reward_2
 
         new_state_1, new_state_2 = state_template.get_states_from_sim(sim)
-        reward_1, penalty_1 = sim.get_current_reward(0)
-        reward_2, penalty_2 = sim.get_current_reward(1)
+        (reward_1, penalty_1), (reward_2, penalty_2) = sim.get_rewards()
 
         # print(reward_1, penalty_1)
 
@@ -125,11 +252,46 @@ def _get_post_tick_function(sim: simulation.Simulation):
     sim.on_reset.append(on_reset)
 
     if "--no-train" not in sys.argv:
-        return post_tick_function, lambda: None
+        return _with_autosave(post_tick_function), lambda: None
     else:
         return lambda: None, post_tick_function
 
 
+def _with_autosave(post_tick_function):
+    """
+    :return: post_tick_function, followed by a checkpoint of pef_brain every --autosave-steps steps
+             and every --autosave-minutes minutes (written by a background thread in --checkpoint-dir);
+             the checkpoints are named after pef_brain.updates, not after the steps of this run
+    """
+    autosave_steps = _get_arg("--autosave-steps", arg_type=int)
+    autosave_seconds = _get_arg("--autosave-minutes", arg_type=float)
+    if autosave_seconds is not None:
+        autosave_seconds *= 60
+    if autosave_steps is None and autosave_seconds is None:
+        return post_tick_function
+
+    checkpointer = checkpoint.Checkpointer(_get_arg("--checkpoint-dir", "checkpoints"),
+                                           keep=_get_arg("--keep-checkpoints", 5, arg_type=int))
+    atexit.register(checkpointer.close)
+    step = 0
+    last_save_time = time.perf_counter()
+
+    def post_tick_function_with_autosave():
+        nonlocal step
+        nonlocal last_save_time
+
+        post_tick_function()
+        step += 1
+
+        now = time.perf_counter()
+        if (autosave_steps is not None and step % autosave_steps == 0) or \
+                (autosave_seconds is not None and now - last_save_time >= autosave_seconds):
+            pef_brain.save_checkpoint(checkpointer)
+            last_save_time = now
+
+    return post_tick_function_with_autosave
+
+
 def _get_table_info():
     length = 2.0
     return {
@@ -0,0 +1,468 @@
+from . import simulation
+from . import state
+from . import table
+import numpy as np
+import math
+
+# the radius of the side segments built by TableInfo.get_space
+SIDE_RADIUS = 0.01
+
+
+def _get_side_segments(table_info: table.TableInfo):
+    """
+    :return: array (sides, 2, 2) with the end points of each side that the ball bounces on, as in TableInfo.get_space
+             (the goal segments only stop the foosmen, so they are left out)
+    """
+    length = table_info.length
+    goal_clearance = (1 - table_info.goal_width) / 2
+    return np.array([
+        ((0, 0), (length, 0)),
+        ((0, 1), (length, 1)),
+        ((0, 0), (0, goal_clearance)),
+        ((0, 1 - goal_clearance), (0, 1)),
+        ((length, 0), (length, goal_clearance)),
+        ((length, 1 - goal_clearance), (length, 1)),
+    ], dtype=float)
+
+
+class _TableView:
+    """
+    Has the table info and the state of one table of a BatchSimulation,
+    so it can be passed where a Simulation is read, as StateTemplate.encode
+    """
+
+    __slots__ = ("table_info", "_batch", "_idx")
+
+    def __init__(self, batch: "BatchSimulation", idx: int):
+        self.table_info = batch.table_info
+        self._batch = batch
+        self._idx = idx
+
+    @property
+    def state(self):
+        """
+        :return: a GameState with a copy of the current state of the table
+        """
+        return self._batch.get_state(self._idx)
+
+
+class BatchSimulation:
+    """
+    Has:
+        A TableInfo, shared by N tables
+        For each table, the same values as a Simulation, as arrays with the table on the first axis:
+            the ball position and velocity of the physics and of the state (the state is only refreshed by tick)
+            the rod positions and velocities, and the rods of the state, as GameState.rods
+            the tick info (goal side, in bounds, ball speed and direction) and the rewards
+    Steps all tables at once with array math instead of one pymunk space per table.
+    The world is simple enough for that: one ball, kinematic axis-aligned boxes (the foosmen, which never rotate)
+    and static segments, all without friction, so a contact only reflects the normal velocity of the ball.
+    The contacts are resolved like pymunk does (positions first, then the velocities of the touching bodies,
+    with the same elasticity, slop and bias), but not identically; see check_divergence.
+    """
+
+    def __init__(self, table_info: table.TableInfo, count: int, rng: np.random.Generator = None,
+                 elasticity: float = 0.8 * 0.8, iterations: int = 10, collision_slop: float = 0.1,
+                 collision_bias: float = (1 - 0.1) ** 60, collision_persistence: int = 3):
+        """
+        :param count: number of tables (N)
+        :param rng: the generator of the initial ball velocities (default: an unseeded generator)
+        :param elasticity: of a contact; pymunk multiplies the elasticities (0.8) of both shapes
+        :param iterations: passes over the contacts of a ball in each step, as pymunk.Space.iterations
+        :param collision_slop: overlap allowed without pushing the ball out, as pymunk.Space.collision_slop
+        :param collision_bias: fraction of the overlap left after a second, as pymunk.Space.collision_bias
+        :param collision_persistence: steps during which a contact keeps its impulse after it stops touching,
+                                      as pymunk.Space.collision_persistence
+        """
+        assert count > 0, "BatchSimulation must contain at least one table"
+        self.table_info = table_info
+        self.count = count
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.elasticity = elasticity
+        self.collision_slop = collision_slop
+        self.collision_bias = collision_bias
+        self.iterations = iterations
+        self.collision_persistence = collision_persistence
+
+        rods = table_info.rods
+        rods_number = len(rods)
+        self.sides = _get_side_segments(table_info)
+        # every foosman, rod after rod: its rod and its distance from the rod center on the Y axis
+        self.foosman_rods = np.array([idx for idx, rod in enumerate(rods) for _ in range(rod[2])])
+        self.foosman_offsets = np.array([rod[3] * ((rod[2] - 1) / 2 - foo_idx)
+                                         for rod in rods for foo_idx in range(rod[2])])
+        self.foosman_half_size = np.array(table_info.foosman_size[:2]) / 2
+
+        # physics
+        self.ball_positions = np.zeros((count, 2))
+        self.ball_velocities = np.zeros((count, 2))
+        self.rod_positions = np.zeros((count, rods_number, 2))
+        self.rod_velocities = np.zeros((count, rods_number, 2))
+        # the velocities that push overlapping balls out during the next step only
+        self.ball_bias_velocities = np.zeros((count, 2))
+        # for the ball and each side and foosman: the sum of the impulses of their last contact,
+        # the steps since it and the part of the shape it touched, see _find_contacts
+        shapes = len(self.sides) + len(self.foosman_rods)
+        self.contact_impulses = np.zeros((count, shapes))
+        self.contact_ages = np.full((count, shapes), collision_persistence + 1)
+        self.contact_features = np.zeros((count, shapes), dtype=int)
+        self._last_dt = 0
+
+        # state: ball (x, y, velocity x, velocity y) and rods as in GameState.rods
+        self.balls = np.zeros((count, 4))
+        self.rods = np.zeros((count, rods_number, 2, 2))
+
+        # as in Simulation
+        self.side_rods = ([idx for idx, rod in enumerate(rods) if rod[0] == 0],
+                          [idx for idx, rod in reversed(list(enumerate(rods))) if rod[0] == 1])
+        self.action_rods: np.ndarray = None
+        self.action_velocities: np.ndarray = None
+        self.own_rods = np.array([[rod[0] == side for rod in rods] for side in range(2)], dtype=float)
+
+        # tick info: goal side (-1 for none), in bounds, ball speed and direction
+        self.goal_sides = np.full(count, -1)
+        self.inbounds = np.ones(count, dtype=bool)
+        self.ball_speeds = np.zeros(count)
+        self.ball_directions = np.zeros(count)
+        self.rewards = np.zeros((count, 2, 2))
+        self._rewards_valid = False
+
+        self.reset()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def dones(self):
+        """
+        :return: for each table, True if a goal was scored or the ball left the table in the last tick
+        """
+        return (self.goal_sides >= 0) | ~self.inbounds
+
+    def reset(self, idxs=None):
+        """
+        Same as Simulation.reset, for the tables in idxs (default: all)
+        """
+        if idxs is None:
+            idxs = np.arange(self.count)
+        idxs = np.asarray(idxs)
+        if idxs.dtype == bool:
+            idxs = np.flatnonzero(idxs)
+
+        # as TableInfo.reset_bodies
+        kicks = self.rng.uniform(-0.05, 0.05, (len(idxs), 4))
+        self.ball_positions[idxs] = kicks[:, :2] + (self.table_info.length / 2, 0.5)
+        self.ball_velocities[idxs] = kicks[:, 2:]
+        self.rod_positions[idxs, :, 0] = self.table_info.rod_xs
+        self.rod_positions[idxs, :, 1] = 0.5
+        self.rod_velocities[idxs] = 0
+        self.ball_bias_velocities[idxs] = 0
+        self.contact_ages[idxs] = self.collision_persistence + 1
+
+        # as TableInfo.get_init_state
+        self.balls[idxs] = (0.5, 0.5, 0, 0)
+        self.rods[idxs] = ((0.5, 0.0), (0.0, 0.0))
+
+        self._update_tick_info()
+
+    def get_state(self, idx):
+        """
+        :return: a GameState with a copy of the state of table idx
+        """
+        x, y, velocity_x, velocity_y = self.balls[idx]
+        return state.GameState((0, 0), (complex(x, y), complex(velocity_x, velocity_y)), self.rods[idx].copy())
+
+    def table(self, idx):
+        """
+        BatchSimulation has no state of its own; use this view (or get_state) to read one table like a Simulation
+        :return: a view of table idx with the table_info and state attributes of a Simulation
+        """
+        return _TableView(self, idx)
+
+    def set_actions(self, actions):
+        """
+        Same as Simulation.set_actions
+        """
+        absolute = np.array([[self._input_to_absolute(side, action) for action in actions] for side in range(2)])
+        self.action_rods = absolute[:, :, 0].astype(int)
+        self.action_velocities = absolute[:, :, 1:]
+
+    def _input_to_absolute(self, side, input):
+        rod_idx, offset_vel, angle_vel = input
+        # as in Simulation, side 1's rods and velocities are reversed
+        if side == 1:
+            offset_vel = -offset_vel
+            angle_vel = -angle_vel
+        return self.side_rods[side][int(rod_idx)], offset_vel, angle_vel
+
+    def apply_action_indices(self, side, actions_idxs):
+        """
+        Same as Simulation.apply_action_indices, for all tables
+        :param actions_idxs: matrix (N, k) with the indexes of k actions of the player on each table
+        """
+        actions_idxs = np.asarray(actions_idxs)
+        rods = self.action_rods[side, actions_idxs]
+        self.rods[np.arange(self.count)[:, None], rods, :, 1] = self.action_velocities[side, actions_idxs]
+
+    def tick(self, time):
+        self._set_rod_velocities(time)
+        # pymunk moves every body first, then finds and solves the contacts at the new positions
+        self.ball_positions += (self.ball_velocities + self.ball_bias_velocities) * time
+        self.ball_bias_velocities[...] = 0
+        self.rod_positions += self.rod_velocities * time
+        self._solve_contacts(time)
+        self._last_dt = time
+        self._fetch_state()
+        self._update_tick_info()
+
+    def _set_rod_velocities(self, dt):
+        """
+        Same as Simulation._set_rod_velocities, for all tables
+        """
+        table_info = self.table_info
+        offset_vels = self.rods[:, :, 0, 1]
+        angles = self.rods[:, :, 1, 0]
+        angle_vels = self.rods[:, :, 1, 1]
+
+        next_foo_xs = table_info.get_rods_x(angles + angle_vels * dt / 2)
+        self.rod_velocities[:, :, 0] = (next_foo_xs - self.rod_positions[:, :, 0]) / dt / 2
+
+        a_offsets = table_info.get_rods_offset(self.rod_positions[:, :, 1])
+        blocked = ((a_offsets < 0) & (offset_vels < 0)) | ((a_offsets > 1) & (offset_vels > 0))
+        self.rod_velocities[:, :, 1] = np.where(blocked, 0, offset_vels)
+
+    def _find_contacts(self):
+        """
+        :return: a tuple of arrays with a column for each side and then each foosman:
+                    penetrations (N, shapes): how deep the ball is in the shape (negative if they do not touch)
+                    normals (N, shapes, 2): unit vectors from the shape to the ball
+                    velocities (N, shapes, 2): of the shapes (zeros for the static sides)
+                    features (N, shapes): which part of the shape is touched (a face, a corner or an end),
+                                          because pymunk only keeps the impulse of a contact on the same part
+        """
+        # the sides: the closest point of each segment to each ball
+        starts = self.sides[:, 0]
+        vectors = self.sides[:, 1] - starts
+        t = np.clip(np.einsum("ijk,jk->ij", self.ball_positions[:, None, :] - starts, vectors) /
+                    np.einsum("jk,jk->j", vectors, vectors), 0, 1)
+        side_deltas = self.ball_positions[:, None, :] - (starts + t[:, :, None] * vectors)
+        side_distances = np.sqrt(np.einsum("ijk,ijk->ij", side_deltas, side_deltas))
+        side_penetrations = self.table_info.ball_radius + SIDE_RADIUS - side_distances
+        side_features = np.where(t <= 0, 0, np.where(t >= 1, 2, 1))
+
+        # the foosmen: the closest point of each box, or the nearest face if the center of the ball is inside
+        centers = self.rod_positions[:, self.foosman_rods]
+        centers[:, :, 1] += self.foosman_offsets
+        relative = self.ball_positions[:, None, :] - centers
+        outside = np.abs(relative) - self.foosman_half_size
+        foosman_deltas = np.sign(relative) * np.maximum(outside, 0)
+        foosman_distances = np.sqrt(np.einsum("ijk,ijk->ij", foosman_deltas, foosman_deltas))
+        inside = foosman_distances == 0
+        nearest_faces = outside.max(axis=2)
+        foosman_penetrations = self.table_info.ball_radius - np.where(inside, nearest_faces, foosman_distances)
+        face_deltas = np.where(outside == nearest_faces[:, :, None], np.sign(relative), 0)
+        foosman_deltas = np.where(inside[:, :, None], face_deltas, foosman_deltas)
+        # a face or a corner: the side of the box the ball is on along each axis
+        regions = np.sign(foosman_deltas).astype(int) + 1
+        foosman_features = regions[:, :, 0] * 3 + regions[:, :, 1]
+
+        penetrations = np.concatenate((side_penetrations, foosman_penetrations), axis=1)
+        deltas = np.concatenate((side_deltas, foosman_deltas), axis=1)
+        lengths = np.sqrt(np.einsum("ijk,ijk->ij", deltas, deltas))
+        normals = deltas / np.where(lengths > 0, lengths, 1)[:, :, None]
+        velocities = np.concatenate((np.zeros_like(side_deltas), self.rod_velocities[:, self.foosman_rods]), axis=1)
+        features = np.concatenate((side_features, foosman_features), axis=1)
+        return penetrations, normals, velocities, features
+
+    def _solve_contacts(self, dt):
+        """
+        Solves the contacts of the balls like pymunk: each contact keeps the sum of the impulses it applied
+        (from its previous steps too, if it touched the same part of the shape less than collision_persistence
+        steps ago) and the contacts are solved one after the other, deepest first, for some iterations.
+        pymunk solves them in the order its spatial index finds them, so a ball pinched between two foosmen
+        can leave differently
+        """
+        penetrations, normals, velocities, features = self._find_contacts()
+        touching = penetrations > 0
+        self.contact_ages += 1
+        rows = np.flatnonzero(touching.any(axis=1))
+        if len(rows) == 0:
+            return
+
+        # for the tables with contacts, the columns of their contacts, deepest first
+        contacts = int(touching[rows].sum(axis=1).max())
+        columns = np.argsort(np.where(touching[rows], -penetrations[rows], np.inf), axis=1)[:, :contacts]
+        sub_rows = rows[:, None]
+        valid = touching[sub_rows, columns]
+        normals = normals[sub_rows, columns]
+        velocities = velocities[sub_rows, columns]
+        penetrations = penetrations[sub_rows, columns]
+        features = features[sub_rows, columns]
+
+        # warm start with the impulses of the contacts that persist
+        persisting = valid & (self.contact_ages[sub_rows, columns] <= self.collision_persistence) & \
+            (self.contact_features[sub_rows, columns] == features)
+        impulses = np.where(persisting, self.contact_impulses[sub_rows, columns], 0)
+        ball_velocities = self.ball_velocities[rows]
+        bounces = self.elasticity * np.einsum("ijk,ijk->ij", ball_velocities[:, None, :] - velocities, normals)
+        dt_coef = dt / self._last_dt if self._last_dt else 0
+        ball_velocities += np.einsum("ij,ijk->ik", impulses * dt_coef, normals)
+
+        for _ in range(self.iterations):
+            for contact in range(contacts):
+                normal = normals[:, contact]
+                normal_velocities = np.einsum("ij,ij->i", ball_velocities - velocities[:, contact], normal)
+                old_impulses = impulses[:, contact]
+                new_impulses = np.where(valid[:, contact],
+                                        np.maximum(old_impulses - bounces[:, contact] - normal_velocities, 0),
+                                        old_impulses)
+                ball_velocities += (new_impulses - old_impulses)[:, None] * normal
+                impulses[:, contact] = new_impulses
+        self.ball_velocities[rows] = ball_velocities
+
+        self.contact_impulses[sub_rows, columns] = np.where(valid, impulses, self.contact_impulses[sub_rows, columns])
+        self.contact_ages[sub_rows, columns] = np.where(valid, 0, self.contact_ages[sub_rows, columns])
+        self.contact_features[sub_rows, columns] = np.where(valid, features, self.contact_features[sub_rows, columns])
+
+        # the overlap beyond the slop is pushed out during the next step, as pymunk does with its bias velocities
+        bias_coef = 1 - self.collision_bias ** dt
+        corrections = np.where(valid, np.maximum(penetrations - self.collision_slop, 0), 0) * bias_coef / dt
+        self.ball_bias_velocities[rows] = np.einsum("ij,ijk->ik", corrections, normals)
+
+    def _fetch_state(self):
+        """
+        Same as Simulation._fetch_state, for all tables
+        """
+        table_info = self.table_info
+        self.balls[:, :2] = self.ball_positions
+        self.balls[:, 2:] = self.ball_velocities
+
+        rod_angles = table_info.get_rods_angle(self.rod_positions[:, :, 0])
+        rod_last_angles = table_info.get_rods_angle(self.rod_positions[:, :, 0] - self.rod_velocities[:, :, 0])
+        self.rods[:, :, 0, 0] = table_info.get_rods_offset(self.rod_positions[:, :, 1])
+        self.rods[:, :, 0, 1] = self.rod_velocities[:, :, 1]
+        self.rods[:, :, 1, 0] = rod_angles
+        self.rods[:, :, 1, 1] = rod_angles - rod_last_angles
+
+    def _update_tick_info(self):
+        """
+        Same as Simulation._update_tick_info (with TableInfo.get_goal and get_inbounds), for all tables
+        """
+        table_info = self.table_info
+        x, y = self.balls[:, 0], self.balls[:, 1]
+        in_goal = np.abs(y - 0.5) <= table_info.goal_width / 2
+        self.goal_sides = np.where(in_goal & (x < 0), 0, np.where(in_goal & (x > table_info.length), 1, -1))
+        threshold = 0.1
+        self.inbounds = (-threshold <= x) & (x <= table_info.length + threshold) & \
+            (-threshold <= y) & (y <= 1 + threshold)
+        self.ball_speeds = np.hypot(self.balls[:, 2], self.balls[:, 3])
+        self.ball_directions = np.sign(self.balls[:, 2])
+        self._rewards_valid = False
+
+    def get_current_reward(self, player: int):
+        """
+        Same as Simulation.get_current_reward, for all tables
+        :return: a tuple of vectors (rewards, penalties) of player on each table
+        """
+        rewards = self.get_rewards()[:, player]
+        return rewards[:, 0], rewards[:, 1]
+
+    def get_rewards(self):
+        """
+        Same as Simulation.get_rewards, for all tables
+        :return: an array (N, 2, 2) with (reward, penalty) for each player on each table;
+                 it is overwritten after the next tick or reset
+        """
+        if self._rewards_valid:
+            return self.rewards
+        self._rewards_valid = True
+        rewards = self.rewards
+        length = self.table_info.length
+
+        speeds = self.ball_speeds
+        with np.errstate(divide="ignore", invalid="ignore"):
+            penalties = np.where(speeds < 0.0001, -10, np.where(speeds < 0.1, -np.minimum(0.1 / speeds, 10), 0))
+        penalties = penalties - 2000 * ~self.inbounds
+
+        offsets = self.rods[:, :, 0, 0]
+        angles = self.rods[:, :, 1, 0]
+        rods_at_edge = ((offsets < 0.01) | (offsets > 0.99)).astype(float) + ((angles < -0.99) | (angles > 0.99))
+        rod_penalties = rods_at_edge @ self.own_rods.T * -5
+
+        ball_x = self.balls[:, 0]
+        good_multiplier = 8
+        bad_multiplier = 3
+        for player in range(2):
+            player_penalties = penalties + rod_penalties[:, player]
+            ball_directions = self.ball_directions * ((-1) ** player)
+
+            dist_from_goal = np.abs(length * player - ball_x)
+            dist_to_goal = length - dist_from_goal
+            score_multipliers = np.where(dist_to_goal < dist_from_goal, good_multiplier, bad_multiplier)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                forward = np.minimum(dist_from_goal / dist_to_goal * score_multipliers, 50)
+                backward = -np.minimum(dist_to_goal / dist_from_goal * good_multiplier, 50)
+
+            rewards[:, player, 0] = np.where(ball_directions == 0, -5,
+                                             np.where(ball_directions == 1, forward, backward))
+            rewards[:, player, 1] = np.where(ball_directions == 0, player_penalties - 5, player_penalties)
+
+        goals = np.flatnonzero(self.goal_sides >= 0)
+        goal_sides = self.goal_sides[goals]
+        rewards[goals, 1 - goal_sides] = (1000, 0)
+        rewards[goals, goal_sides] = (-1000, 0)
+        return rewards
+
+
+def check_divergence(table_info: table.TableInfo, actions, steps: int = 600, dt: float = 1 / 60,
+                     tolerance: float = 0.01, rng: np.random.Generator = None):
+    """
+    Runs a pymunk Simulation and a BatchSimulation of one table side by side from the same ball position and velocity,
+    with the same random actions at each tick, until a goal or the ball leaves the table (or steps ticks)
+    :param actions: a matrix with an action (rod_idx, offset_vel, angle_vel) on each row, like AI.actions
+    :param tolerance: distance between the balls of both simulations from which they count as diverged
+    :return: a dict with the number of ticks run, the first tick with a ball distance above tolerance
+             (None if there is none), the maximum ball and rod position errors
+             and whether both simulations ended the same way
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    sim = simulation.Simulation(table_info, rng)
+    batch = BatchSimulation(table_info, 1, rng)
+    sim.set_actions(actions)
+    batch.set_actions(actions)
+    batch.ball_positions[0] = tuple(sim.ball_body.position)
+    batch.ball_velocities[0] = tuple(sim.ball_body.velocity)
+
+    rods_number = max(map(len, sim.side_rods))
+    slice_size = len(actions) // rods_number
+    diverged_tick = None
+    max_ball_error = 0.0
+    max_rod_error = 0.0
+    tick = 0
+    for tick in range(1, steps + 1):
+        for side in range(2):
+            # one action for each rod of the player, as AI.multiple_actions
+            actions_idxs = np.arange(rods_number) * slice_size + rng.integers(0, slice_size, rods_number)
+            sim.apply_action_indices(side, actions_idxs)
+            batch.apply_action_indices(side, actions_idxs[None, :])
+        sim.tick(dt)
+        batch.tick(dt)
+
+        ball_error = math.hypot(*(np.array(sim.ball_body.position) - batch.ball_positions[0]))
+        max_ball_error = max(max_ball_error, ball_error)
+        max_rod_error = max(max_rod_error, float(np.abs(sim.rod_positions - batch.rod_positions[0]).max()))
+        if diverged_tick is None and ball_error > tolerance:
+            diverged_tick = tick
+
+        done = sim.tick_info.goal_side is not None or not sim.tick_info.inbounds
+        if done or batch.dones[0]:
+            break
+
+    goal_side = sim.tick_info.goal_side
+    return dict(ticks=tick,
+                diverged_tick=diverged_tick,
+                max_ball_error=max_ball_error,
+                max_rod_error=max_rod_error,
+                same_end=(-1 if goal_side is None else goal_side) == batch.goal_sides[0]
+                and sim.tick_info.inbounds == batch.inbounds[0])
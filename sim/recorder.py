@@ -0,0 +1,197 @@
+from . import simulation
+import numpy as np
+import json
+import os
+
+# goal sides are 0 and 1
+END_OOB = 2
+END_RESET = -1
+
+
+def _chunk_name(idx):
+    return "chunk-{:06d}.npz".format(idx)
+
+
+class TrajectoryRecorder:
+    """
+    Has:
+        A Simulation whose ticks it records
+        Preallocated column buffers for one chunk of ticks:
+            ball (x, y, velocity x, velocity y)
+            rods (offset, offset velocity, angle, angle velocity) for each rod
+            the indexes of the actions applied by each side (-1 for none)
+            the inputs applied by each side to each of its rods, from actions or not (e.g. from the keyboard),
+            as Simulation.applied_inputs (NaN for none)
+            the (reward, penalty) of each side
+            the duration of the tick
+        An index of the written chunks and of the episodes (one episode between two resets)
+    Writes one uncompressed npz file per chunk in a directory, then rewrites index.json.
+    """
+
+    def __init__(self, sim: simulation.Simulation, directory, chunk_size: int = 10000):
+        """
+        :param sim: the simulation to record, from its next tick on
+        :param directory: where chunk files and index.json are written; created if missing
+        :param chunk_size: number of ticks in a chunk file
+        """
+        assert chunk_size > 0, "TrajectoryRecorder must have a positive chunk size"
+        self.sim = sim
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+
+        rods_number = len(sim.table_info.rods)
+        self.ball = np.zeros((chunk_size, 4), dtype=np.float32)
+        self.rods = np.zeros((chunk_size, rods_number, 4), dtype=np.float32)
+        self.actions = np.zeros((chunk_size,) + sim.applied_actions.shape, dtype=np.int16)
+        self.inputs = np.zeros((chunk_size,) + sim.applied_inputs.shape, dtype=np.float32)
+        self.rewards = np.zeros((chunk_size, 2, 2), dtype=np.float32)
+        self.dts = np.zeros(chunk_size, dtype=np.float32)
+        # ticks in the current chunk
+        self.length = 0
+
+        self.ticks = 0
+        self.chunks = []
+        self.episode_starts = [0]
+        self.episode_ends = []
+
+        # how the current episode would end if the game was reset now
+        self.__end = END_RESET
+
+        sim.on_tick.append(self.record)
+        sim.on_reset.append(self.__on_reset)
+
+    def record(self, time):
+        """
+        Appends the current state of the simulation; called after each tick
+        :param time: the duration of the tick
+        """
+        sim = self.sim
+        idx = self.length
+        position, velocity = sim.state.ball
+        self.ball[idx] = (position.real, position.imag, velocity.real, velocity.imag)
+        self.rods[idx] = sim.state.rods.reshape(len(self.rods[idx]), 4)
+        self.actions[idx] = sim.applied_actions
+        self.inputs[idx] = sim.applied_inputs
+        self.rewards[idx] = sim.get_rewards()
+        self.dts[idx] = time
+
+        info = sim.tick_info
+        if info.goal_side is not None:
+            self.__end = info.goal_side
+        elif not info.inbounds:
+            self.__end = END_OOB
+        else:
+            self.__end = END_RESET
+
+        self.length += 1
+        self.ticks += 1
+        if self.length == self.chunk_size:
+            self.flush()
+
+    def __on_reset(self):
+        if self.ticks == self.episode_starts[-1]:
+            # nothing was recorded since the last reset
+            return
+        self.episode_ends.append(self.__end)
+        self.__end = END_RESET
+        self.episode_starts.append(self.ticks)
+
+    def flush(self):
+        """
+        Writes the ticks of the current chunk, if any, and the index
+        """
+        if self.length > 0:
+            name = _chunk_name(len(self.chunks))
+            path = os.path.join(self.directory, name)
+            with open(path + ".tmp", "wb") as fd:
+                np.savez(fd,
+                         ball=self.ball[:self.length],
+                         rods=self.rods[:self.length],
+                         actions=self.actions[:self.length],
+                         inputs=self.inputs[:self.length],
+                         rewards=self.rewards[:self.length],
+                         dts=self.dts[:self.length])
+            os.replace(path + ".tmp", path)
+            self.chunks.append(dict(file=name, start=self.ticks - self.length, length=self.length))
+            self.length = 0
+        self.__write_index()
+
+    def close(self):
+        """
+        Writes the remaining ticks and stops recording
+        """
+        self.flush()
+        self.sim.on_tick.remove(self.record)
+        self.sim.on_reset.remove(self.__on_reset)
+
+    def __write_index(self):
+        index = dict(chunk_size=self.chunk_size,
+                     ticks=self.ticks - self.length,
+                     chunks=self.chunks,
+                     episode_starts=self.episode_starts,
+                     episode_ends=self.episode_ends,
+                     actions=None if self.sim.action_rods is None else len(self.sim.action_rods[0]))
+        path = os.path.join(self.directory, "index.json")
+        with open(path + ".tmp", "wt") as fd:
+            json.dump(index, fd)
+        os.replace(path + ".tmp", path)
+
+
+class TrajectoryReader:
+    """
+    Reads the files written by a TrajectoryRecorder
+    """
+
+    COLUMNS = ("ball", "rods", "actions", "inputs", "rewards", "dts")
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json"), "rt") as fd:
+            self.index = json.load(fd)
+        self.ticks = self.index["ticks"]
+        self.chunk_starts = np.array([chunk["start"] for chunk in self.index["chunks"]], dtype=np.int64)
+
+    def __len__(self):
+        return self.ticks
+
+    def read_chunk(self, idx):
+        """
+        :return: a dict with the columns of the idx-th chunk (recordings made before inputs were recorded
+                 have no inputs column)
+        """
+        with np.load(os.path.join(self.directory, self.index["chunks"][idx]["file"])) as arrays:
+            return {name: arrays[name] for name in TrajectoryReader.COLUMNS if name in arrays.files}
+
+    def chunks(self):
+        """
+        :return: an iterator over the columns of all chunks, in order
+        """
+        for idx in range(len(self.index["chunks"])):
+            yield self.read_chunk(idx)
+
+    def read(self, start, stop):
+        """
+        :return: a dict with the columns of the ticks in [start, stop)
+        """
+        stop = min(stop, self.ticks)
+        parts = {name: [] for name in TrajectoryReader.COLUMNS}
+        first = max(int(np.searchsorted(self.chunk_starts, start, side="right")) - 1, 0)
+        for idx in range(first, len(self.chunk_starts)):
+            chunk_start = self.chunk_starts[idx]
+            if chunk_start >= stop:
+                break
+            columns = self.read_chunk(idx)
+            for name, column in columns.items():
+                parts[name].append(column[max(start - chunk_start, 0):stop - chunk_start])
+        return {name: np.concatenate(values) for name, values in parts.items() if values}
+
+    def episodes(self):
+        """
+        :return: a list of (start, stop, end) for each complete episode; end is the side that received the goal,
+                 END_OOB if the ball left the table or END_RESET if the game was reset otherwise
+        """
+        starts = self.index["episode_starts"]
+        return [(start, stop, end)
+                for start, stop, end in zip(starts, starts[1:], self.index["episode_ends"])
+                if stop <= self.ticks]
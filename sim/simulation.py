@@ -10,10 +10,16 @@ class Simulation:
     Has:
         A TableInfo
         A State
+        A random generator, used for the initial ball velocity of each game
     """
 
-    def __init__(self, table_info: table.TableInfo):
+    def __init__(self, table_info: table.TableInfo, rng: np.random.Generator = None):
+        """
+        :param rng: the generator of this simulation; give each simulation its own (seeded) generator
+                    for reproducible runs (default: an unseeded generator)
+        """
         self.table_info = table_info
+        self.rng = rng if rng is not None else np.random.default_rng()
 
         self.state: state.GameState = None
         self.space: pymunk.Space = None
@@ -21,107 +27,163 @@ class Simulation:
         self.ball_body: pymunk.Body = None
         self.goal_bodies: (pymunk.Body, pymunk.Body) = None
         self.side_bodies: [pymunk.Body] = None
-        self.rod_body_idx_cache: {pymunk.Body: int} = None
+
+        # the space is built only once; reset moves the bodies back in place
+        self.space, bodies = self.table_info.get_space(self.rng)
+        self.rod_bodies = bodies["rods"]
+        self.ball_body = bodies["ball"]
+        self.goal_bodies = tuple(bodies["goals"])
+        self.side_bodies = tuple(bodies["excl_sides"])
+
+        # positions and velocities of the rod bodies
+        # rods are kinematic: they move by exactly velocity * dt and collisions do not change their velocity,
+        # so these are kept up to date without reading the bodies back from pymunk after each step
+        self.rod_positions = np.zeros((len(self.rod_bodies), 2))
+        self.rod_velocities = np.zeros((len(self.rod_bodies), 2))
+        self.__rods_initial_position = table_info.get_rods_initial_position()
+
+        # for each side, the absolute index of each of its rods, in that side's order
+        # the player's rods are those with side == rod[0]; side 1's rods are ordered in reverse
+        self.side_rods = ([idx for idx, rod in enumerate(table_info.rods) if rod[0] == 0],
+                          [idx for idx, rod in reversed(list(enumerate(table_info.rods))) if rod[0] == 1])
+        # filled by set_actions
+        self.action_rods: np.ndarray = None
+        self.action_velocities: np.ndarray = None
+        # for each side, the indexes of the actions applied since the last tick (-1 for none)
+        self.applied_actions = np.full((2, max(map(len, self.side_rods))), -1, dtype=np.int64)
+        # for each side and each of its rods (in that side's order), the (offset velocity, angle velocity) input
+        # applied since the last tick (NaN for none), whether it came from an action or from apply_inputs
+        self.applied_inputs = np.full((2, max(map(len, self.side_rods)), 2), np.nan)
+        self.__action_idxs = {}
+
+        # for each side, which rods it owns
+        self.own_rods = np.array([[rod[0] == side for rod in table_info.rods] for side in range(2)], dtype=float)
+        # derived from the state after each tick, see _update_tick_info
+        self.tick_info: state.TickInfo = None
+        self.rewards = np.zeros((2, 2))
+        self._rewards_valid = False
 
         self.on_reset = []
         self.reset()
 
         self.on_goal = []
         self.on_oob = []
+        self.on_tick = []
 
     def reset(self):
         self.state = self.table_info.get_init_state()
 
-        self.space: pymunk.Space
-        self.rod_bodies: [pymunk.Body]
-        self.ball_body: pymunk.Body
-        self.goal_bodies: (pymunk.Body, pymunk.Body)
-
-        self.space, bodies = self.table_info.get_space()
-        self.rod_bodies = bodies["rods"]
-        self.ball_body = bodies["ball"]
-        self.goal_bodies = tuple(bodies["goals"])
-        self.side_bodies = tuple(bodies["excl_sides"])
+        self.table_info.reset_bodies(self.ball_body, self.rod_bodies, self.rng)
+        self.space.reindex_shapes_for_body(self.ball_body)
+        for body in self.rod_bodies:
+            self.space.reindex_shapes_for_body(body)
 
-        self.rod_body_idx_cache = _inverse_list(self.rod_bodies, key=id)
-        self._hook_velocities()
+        # where reset_bodies put the rods, without reading every body back from pymunk
+        self.rod_positions[...] = self.__rods_initial_position
+        self.rod_velocities[...] = 0
+        self._update_tick_info()
 
         self._on_reset()
 
-    # noinspection PyUnusedLocal
-    def _get_rod_velocity(self, body: pymunk.Body, gravity, damping, dt):
-        rod_idx = self.rod_body_idx_cache[id(body)]
-        rod = self.state.rods[rod_idx]
-        offset, offset_vel = rod[0]
-        angle, angle_vel = rod[1]
-        max_offset = self.table_info.rods[rod_idx][4]
-
-        next_foo_x = self.table_info.get_rod_x(rod_idx, angle + angle_vel * dt / 2)
-        vel_x = (next_foo_x - body.position[0]) / dt / 2
-
-        a_offset = self.table_info.get_rod_offset(rod_idx, body.position[1])
-        if a_offset < 0 and offset_vel < 0:
-            offset_vel = 0
-        if a_offset > 1 and offset_vel > 0:
-            offset_vel = 0
-
-        vel_y = offset_vel
-        # vel_y = 0
+    def _set_rod_velocities(self, dt):
+        """
+        Sets the velocity of every rod body for the next step,
+        so that it follows the offset velocity and angle velocity in the state
+        """
+        rods = self.state.rods
+        offset_vels = rods[:, 0, 1]
+        angles = rods[:, 1, 0]
+        angle_vels = rods[:, 1, 1]
 
-        # return vel_x, vel_y
+        next_foo_xs = self.table_info.get_rods_x(angles + angle_vels * dt / 2)
+        vels_x = (next_foo_xs - self.rod_positions[:, 0]) / dt / 2
 
-        body.velocity = (vel_x, vel_y)
+        # do not push rods further out of their range
+        a_offsets = self.table_info.get_rods_offset(self.rod_positions[:, 1])
+        blocked = ((a_offsets < 0) & (offset_vels < 0)) | ((a_offsets > 1) & (offset_vels > 0))
+        vels_y = np.where(blocked, 0, offset_vels)
 
-    def _hook_velocities(self):
-        for rod in self.rod_bodies:
-            rod.velocity_func = self._get_rod_velocity
+        self.rod_velocities[:, 0] = vels_x
+        self.rod_velocities[:, 1] = vels_y
+        for body, vel_x, vel_y in zip(self.rod_bodies, vels_x.tolist(), vels_y.tolist()):
+            body.velocity = (vel_x, vel_y)
 
     def _fetch_state(self):
         ball_offset = self.ball_body.position
         ball_velocity = self.ball_body.velocity
         self.state.ball = (complex(ball_offset[0], ball_offset[1]),
                            complex(ball_velocity[0], ball_velocity[1]))
-        for idx, body in enumerate(self.rod_bodies):
-            rod_offset = self.table_info.get_rod_offset(idx, body.position[1])
-            rod_angle = self.table_info.get_rod_angle(idx, body.position[0])
-            rod_last_angle = self.table_info.get_rod_angle(idx, body.position[0] - body.velocity[0])
-            self.state.rods[idx] = ((rod_offset, body.velocity[1]),
-                                    (rod_angle, rod_angle - rod_last_angle))
+
+        rod_angles = self.table_info.get_rods_angle(self.rod_positions[:, 0])
+        rod_last_angles = self.table_info.get_rods_angle(self.rod_positions[:, 0] - self.rod_velocities[:, 0])
+        rods = self.state.rods
+        rods[:, 0, 0] = self.table_info.get_rods_offset(self.rod_positions[:, 1])
+        rods[:, 0, 1] = self.rod_velocities[:, 1]
+        rods[:, 1, 0] = rod_angles
+        rods[:, 1, 1] = rod_angles - rod_last_angles
 
     def apply_inputs(self, side, input):
         self.state.apply_inputs(self._input_to_absolute(side, input))
+        rod_idx, offset_vel, angle_vel = input
+        self.applied_inputs[side, int(rod_idx)] = (offset_vel, angle_vel)
+        # an input that is also an action (e.g. from AI.get_action) is recorded as one
+        action_idx = self.__action_idxs.get((int(rod_idx), float(offset_vel), float(angle_vel)))
+        free = np.flatnonzero(self.applied_actions[side] < 0)
+        if action_idx is not None and len(free) > 0:
+            self.applied_actions[side, free[0]] = action_idx
 
     def _input_to_absolute(self, side, input):
         rod_idx, offset_vel, angle_vel = input
 
         # Side 1's rods are ordered in reverse
-        if side == 0:
-            ordered = self.table_info.rods
-            idxs = range(len(ordered))
-        else:
-            ordered = reversed(self.table_info.rods)
-            idxs = range(len(self.table_info.rods) - 1, -1, -1)
+        if side == 1:
             offset_vel = -offset_vel
             angle_vel = -angle_vel
 
         # Find the rod_idx-th rod in the player's order
-        # The player's rods are those with side == rod[0]
-        idx_left = rod_idx
-        for abs_idx, rod in zip(idxs, ordered):
-            if side == rod[0]:
-                if idx_left == 0:
-                    return abs_idx, offset_vel, angle_vel
-                idx_left -= 1
+        side_rods = self.side_rods[side]
+        if not 0 <= rod_idx < len(side_rods):
+            raise ValueError("rod_idx {} too large".format(rod_idx))
+        return side_rods[int(rod_idx)], offset_vel, angle_vel
 
-        raise ValueError("rod_idx {} too large".format(rod_idx))
+    def set_actions(self, actions):
+        """
+        Precomputes the absolute input of every action, for apply_action_indices
+        :param actions: a matrix with an action (rod_idx, offset_vel, angle_vel) on each row, like AI.actions
+        """
+        absolute = np.array([[self._input_to_absolute(side, action) for action in actions]
+                             for side in range(2)])
+        self.action_rods = absolute[:, :, 0].astype(int)
+        self.action_velocities = absolute[:, :, 1:]
+        # the inputs of the actions, as given to apply_inputs
+        self.action_side_rods = np.array(actions)[:, 0].astype(int)
+        self.action_inputs = np.array(actions, dtype=float)[:, 1:]
+        self.__action_idxs = {(int(rod_idx), float(offset_vel), float(angle_vel)): idx
+                              for idx, (rod_idx, offset_vel, angle_vel) in enumerate(actions)}
+
+    def apply_action_indices(self, side, actions_idxs):
+        """
+        Same as apply_inputs for all the actions of a player at once
+        :param actions_idxs: indexes in the actions given to set_actions
+        """
+        rods = self.action_rods[side, actions_idxs]
+        self.state.rods[rods, :, 1] = self.action_velocities[side, actions_idxs]
+        self.applied_actions[side, :len(rods)] = actions_idxs
+        self.applied_inputs[side, self.action_side_rods[actions_idxs]] = self.action_inputs[actions_idxs]
 
     def tick(self, time):
         # _assert_no_nans(self.space)
 
+        self._set_rod_velocities(time)
         self.space.step(time)
+        self.rod_positions += self.rod_velocities * time
         self._fetch_state()
+        self._update_tick_info()
         self._check_on_goal()
         self._check_oob()
+        self._on_tick(time)
+        self.applied_actions[...] = -1
+        self.applied_inputs[...] = np.nan
 
         # _assert_no_nans(self.space)
 
@@ -133,66 +195,86 @@ class Simulation:
                         1 for player with the goal at x = MAX_X coordinate)
         :return: a score for current state for player player
         """
-        # check for goal for player
-        goal = self.table_info.get_goal(self.state.ball[0])
+        reward, penalty = self.get_rewards()[player]
+        return float(reward), float(penalty)
+
+    def get_rewards(self):
+        """
+        Computes get_current_reward for both players, at most once per tick
+        :return: an array (2, 2) with (reward, penalty) for each player;
+                 it is overwritten after the next tick or reset
+        """
+        if self._rewards_valid:
+            return self.rewards
+        self._rewards_valid = True
 
-        if goal == (1 - player):
-            print("goal for current player (side {})".format(player))
-            return 1000, 0
-        # check for goal for opponent
-        if goal == player:
-            print("goal against current player (side {})".format(player))
-            return -1000, 0
+        info = self.tick_info
+        rewards = self.rewards
 
-        ball_direction = np.sign(self.state.ball[1].real) * ((-1) ** player)
+        # check for goal
+        if info.goal_side is not None:
+            rewards[1 - info.goal_side] = (1000, 0)
+            rewards[info.goal_side] = (-1000, 0)
+            return rewards
 
         penalty = 0
-        if abs(self.state.ball[1]) < 0.0001:
+        if info.ball_speed < 0.0001:
             penalty -= 10
-        elif abs(self.state.ball[1]) < 0.1:
-            penalty -= min(0.1 / abs(self.state.ball[1]), 10)  # penalty for inert state of the ball
+        elif info.ball_speed < 0.1:
+            penalty -= min(0.1 / info.ball_speed, 10)  # penalty for inert state of the ball
         # punish OOB
-        if not self.table_info.get_inbounds(self.state.ball[0]):
+        if not info.inbounds:
             penalty -= 2000
 
-        for t_rod, rod in zip(self.table_info.rods, self.state.rods):
-            # Check if it's our own rod
-            if t_rod[0] != player:
-                continue
-
-            if rod[0][0] < 0.01 or rod[0][0] > 0.99:
-                penalty -= 5
-            if rod[1][0] < -0.99 or rod[1][0] > 0.99:
-                penalty -= 5
+        # punish own rods at the edge of their range
+        offsets = self.state.rods[:, 0, 0]
+        angles = self.state.rods[:, 1, 0]
+        rods_at_edge = ((offsets < 0.01) | (offsets > 0.99)).astype(float) + \
+            ((angles < -0.99) | (angles > 0.99))
+        rod_penalties = self.own_rods @ rods_at_edge * -5
 
         # return a score that is a sum of:
         #   how far is the ball from goal of player
         #   50% of above number (negative weighted if player doesn't have possession, positive otherwise )
-        player_starting_point = self.table_info.length * player
-        dist_from_goal = abs(player_starting_point - self.state.ball[0].real)
-        dist_to_goal = self.table_info.length - dist_from_goal
-
-        if ball_direction == 0:
-            return -5, penalty - 5
-
+        ball_x = self.state.ball[0].real
         good_multiplier = 8
         bad_multiplier = 3
+        for player in range(2):
+            player_penalty = penalty + rod_penalties[player]
+            ball_direction = info.ball_direction * ((-1) ** player)
+            if ball_direction == 0:
+                rewards[player] = (-5, player_penalty - 5)
+                continue
+
+            player_starting_point = self.table_info.length * player
+            dist_from_goal = abs(player_starting_point - ball_x)
+            dist_to_goal = self.table_info.length - dist_from_goal
 
-        if dist_to_goal < dist_from_goal:
-            score_multiplier = good_multiplier
-        else:
-            score_multiplier = bad_multiplier
-        if ball_direction == 1:
-            return min(dist_from_goal / dist_to_goal * score_multiplier, 50), penalty
-        else:
-            # return negative the other player's score
-            return -min(dist_to_goal / dist_from_goal * good_multiplier, 50), penalty
+            if dist_to_goal < dist_from_goal:
+                score_multiplier = good_multiplier
+            else:
+                score_multiplier = bad_multiplier
+            if ball_direction == 1:
+                rewards[player] = (min(dist_from_goal / dist_to_goal * score_multiplier, 50), player_penalty)
+            else:
+                # return negative the other player's score
+                rewards[player] = (-min(dist_to_goal / dist_from_goal * good_multiplier, 50), player_penalty)
+
+        return rewards
 
     def get_rod_owners(self):
         return [r[0] for r in self.table_info.rods]
 
+    def _update_tick_info(self):
+        position, velocity = self.state.ball
+        self.tick_info = state.TickInfo(self.table_info.get_goal(position),
+                                        self.table_info.get_inbounds(position),
+                                        abs(velocity),
+                                        float(np.sign(velocity.real)))
+        self._rewards_valid = False
+
     def _check_on_goal(self):
-        goal_side = self.table_info.get_goal(self.state.ball[0])
+        goal_side = self.tick_info.goal_side
         if goal_side is not None:
             self._on_goal(goal_side)
 
@@ -201,26 +283,22 @@ class Simulation:
             handler(side)
 
     def _check_oob(self):
-        if not self.table_info.get_inbounds(self.state.ball[0]):
+        if not self.tick_info.inbounds:
             self._on_oob()
 
     def _on_oob(self):
         for handler in self.on_oob:
             handler()
 
+    def _on_tick(self, time):
+        for handler in self.on_tick:
+            handler(time)
+
     def _on_reset(self):
         for handler in self.on_reset:
             handler()
 
 
-def _inverse_list(items, key):
-    results = {}
-    for idx, item in enumerate(items):
-        results[key(item)] = idx
-
-    return results
-
-
 def _assert_no_nans(space: pymunk.Space):
     def any_nan(t):
         return any(math.isnan(x) for x in t)
@@ -1,9 +1,12 @@
+import numpy
+
+
 class GameState:
     """
     Has:
         A score (tuple of 2 ints)
         The coordinates of the ball (complex, in [0, 1] ) and its velocities
-        A list of rods, each with:
+        An array of rods (shape (rods, 2, 2)), each with:
             An offset in [0, 1], the sideways coord
             An offset velocity in units/sec
             An angle in [-1, 1] where -1 is -90deg and 1 is 90deg
@@ -17,22 +20,37 @@ class GameState:
         Args:
             score (int, int): The score of the match
             ball ([complex, complex]): The position of the ball (in [0,1]) and its velocity (in units/sec)
-            rods (list of ((double, double), (double, double))): for each rod left to right (home to away),
+            rods (numpy array of shape (rods, 2, 2)): for each rod left to right (home to away),
                 (its offset in [0,1] and its velocity)
                 and
                 (its angle in [-1,1]) and its velocity)
         """
         self.score : (int, int) = score
         self.ball : (complex, complex) = ball
-        self.rods : [((float, float), (float, float))] = rods
+        self.rods : numpy.ndarray = rods
 
     def clone(self):
-        return GameState(self.score, self.ball, self.rods[:])
+        return GameState(self.score, self.ball, self.rods.copy())
 
     def apply_inputs(self, input):
         rod_idx, i_off_vel, i_ang_vel = input
-        (curr_offset, offset_vel), (curr_angle, angle_vel) = self.rods[rod_idx]
-        offset_vel = i_off_vel
-        angle_vel = i_ang_vel
+        self.rods[rod_idx, 0, 1] = i_off_vel
+        self.rods[rod_idx, 1, 1] = i_ang_vel
+
+
+class TickInfo:
+    """
+    Has the values derived from a GameState that are needed more than once per tick:
+        The side of the goal the ball is in (None if it is not in a goal)
+        Whether the ball is in bounds
+        The speed of the ball
+        The direction of the ball on the X axis (-1, 0 or 1)
+    """
+
+    __slots__ = ("goal_side", "inbounds", "ball_speed", "ball_direction")
 
-        self.rods[rod_idx] = ((curr_offset, offset_vel), (curr_angle, angle_vel))
+    def __init__(self, goal_side, inbounds, ball_speed, ball_direction):
+        self.goal_side : int = goal_side
+        self.inbounds : bool = inbounds
+        self.ball_speed : float = ball_speed
+        self.ball_direction : float = ball_direction
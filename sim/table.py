@@ -1,7 +1,7 @@
 from . import state
 import pymunk
+import numpy as np
 import math
-import random
 
 
 class TableInfo:
@@ -32,6 +32,9 @@ class TableInfo:
             ))
         foo_x, foo_y, foo_h = foosman_size
         self.foosman_size = (float(foo_x), float(foo_y), float(foo_h))
+        # the same rod attributes as arrays, for computing all rods at once
+        self.rod_xs = np.array([rod[1] for rod in self.rods], dtype=float)
+        self.rod_max_offsets = np.array([rod[4] for rod in self.rods], dtype=float)
         self.goal_width = goal_width
         self.ball_radius = ball_radius
 
@@ -61,10 +64,10 @@ class TableInfo:
         return state.GameState(
             (0, 0),
             (complex(0.5, 0.5), complex(0, 0)),
-            [((0.5, 0.0), (0.0, 0.0)) for _ in self.rods]
+            np.array([((0.5, 0.0), (0.0, 0.0)) for _ in self.rods])
         )
 
-    def get_space(self):
+    def get_space(self, rng: np.random.Generator = None):
         """
         Returns a pymunk Space with the ball and rods etc.
         and a dict of bodies in the form:
@@ -81,10 +84,8 @@ class TableInfo:
                 goal_1_body
             ]
         }
+        :param rng: the generator of the initial ball velocity, see reset_bodies
         """
-        def small_rand(maximum):
-            return random.random() * 2 * maximum - maximum
-
         space = pymunk.Space()
         space.gravity = (0, 0)
 
@@ -92,8 +93,6 @@ class TableInfo:
         ball_shape = pymunk.Circle(ball_body, self.ball_radius)
         ball_shape.density = 1.0
         ball_shape.elasticity = 0.8
-        ball_body.position = (self.length / 2 + small_rand(0.05), 0.5 + small_rand(0.05))
-        ball_body.velocity = (small_rand(0.05), small_rand(0.05))
 
         space.add(ball_body, ball_shape)
 
@@ -116,7 +115,6 @@ class TableInfo:
 
         for owner, x, foo_count, foo_dist, max_offset in self.rods:
             rod_body = pymunk.Body(0, 0, pymunk.Body.KINEMATIC)
-            rod_body.position = (x, 0.5)
             space.add(rod_body)
 
             rod_bodies.append(rod_body)
@@ -200,6 +198,8 @@ class TableInfo:
             for shape in body.shapes: #type: pymunk.Shape
                 shape.friction = 0
 
+        self.reset_bodies(ball_body, rod_bodies, rng)
+
         return space, {
             "ball": ball_body,
             "rods": rod_bodies,
@@ -207,6 +207,31 @@ class TableInfo:
             "excl_sides": excl_side_bodies
         }
 
+    def reset_bodies(self, ball_body: pymunk.Body, rod_bodies: [pymunk.Body], rng: np.random.Generator = None):
+        """
+        Puts the bodies returned by get_space back in their initial position:
+        the ball near the center with a small random velocity and the rods straight and centered
+        :param rng: the generator of the ball position and velocity (default: an unseeded module-wide generator)
+        """
+        if rng is None:
+            rng = _default_rng
+        dx, dy, vx, vy = rng.uniform(-0.05, 0.05, 4).tolist()
+        ball_body.position = (self.length / 2 + dx, 0.5 + dy)
+        ball_body.velocity = (vx, vy)
+        ball_body.angle = 0
+        ball_body.angular_velocity = 0
+
+        # rods are kinematic and their angular velocity is never set, so their angle is always 0
+        for rod_body, (x, y) in zip(rod_bodies, self.get_rods_initial_position().tolist()):
+            rod_body.position = (x, y)
+            rod_body.velocity = (0, 0)
+
+    def get_rods_initial_position(self):
+        """
+        :return: a matrix with the (x, y) position of each rod body after reset_bodies, one rod on each row
+        """
+        return np.array([(rod[1], 0.5) for rod in self.rods])
+
     def get_rod_x(self, rod_idx, angle):
         start_x = self.rods[rod_idx][1]
         foo_h = self.foosman_size[1]
@@ -231,6 +256,29 @@ class TableInfo:
         return unclamped
         # return max(min(unclamped, 1), 0)
 
+    def get_rods_x(self, angles):
+        """
+        Same as get_rod_x, for all rods at once
+        :param angles: vector with the angle of each rod
+        """
+        return self.rod_xs - np.sin(angles * (math.pi / 2)) * self.foosman_size[1]
+
+    def get_rods_angle(self, rods_x):
+        """
+        Same as get_rod_angle, for all rods at once
+        :param rods_x: vector with the x coordinate of each rod
+        """
+        asin_arg = (self.rod_xs - rods_x) / self.foosman_size[1]
+
+        return np.arcsin(np.clip(asin_arg, -1, 1)) / (math.pi / 2)
+
+    def get_rods_offset(self, rods_y):
+        """
+        Same as get_rod_offset, for all rods at once
+        :param rods_y: vector with the y coordinate of each rod
+        """
+        return (rods_y - 0.5 + self.rod_max_offsets / 2) / self.rod_max_offsets
+
     def get_goal(self, position):
         x, y = position.real, position.imag
         if abs(y - 0.5) > self.goal_width / 2:
@@ -243,4 +291,7 @@ class TableInfo:
 
     def get_inbounds(self, position, threshold=0.1):
         x, y = position.real, position.imag
-        return -threshold <= x <= self.length + threshold and -threshold <= y <= 1 + threshold
\ No newline at end of file
+        return -threshold <= x <= self.length + threshold and -threshold <= y <= 1 + threshold
+
+
+_default_rng = np.random.default_rng()
@@ -0,0 +1,119 @@
+from . import simulation
+from . import table
+import numpy as np
+
+
+class VecSimulation:
+    """
+    Has:
+        N independent Simulations of the same table
+        A state template for each of them
+    Steps all the tables with one batch of actions and resets finished tables automatically,
+    so the policy can be evaluated once for the whole batch.
+    """
+
+    def __init__(self, table_info: table.TableInfo, count: int, state_template_type, dt=1 / 60,
+                 rng: np.random.Generator = None):
+        """
+        :param table_info: the table used by all simulations
+        :param count: number of tables (N)
+        :param state_template_type: builds a state template from a Simulation,
+                                    e.g. ai.state_template.StateTemplate; must have encode and state_size,
+                                    and its reset, if any, is called whenever its table is reset
+        :param dt: simulation time of one step, in seconds
+        :param rng: spawns an independent generator for each table (default: an unseeded generator)
+        """
+        assert count > 0, "VecSimulation must contain at least one table"
+        self.table_info = table_info
+        self.dt = dt
+        if rng is None:
+            rng = np.random.default_rng()
+        self.sims = [simulation.Simulation(table_info, sim_rng) for sim_rng in rng.spawn(count)]
+        self.state_templates = [state_template_type(sim) for sim in self.sims]
+        for sim, state_template in zip(self.sims, self.state_templates):
+            # templates that follow the foosmen between ticks (StateTemplatev2) start again with each game
+            if hasattr(state_template, "reset"):
+                sim.on_reset.append(state_template.reset)
+
+        self.state_size = self.state_templates[0].state_size
+        self.observations = np.zeros((count, 2, self.state_size), dtype=np.float32)
+        # observations of the tables that finished in the last step, before their reset
+        self.terminal_observations = np.zeros((count, 2, self.state_size), dtype=np.float32)
+        self.rewards = np.zeros((count, 2))
+        self.dones = np.zeros(count, dtype=bool)
+        self.last_rewards = np.zeros((count, 2))
+
+    def __len__(self):
+        return len(self.sims)
+
+    def reset(self):
+        """
+        Resets all tables
+        :return: observations of shape (N, 2, state_size), one row for each side
+        """
+        for idx, sim in enumerate(self.sims):
+            sim.reset()
+            self.last_rewards[idx] = 0
+            self._observe(idx)
+        return self.observations.copy()
+
+    def step(self, actions):
+        """
+        :param actions: shape (N, 2, k, 3): for each table and side, k inputs (rod_idx, offset_vel, angle_vel)
+                        in that side's own rod order, as returned by AI.get_action
+        :return: a tuple of:
+                    observations of shape (N, 2, state_size)
+                    rewards of shape (N, 2), computed like in main (reward change plus penalty)
+                    done flags of shape (N,), set when a goal was scored or the ball left the table
+                 Finished tables are reset before returning, so their observations are those of the new game;
+                 the last observations before the reset are in self.terminal_observations.
+        """
+        assert len(actions) == len(self.sims), "must have actions for each table"
+
+        for sim, sim_actions in zip(self.sims, actions):
+            for side, side_actions in enumerate(sim_actions):
+                for input in side_actions:
+                    sim.apply_inputs(side, input)
+        return self._tick_all()
+
+    def set_actions(self, actions):
+        """
+        :param actions: the actions used by step_action_indices, as AI.actions
+        """
+        for sim in self.sims:
+            sim.set_actions(actions)
+
+    def step_action_indices(self, actions_idxs):
+        """
+        Same as step, with actions given as indexes in the actions passed to set_actions
+        :param actions_idxs: shape (N, 2, k): for each table and side, the indexes of k actions
+        """
+        assert len(actions_idxs) == len(self.sims), "must have actions for each table"
+
+        for sim, sim_actions_idxs in zip(self.sims, actions_idxs):
+            sim.apply_action_indices(0, sim_actions_idxs[0])
+            sim.apply_action_indices(1, sim_actions_idxs[1])
+        return self._tick_all()
+
+    def _tick_all(self):
+        for idx, sim in enumerate(self.sims):
+            sim.tick(self.dt)
+
+            rewards = sim.get_rewards()
+            self.rewards[idx] = rewards[:, 0] - self.last_rewards[idx] + rewards[:, 1]
+            self.last_rewards[idx] = rewards[:, 0]
+
+            self._observe(idx)
+
+            done = sim.tick_info.goal_side is not None or not sim.tick_info.inbounds
+            self.dones[idx] = done
+            if done:
+                self.terminal_observations[idx] = self.observations[idx]
+                sim.reset()
+                self.last_rewards[idx] = 0
+                self._observe(idx)
+
+        return self.observations.copy(), self.rewards.copy(), self.dones.copy()
+
+    def _observe(self, idx):
+        self.state_templates[idx].encode(self.sims[idx], self.observations[idx])
@@ -0,0 +1,22 @@
+from sim import table
+import main
+import numpy as np
+import itertools
+import pytest
+import json
+import os
+
+
+@pytest.fixture(scope="session")
+def table_info():
+    return table.TableInfo.from_dict(main._get_table_info())
+
+
+@pytest.fixture(scope="session")
+def actions():
+    """
+    :return: the actions of the config, as built by AI
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(main.__file__)), "config"), "rt") as fd:
+        conf = json.load(fd)
+    return np.array(list(itertools.product(np.arange(conf["rods_number"]), conf["offset"], conf["angle_velocity"])))
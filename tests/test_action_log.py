@@ -0,0 +1,33 @@
+from ai.action_log import ActionLog
+import numpy as np
+
+
+def test_slots_alternate_between_players_and_keep_the_newest_entries():
+    log = ActionLog(4, 1, 2, 1)
+    for i in range(6):
+        log.append(np.full(1, i), np.zeros(2), [i])
+    assert len(log) == 4
+    assert log.states[log.order(), 0].tolist() == [2, 3, 4, 5]
+    assert log.actions_idxs[log.order(), 0].tolist() == [2, 3, 4, 5]
+    # entry i belongs to player i % 2 and so does its slot
+    assert np.array_equal(log.order() % 2, log.states[log.order(), 0] % 2)
+
+
+def test_rewards_since_an_action_only_count_its_player():
+    log = ActionLog(6, 1, 2, 1)
+    log.append(np.zeros(1), np.zeros(2), [0])
+    log.append(np.zeros(1), np.zeros(2), [0])
+    log.add_rewards(np.array([1.0, -1.0]))
+    log.append(np.zeros(1), np.zeros(2), [0])
+    log.add_rewards(np.array([10.0, 5.0]))
+    assert log.rewards_since(log.order()).tolist() == [11, 4, 10]
+
+
+def test_clear_forgets_entries_and_rewards():
+    log = ActionLog(2, 1, 2, 1)
+    log.append(np.zeros(1), np.zeros(2), [0])
+    log.add_rewards(np.array([1.0, 2.0]))
+    log.clear()
+    assert len(log) == 0 and len(log.order()) == 0
+    log.append(np.zeros(1), np.zeros(2), [0])
+    assert log.rewards_since(log.order()).tolist() == [0]
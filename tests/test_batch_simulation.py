@@ -0,0 +1,41 @@
+from sim import batch_simulation
+from sim import simulation
+from ai import state_template
+import numpy as np
+
+
+def test_rods_follow_pymunk_and_most_games_end_the_same_way(table_info, actions):
+    results = [batch_simulation.check_divergence(table_info, actions, rng=np.random.default_rng(seed))
+               for seed in range(10)]
+    assert max(result["max_rod_error"] for result in results) < 1e-9
+    # the contacts are not solved in the order of pymunk, so a ball can leave the tolerance after a few bounces,
+    # but never during the first seconds of a game
+    diverged = [result["diverged_tick"] for result in results if result["diverged_tick"] is not None]
+    assert len(diverged) <= 5
+    assert min(diverged, default=np.inf) >= 150
+    assert sum(result["same_end"] for result in results) >= 8
+
+
+def test_reset_only_resets_the_given_tables(table_info, actions):
+    batch = batch_simulation.BatchSimulation(table_info, 4, np.random.default_rng(0))
+    batch.set_actions(actions)
+    for _ in range(30):
+        for side in range(2):
+            batch.apply_action_indices(side, np.zeros((4, 1), dtype=int))
+        batch.tick(1 / 60)
+    balls = batch.balls.copy()
+    batch.reset(np.array([False, True, False, True]))
+    assert np.array_equal(batch.balls[[0, 2]], balls[[0, 2]])
+    assert np.array_equal(batch.balls[[1, 3]], np.tile((0.5, 0.5, 0, 0), (2, 1)))
+
+
+def test_table_view_encodes_like_a_simulation(table_info):
+    sim = simulation.Simulation(table_info, np.random.default_rng(0))
+    batch = batch_simulation.BatchSimulation(table_info, 2, np.random.default_rng(0))
+    for template_type in (state_template.StateTemplate, state_template.StateTemplatev2):
+        template = template_type(sim)
+        expected = np.zeros((2, template.state_size), dtype=np.float32)
+        encoded = np.zeros((2, template.state_size), dtype=np.float32)
+        template.encode(sim, expected)
+        template_type(sim).encode(batch.table(1), encoded)
+        assert np.array_equal(encoded, expected)
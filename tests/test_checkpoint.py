@@ -0,0 +1,50 @@
+from ai import checkpoint
+import numpy as np
+import os
+import time
+
+
+def _weights(seed):
+    rng = np.random.default_rng(seed)
+    return [rng.normal(size=(3, 4)).astype(np.float32), rng.normal(size=4).astype(np.float32)]
+
+
+def test_write_read_round_trip(tmp_path):
+    path = os.path.join(str(tmp_path), "checkpoint")
+    weights = _weights(0)
+    metadata = dict(step=12, epsilon=0.25, actions=[[0, 1.0, 0.0]])
+    checkpoint.write_checkpoint(path, weights, metadata)
+
+    read_weights, read_metadata = checkpoint.read_checkpoint(path)
+    assert read_metadata == metadata
+    assert len(read_weights) == len(weights)
+    for read, written in zip(read_weights, weights):
+        assert read.dtype == written.dtype and np.array_equal(read, written)
+    assert not any(name.endswith(".tmp") for name in os.listdir(str(tmp_path)))
+
+
+def test_latest_is_the_last_written_and_old_ones_are_removed(tmp_path):
+    directory = str(tmp_path)
+    checkpointer = checkpoint.Checkpointer(directory, keep=2)
+    # a run resumed from an older checkpoint writes smaller steps than the ones already there
+    for count, step in enumerate((30, 10, 20), 1):
+        checkpointer.save(step, _weights(step), dict(step=step))
+        # one at a time, so that none is skipped and their modification times differ
+        while checkpointer.written < count:
+            time.sleep(0.01)
+        time.sleep(0.01)
+    checkpointer.close()
+
+    assert [os.path.basename(path) for path in checkpoint.list_checkpoints(directory)] == \
+        ["checkpoint-000000000010", "checkpoint-000000000020"]
+    weights, metadata = checkpoint.read_checkpoint(directory)
+    assert metadata == dict(step=20)
+    assert all(np.array_equal(read, written) for read, written in zip(weights, _weights(20)))
+
+
+def test_incomplete_checkpoints_are_ignored(tmp_path):
+    directory = str(tmp_path)
+    checkpoint.write_checkpoint(os.path.join(directory, "checkpoint-000000000001"), _weights(1), dict(step=1))
+    # weights written but not the metadata yet
+    np.savez(os.path.join(directory, "checkpoint-000000000002.npz"), w0=np.zeros(1))
+    assert checkpoint.latest_checkpoint(directory) == os.path.join(directory, "checkpoint-000000000001")
@@ -0,0 +1,38 @@
+from ai.NN import NN
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def states():
+    return np.random.default_rng(0).standard_normal((16, 5)).astype(np.float32)
+
+
+@pytest.mark.parametrize("activation", ["sigmoid", "linear", "relu", "tanh"])
+def test_mirror_predicts_like_keras(activation, states):
+    network = NN(input_dim=5, layers=[(7, activation), (3, "linear")])
+    assert network.check_mirror(states) <= NN.MIRROR_TOLERANCE
+    assert np.allclose(network.predict_actions(states), network.model.predict_on_batch(states),
+                       atol=NN.MIRROR_TOLERANCE)
+    assert np.allclose(network.predict_action(states[0]), network.predict_actions(states)[0])
+
+
+def test_verify_mirror_raises_on_a_wrong_mirror(states):
+    network = NN(input_dim=5, hidden_layers=[7], output_dim=3)
+    network.verify_mirror(states)
+    weights, bias, activation = network.mirror[0]
+    network.mirror[0] = (weights + 1, bias, activation)
+    with pytest.raises(RuntimeError):
+        network.verify_mirror(states)
+    # the mirror follows the weights again once refreshed
+    network.refresh_mirror()
+    network.verify_mirror(states)
+
+
+def test_set_weights_refreshes_the_mirror_and_the_version(states):
+    network = NN(input_dim=5, hidden_layers=[7], output_dim=3)
+    other = NN(input_dim=5, hidden_layers=[7], output_dim=3)
+    version = network.predictions_version
+    network.set_weights(other.get_weights())
+    assert network.predictions_version != version
+    assert np.allclose(network.predict_actions(states), other.predict_actions(states), atol=NN.MIRROR_TOLERANCE)
@@ -0,0 +1,39 @@
+from ai import offline
+from ai.state_template import StateTemplate, StateTemplatev2
+from sim import recorder
+from sim import simulation
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("template_type", [StateTemplate, StateTemplatev2])
+def test_recorded_states_are_encoded_like_live_ones(tmp_path, table_info, actions, template_type):
+    sim = simulation.Simulation(table_info, np.random.default_rng(0))
+    sim.set_actions(actions)
+    template = template_type(sim)
+    # reset with the simulation, as during online training
+    if hasattr(template, "reset"):
+        sim.on_reset.append(template.reset)
+    trajectory = recorder.TrajectoryRecorder(sim, str(tmp_path), chunk_size=16)
+    rng = np.random.default_rng(1)
+    live = []
+    for tick in range(60):
+        if tick in (20, 45):
+            sim.reset()
+        for side in range(2):
+            sim.apply_action_indices(side, rng.integers(0, len(actions), 1))
+        sim.tick(1 / 60)
+        live.append(np.zeros((2, template.state_size), dtype=np.float32))
+        template.encode(sim, live[-1])
+    trajectory.close()
+    live = np.array(live)
+
+    reader = recorder.TrajectoryReader(str(tmp_path))
+    transitions = list(offline.read_transitions(reader, template_type(sim)))
+    # player after player in each chunk
+    next_states = [np.concatenate([columns[3] for columns in transitions[player::2]]) for player in range(2)]
+    # every tick has actions, but the first tick of each episode has no state before it
+    valid = np.ones(60, dtype=bool)
+    valid[[0, 20, 45]] = False
+    for player in range(2):
+        assert np.allclose(next_states[player], live[valid, player])
@@ -0,0 +1,64 @@
+from sim import recorder
+from sim import simulation
+import numpy as np
+
+
+def _play(sim, actions, ticks, reset_at):
+    """
+    Plays random actions for ticks ticks, with an input that is not an action on every third tick,
+    resetting the game at reset_at
+    :return: the columns expected in the recording
+    """
+    expected = {name: [] for name in recorder.TrajectoryReader.COLUMNS}
+
+    def on_tick(time):
+        position, velocity = sim.state.ball
+        expected["ball"].append((position.real, position.imag, velocity.real, velocity.imag))
+        expected["rods"].append(sim.state.rods.reshape(-1, 4).copy())
+        expected["actions"].append(sim.applied_actions.copy())
+        expected["inputs"].append(sim.applied_inputs.copy())
+        expected["rewards"].append(sim.get_rewards().copy())
+        expected["dts"].append(time)
+
+    sim.on_tick.append(on_tick)
+    rng = np.random.default_rng(1)
+    for tick in range(ticks):
+        if tick == reset_at:
+            sim.reset()
+        for side in range(2):
+            if tick % 3 == 0:
+                sim.apply_inputs(side, (1, 0.123, 0.0))
+            else:
+                sim.apply_action_indices(side, rng.integers(0, len(actions), 1))
+        sim.tick(1 / 60)
+    sim.on_tick.remove(on_tick)
+    return {name: np.array(values, dtype=np.float32) for name, values in expected.items()}
+
+
+def test_recorder_reader_round_trip(tmp_path, table_info, actions):
+    directory = str(tmp_path)
+    sim = simulation.Simulation(table_info, np.random.default_rng(0))
+    sim.set_actions(actions)
+    trajectory = recorder.TrajectoryRecorder(sim, directory, chunk_size=7)
+    expected = _play(sim, actions, 30, reset_at=12)
+    trajectory.close()
+
+    reader = recorder.TrajectoryReader(directory)
+    assert len(reader) == 30
+    assert len(reader.index["chunks"]) == 5
+    columns = reader.read(0, 30)
+    assert set(columns) == set(recorder.TrajectoryReader.COLUMNS)
+    for name, column in columns.items():
+        assert column.shape == expected[name].shape, name
+        assert np.array_equal(column, expected[name], equal_nan=True), name
+
+    # an input that is not an action is only in the inputs
+    assert (columns["actions"][0] == -1).all()
+    assert np.isclose(columns["inputs"][0, :, 1, 0], 0.123).all()
+    assert not (columns["actions"][1] == -1).all()
+
+    # a range across chunks
+    part = reader.read(5, 17)
+    for name, column in part.items():
+        assert np.array_equal(column, expected[name][5:17], equal_nan=True), name
+    assert reader.episodes() == [(0, 12, recorder.END_RESET)]
@@ -0,0 +1,104 @@
+from ai.replay_memory import SumTree, ReplayMemory
+import numpy as np
+
+
+def test_sum_tree_samples_proportionally_to_priorities():
+    priorities = np.array([1.0, 2.0, 0.0, 5.0, 2.0])
+    tree = SumTree(len(priorities))
+    tree.update(np.arange(len(priorities)), priorities)
+    assert tree.total == priorities.sum()
+
+    rng = np.random.default_rng(0)
+    found = tree.find(rng.random(100000) * tree.total)
+    frequencies = np.bincount(found, minlength=tree.leaves) / len(found)
+    assert np.allclose(frequencies[:len(priorities)], priorities / priorities.sum(), atol=0.01)
+    assert frequencies[len(priorities):].sum() == 0
+
+
+def test_sum_tree_update_keeps_sums():
+    tree = SumTree(6)
+    tree.update(np.arange(6), np.ones(6))
+    tree.update(np.array([1, 4]), np.array([3.0, 0.5]))
+    assert tree.total == 4 + 3 + 0.5
+    assert tree.find(np.array([0.5, 1.5, 3.9, 4.5, 5.9, 6.2, 7.4])).tolist() == [0, 1, 1, 2, 3, 4, 5]
+
+
+def test_ring_buffer_overwrites_the_oldest_memories():
+    memory = ReplayMemory(3, 2, 1)
+    for i in range(5):
+        memory.append(np.full(2, i), np.full(1, -i))
+    assert len(memory) == 3
+    assert sorted(memory.states[:, 0].tolist()) == [2, 3, 4]
+    assert np.array_equal(memory.targets[:, 0], -memory.states[:, 0])
+
+
+def test_uniform_sampling_is_without_replacement():
+    memory = ReplayMemory(10, 1, 1, rng=np.random.default_rng(0))
+    for i in range(8):
+        memory.append(np.full(1, i), np.zeros(1))
+    idxs, states, _ = memory.sample(8)
+    assert sorted(idxs.tolist()) == list(range(8))
+    assert np.array_equal(states[:, 0], idxs)
+    # more memories than available can only be sampled with replacement
+    assert len(memory.sample(20)[0]) == 20
+
+
+def test_prioritized_sampling_follows_errors():
+    memory = ReplayMemory(4, 1, 1, prioritized=True, priority_exponent=1, min_priority=0,
+                          rng=np.random.default_rng(0))
+    for i in range(4):
+        memory.append(np.full(1, i), np.zeros(1))
+    memory.update_priorities(np.arange(4), np.array([0.0, 1.0, 0.0, 3.0]))
+    idxs = np.concatenate([memory.sample(32)[0] for _ in range(100)])
+    frequencies = np.bincount(idxs, minlength=4) / len(idxs)
+    assert np.allclose(frequencies, (0, 0.25, 0, 0.75), atol=0.02)
+
+
+def test_late_priority_updates_skip_overwritten_memories():
+    memory = ReplayMemory(4, 1, 1, prioritized=True, priority_exponent=1, min_priority=0,
+                          rng=np.random.default_rng(0))
+    for i in range(4):
+        memory.append(np.full(1, i), np.zeros(1))
+    written = memory.written
+    # two memories are overwritten (slots 0 and 1) before the errors of slots 0 to 3 come back
+    memory.append(np.full(1, 4), np.zeros(1))
+    memory.append(np.full(1, 5), np.zeros(1))
+    memory.update_priorities(np.arange(4), np.full(4, 7.0), written)
+    assert memory.priorities.tolist() == [1, 1, 7, 7]
+    assert memory.tree.total == 16
+    # without written, the errors are assumed to be for the current memories
+    memory.update_priorities(np.arange(2), np.full(2, 3.0))
+    assert memory.priorities.tolist() == [3, 3, 7, 7]
+
+
+def test_memory_mapped_memory_reopens_with_its_memories(tmp_path):
+    path = str(tmp_path / "memory")
+    memory = ReplayMemory(4, 2, 1, prioritized=True, path=path)
+    for i in range(6):
+        memory.append(np.full(2, i), np.full(1, -i))
+    memory.update_priorities(np.arange(2), np.array([5.0, 0.0]))
+    memory.flush()
+
+    # the capacity and sizes come from the directory
+    reopened = ReplayMemory(1, 1, 1, prioritized=True, path=path)
+    assert (reopened.capacity, len(reopened), reopened.next_idx) == (4, 4, 2)
+    assert np.array_equal(reopened.states, memory.states)
+    assert np.array_equal(reopened.targets, memory.targets)
+    assert np.isclose(reopened.tree.total, memory.tree.total)
+
+    reader = ReplayMemory(4, 2, 1, path=path, read_only=True)
+    memory.append(np.full(2, 6), np.full(1, -6))
+    memory.flush()
+    assert reader.next_idx == 2
+    reader.refresh()
+    assert reader.next_idx == 3 and reader.states[2, 0] == 6
+
+
+def test_copy_to_writes_a_memory_that_can_be_opened(tmp_path):
+    memory = ReplayMemory(3, 2, 1)
+    for i in range(4):
+        memory.append(np.full(2, i), np.full(1, -i))
+    memory.copy_to(str(tmp_path))
+    copy = ReplayMemory(3, 2, 1, path=str(tmp_path), read_only=True)
+    assert (len(copy), copy.next_idx) == (3, 1)
+    assert np.array_equal(copy.states, memory.states)
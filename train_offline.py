@@ -0,0 +1,63 @@
+from sim import simulation
+from sim import table
+from sim import recorder
+from ai import offline
+from ai import checkpoint
+from ai.state_template import StateTemplate
+import main
+import sys
+import time
+
+
+def run():
+    """
+    Trains the network of main (from the config, --load, --load-checkpoint or --resume)
+    on the recordings given with --data DIR[,DIR...], then saves it like main does.
+
+    Options:
+        --epochs N: passes over the recordings (default 1)
+        --batch-size N: transitions in a batch (default 4096)
+        --shuffle-buffer N: transitions mixed before batching (default 65536)
+        --prefetch N: batches prepared ahead by the background thread (default 8)
+        --checkpoint-dir DIR: also write a checkpoint in DIR
+    """
+    data = main._get_arg("--data")
+    if data is None:
+        raise ValueError("--data is required")
+    readers = [recorder.TrajectoryReader(directory) for directory in data.split(",")]
+
+    if "--load" in sys.argv or "--load-checkpoint" in sys.argv or main._get_saved_session() is not None:
+        main.load()
+    else:
+        main.load_from_config()
+    brain = main.pef_brain
+
+    # the recordings are made on main's table
+    sim = simulation.Simulation(table.TableInfo.from_dict(main._get_table_info()))
+    state_template = StateTemplate(sim)
+
+    start_time = time.perf_counter()
+    trained, batches = offline.train(brain.model, readers, state_template, brain.alpha, brain.lamda,
+                                     epochs=main._get_arg("--epochs", 1, int),
+                                     batch_size=main._get_arg("--batch-size", 4096, int),
+                                     buffer_size=main._get_arg("--shuffle-buffer", 65536, int),
+                                     prefetch_depth=main._get_arg("--prefetch", 8, int),
+                                     rng=main._get_rng())
+    elapsed = time.perf_counter() - start_time
+    print("Done: {} transitions in {:.2f} s ({:.0f} transitions/sec)".format(
+        trained, elapsed, trained / max(elapsed, 1e-9)))
+    # each batch is a gradient step, counted like the updates of online training
+    brain.updates += batches
+
+    brain.stop_learner()
+    brain.save()
+    if "--checkpoint-dir" in sys.argv:
+        checkpointer = checkpoint.Checkpointer(main._get_arg("--checkpoint-dir"))
+        brain.save_checkpoint(checkpointer)
+        checkpointer.close()
+    if "--resume" in sys.argv:
+        brain.save_session(main._get_arg("--resume"))
+
+
+if __name__ == '__main__':
+    run()
@@ -1,26 +1,48 @@
 from sim import simulation
+from ui.phase_timer import PhaseTimer
+from ui.scheduler import FrameScheduler
 import pymunk
 import pymunk.pygame_util
 import pygame
+import time
 
 _scale = 500
 
 
-def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_brain):
+PHASES = ("events", "wait", "input", "keys", "tick", "post_tick", "reset", "render")
+
+
+def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_brain, timings_file="timings.json",
+        target_fps=30, dt=1 / 60, max_substeps=4):
+    """
+    The simulation is always stepped by dt. When rendering, the elapsed time (times the speed) is accumulated
+    and consumed in steps of dt, at most max_substeps * speed steps per frame (the rest of a long frame is dropped),
+    and the bodies are drawn between their last two positions for the time left in the accumulator.
+
+    In fast mode, each frame runs as many steps as fit in the frame budget of target_fps,
+    and only every Nth frame is rendered when even one step and a render do not fit.
+
+    Keys:
+        r: reset the game
+        s: save the AI
+        space: toggle rendering
+        a: toggle random actions
+        u: toggle training
+        t: toggle the per-phase timings overlay
+        d: dump the per-phase timings to timings_file
+        f: toggle fast mode
+        left / right: slower / faster
+        down / up: lower / higher target FPS in fast mode
+    """
     pygame.init()
     pygame.font.init()
     font = pygame.font.SysFont("Helvetica", 16)
 
-    screen: pygame.Surface = pygame.display.set_mode((1024, 768))
-    table: pygame.Surface = _get_table_surface(sim)
+    screen: pygame.Surface = pygame.display.set_mode((1024, 768), pygame.RESIZABLE)
+    renderer = _TableRenderer(sim, screen)
     done = False
     clock = pygame.time.Clock()
 
-    table_pos = ((screen.get_width() - table.get_width()) / 2,
-                 (screen.get_height() - table.get_height()) / 2)
-
-    rod_owners = sim.get_rod_owners()
-
     reset_deferred = False
 
     def defer_reset():
@@ -36,6 +58,16 @@ def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_b
     sim.on_goal.append(lambda _: defer_reset())
     sim.on_oob.append(lambda: defer_reset())
 
+    # the positions before the last step, None when there is nothing to interpolate from (e.g. after a reset)
+    previous_positions = None
+
+    def drop_previous_positions():
+        nonlocal previous_positions
+        previous_positions = None
+
+    sim.on_reset.append(drop_previous_positions)
+    accumulator = 0.0
+
     speed = 1
     max_speed = 100
     rendering = True
@@ -47,11 +79,36 @@ def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_b
     }
     toggle_random = True
     toggle_update = 0
+    show_timings = False
+    timer = PhaseTimer(PHASES)
+    fast = False
+    scheduler = FrameScheduler(target_fps)
+
+    def step():
+        for side, input in inputs_functions[toggle_update](dt):
+            sim.apply_inputs(side, input)
+        timer.lap("input")
+        for side, input in _get_key_inputs(sim):
+            sim.apply_inputs(side, input)
+        timer.lap("keys")
+
+        sim.tick(dt)
+        timer.lap("tick")
+
+        post_tick_functions[toggle_update]()
+        timer.lap("post_tick")
+
+        check_defer_reset()
+        timer.lap("reset")
 
     while not done:
+        timer.begin()
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 done = True
+            if event.type == pygame.VIDEORESIZE:
+                screen = pygame.display.set_mode(event.size, pygame.RESIZABLE)
+                renderer.resize(screen)
             if event.type == pygame.KEYDOWN:
                 if event.unicode == "r":
                     sim.reset()
@@ -66,16 +123,31 @@ def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_b
                 if event.unicode == "u":
                     toggle_update = toggle_update ^ 1
                     print("Update is {}".format(toggle_msg[toggle_update == 0]))
+                if event.unicode == "t":
+                    show_timings = not show_timings
+                if event.unicode == "d":
+                    timer.dump(timings_file)
+                    print("Timings written to {}".format(timings_file))
+                if event.unicode == "f":
+                    fast = not fast
+                    print("Fast mode {}".format(toggle_msg[fast]))
                 if event.key == pygame.K_LEFT and speed > 1:
                     speed -= 1
                     print("Speed set to {}".format(speed))
                 if event.key == pygame.K_RIGHT and speed < max_speed:
                     speed += 1
                     print("Speed set to {}".format(speed))
+                if event.key == pygame.K_DOWN and scheduler.target_fps > 1:
+                    scheduler.target_fps -= 1
+                    print("Target FPS set to {}".format(scheduler.target_fps))
+                if event.key == pygame.K_UP:
+                    scheduler.target_fps += 1
+                    print("Target FPS set to {}".format(scheduler.target_fps))
                 if event.key == pygame.K_F4 and event.mod & pygame.KMOD_ALT:
                     done = True
+        timer.lap("events")
 
-        if rendering:
+        if rendering and not fast:
             tick_s = clock.tick(60) / 1000.0
         else:
             tick_s = clock.tick() / 1000.0
@@ -84,50 +156,205 @@ def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_b
         if frame_counter % 600 == 0:
             actual_fps = 1 / tick_s
 
-        for _ in range(speed):
-            for side, input in inputs_functions[toggle_update](tick_s):
-                sim.apply_inputs(side, input)
-            for side, input in _get_key_inputs(sim):
-                sim.apply_inputs(side, input)
-
-            if rendering:
-                sim.tick(tick_s)
-            else:
-                sim.tick(1 / 60)
-
-            post_tick_functions[toggle_update]()
-
-            check_defer_reset()
-
-        if rendering:
-            screen.fill((0, 0, 0))
-            table.fill((0, 0, 0))
-
-            _draw(sim, sim.ball_body, sim.rod_bodies, rod_owners, sim.goal_bodies, sim.side_bodies, table)
-            screen.blit(table, table_pos)
-
-            _draw_fps(1 / tick_s, speed * 1 / tick_s, font, (255, 255, 255), (10, 10), screen)
-
-            pygame.display.flip()
+        timer.lap("wait")
+
+        positions = None
+        if fast or not rendering:
+            # fixed steps without interpolation: start again from the current state when rendering resumes
+            accumulator = 0.0
+            previous_positions = None
+        if fast:
+            render_frame = scheduler.start_frame(rendering)
+            while scheduler.can_step():
+                step_start = time.perf_counter()
+                step()
+                scheduler.record_step(time.perf_counter() - step_start)
+            fps, ups = scheduler.fps, scheduler.ups
+        elif rendering:
+            render_frame = True
+            accumulator += speed * tick_s
+            steps = 0
+            while accumulator >= dt and steps < max_substeps * speed:
+                previous_positions = _get_positions(sim)
+                step()
+                accumulator -= dt
+                steps += 1
+            if steps == max_substeps * speed:
+                accumulator = min(accumulator, dt)
+            current_positions = _get_positions(sim)
+            if previous_positions is not None and len(previous_positions) == len(current_positions):
+                alpha = accumulator / dt
+                positions = [previous.interpolate_to(current, alpha)
+                             for previous, current in zip(previous_positions, current_positions)]
+            fps, ups = (1 / tick_s, steps / tick_s) if tick_s > 0 else (0, 0)
         else:
+            render_frame = False
+            for _ in range(speed):
+                step()
+            # without rendering, a frame can take less than the clock resolution
+            fps, ups = (1 / tick_s, speed * 1 / tick_s) if tick_s > 0 else (0, 0)
+
+        if render_frame:
+            render_start = time.perf_counter()
+            lines = [_get_fps_text(fps, ups)]
+            if show_timings:
+                lines += timer.format_lines()
+            pygame.display.update(renderer.draw(sim, lines, font, (255, 255, 255), positions))
+            if fast:
+                scheduler.record_render(time.perf_counter() - render_start)
+        elif not rendering:
 
             if frame_counter % int(2 * actual_fps) == 0:
                 screen.fill((0, 0, 0))
 
-                _draw_fps(60, speed * 1 / tick_s, font, (255, 255, 255), (10, 10), screen)
+                _draw_fps(fps if fast else 60, ups, font, (255, 255, 255), (10, 10), screen)
+                if show_timings:
+                    _draw_timings(timer, font, (255, 255, 255), (10, 30), screen)
 
                 pygame.display.flip()
+            # the screen was cleared, the next rendered frame must redraw everything
+            renderer.invalidate()
+        if fast:
+            scheduler.end_frame()
+        timer.lap("render")
 
 
 def r_int(value):
     return int(round(value))
 
 
-def _draw(sim: simulation.Simulation, ball, rods, rod_owners, goals, sides, surface: pygame.Surface):
-    ball_shape, = ball.shapes
-    assert isinstance(ball_shape, pymunk.Circle)
-    _draw_circle(ball_shape, (50, 50, 255), surface, _scale)
+class _TableRenderer:
+    """
+    Has:
+        A background with everything that never moves (the sides, the goals and the rod guide lines),
+        drawn once for the current screen size and table
+        A sprite for the ball and one for each rod with all its foosmen, drawn once
+        The screen rectangles drawn in the last frame
+    Each frame, only the rectangles of the last frame are erased (from the background) and the moving bodies
+    and the text are blitted again, so only those rectangles need to be updated on the display.
+    """
+
+    def __init__(self, sim: simulation.Simulation, screen: pygame.Surface):
+        self.sim = sim
+        self.table_info = None
+        self.screen = screen
+        self.background: pygame.Surface = None
+        self.table_pos = (0, 0)
+        self.ball_sprite: pygame.Surface = None
+        # for each rod, a sprite, the offset of its top left corner from the rod body position and its color
+        self.rod_sprites = []
+        self.last_rects = []
+        self.valid = False
+        self.resize(screen)
+
+    def resize(self, screen: pygame.Surface):
+        """
+        Rebuilds the background for a new screen (or a new table)
+        """
+        self.screen = screen
+        self.table_info = self.sim.table_info
+        table_width = r_int(self.table_info.length * _scale)
+        table_height = r_int(_scale)
+        self.table_pos = (r_int((screen.get_width() - table_width) / 2),
+                          r_int((screen.get_height() - table_height) / 2))
+
+        table = pygame.Surface((table_width, table_height))
+        table.fill((0, 0, 0))
+        _draw_static(self.sim, self.sim.goal_bodies, self.sim.side_bodies, table)
+        self.background = pygame.Surface(screen.get_size()).convert()
+        self.background.fill((0, 0, 0))
+        self.background.blit(table, self.table_pos)
+
+        self.__build_sprites()
+        self.invalidate()
+
+    def __build_sprites(self):
+        ball_shape, = self.sim.ball_body.shapes
+        assert isinstance(ball_shape, pymunk.Circle)
+        radius = r_int(ball_shape.radius * _scale) or 1
+        self.ball_sprite = pygame.Surface((2 * radius + 1, 2 * radius + 1), pygame.SRCALPHA)
+        pygame.draw.circle(self.ball_sprite, (50, 50, 255), (radius, radius), radius)
+
+        self.rod_sprites = []
+        for body, owner in zip(self.sim.rod_bodies, self.sim.get_rod_owners()):
+            color = ((255, 50, 50), (50, 255, 50))[owner]
+            polys = [shape.get_vertices() for shape in body.shapes]
+            min_x = min(vertex.x for vertices in polys for vertex in vertices)
+            min_y = min(vertex.y for vertices in polys for vertex in vertices)
+            max_x = max(vertex.x for vertices in polys for vertex in vertices)
+            max_y = max(vertex.y for vertices in polys for vertex in vertices)
+            sprite = pygame.Surface((r_int((max_x - min_x) * _scale) + 1, r_int((max_y - min_y) * _scale) + 1),
+                                    pygame.SRCALPHA)
+            for vertices in polys:
+                pygame.draw.polygon(sprite, color, [(r_int((vertex.x - min_x) * _scale),
+                                                     r_int((vertex.y - min_y) * _scale))
+                                                    for vertex in vertices])
+            self.rod_sprites.append((sprite, (min_x * _scale, min_y * _scale), color))
+
+    def invalidate(self):
+        """
+        The next draw redraws the whole screen
+        """
+        self.valid = False
+
+    def draw(self, sim: simulation.Simulation, lines, font, color, positions=None):
+        """
+        Draws the moving bodies of sim and lines of text in the top left corner
+        :param positions: where to draw the ball and the rods, as returned by _get_positions
+                          (default: the current positions of the bodies)
+        :return: the rectangles of the screen that changed, for pygame.display.update
+        """
+        if sim.table_info is not self.table_info:
+            self.resize(self.screen)
+        if positions is None:
+            positions = _get_positions(sim)
+
+        screen = self.screen
+        if self.valid:
+            for rect in self.last_rects:
+                screen.blit(self.background, rect, rect)
+        else:
+            screen.blit(self.background, (0, 0))
+
+        table_x, table_y = self.table_pos
+        rects = []
+        for body, (x, y), (sprite, (offset_x, offset_y), rod_color) in zip(sim.rod_bodies, positions[1:],
+                                                                          self.rod_sprites):
+            if body.angle != 0:
+                # sprites are not rotated; rods never rotate in this simulation
+                rects.extend(_draw_poly(shape, rod_color, screen, _scale, self.table_pos) for shape in body.shapes)
+                continue
+            rects.append(screen.blit(sprite, (table_x + r_int(x * _scale + offset_x),
+                                              table_y + r_int(y * _scale + offset_y))))
+
+        x, y = positions[0]
+        radius = self.ball_sprite.get_width() // 2
+        rects.append(screen.blit(self.ball_sprite, (table_x + r_int(x * _scale) - radius,
+                                                    table_y + r_int(y * _scale) - radius)))
+
+        text_y = 10
+        for line in lines:
+            s_text = font.render(line, True, color)
+            rects.append(screen.blit(s_text, (10, text_y)))
+            text_y += s_text.get_height()
+
+        if self.valid:
+            dirty = self.last_rects + rects
+        else:
+            dirty = [screen.get_rect()]
+            self.valid = True
+        self.last_rects = rects
+        return dirty
+
+
+def _get_positions(sim: simulation.Simulation):
+    """
+    :return: the positions of the ball and of each rod body
+    """
+    return [sim.ball_body.position] + [body.position for body in sim.rod_bodies]
+
 
+def _draw_static(sim: simulation.Simulation, goals, sides, surface: pygame.Surface):
     for body in sides:
         for shape in body.shapes:
             assert isinstance(shape, pymunk.Segment)
@@ -137,12 +364,6 @@ def _draw(sim: simulation.Simulation, ball, rods, rod_owners, goals, sides, surf
             assert isinstance(shape, pymunk.Segment)
             _draw_segment(shape, color, surface, _scale)
 
-    for body, owner in zip(rods, rod_owners):
-        color = ((255, 50, 50), (50, 255, 50))[owner]
-        for shape in body.shapes:
-            assert isinstance(shape, pymunk.Poly)
-            _draw_poly(shape, color, surface, _scale)
-
     for rod in sim.table_info.rods:
         x = rod[1]
         _draw_line((x, 0), (x, 1), 0.005, (200, 200, 200, 50), surface, _scale)
@@ -182,13 +403,6 @@ def _get_key_inputs(sim: simulation.Simulation):
     return inputs
 
 
-def _get_table_surface(sim: simulation.Simulation):
-    x = r_int(sim.table_info.length * _scale)
-    y = r_int(_scale)
-
-    return pygame.Surface((x, y))
-
-
 def _draw_segment(segment: pymunk.Segment, color, surface, scale):
     orig_a = segment.body.local_to_world(segment.a)
     orig_b = segment.body.local_to_world(segment.b)
@@ -207,24 +421,27 @@ def _draw_line(line_from, line_to, radius, color, surface, scale):
     pygame.draw.line(surface, color, a, b, r)
 
 
-def _draw_circle(circle: pymunk.Circle, color, surface, scale):
-    orig_c = circle.body.local_to_world(circle.offset)
-    c = (r_int(orig_c[0] * scale), r_int(orig_c[1] * scale))
-    r = r_int(circle.radius * scale) or 1
-
-    pygame.draw.circle(surface, color, c, r)
-
-
-def _draw_poly(poly: pymunk.Poly, color, surface, scale):
+def _draw_poly(poly: pymunk.Poly, color, surface, scale, offset=(0, 0)):
     def get_point(vertex):
         x, y = poly.body.local_to_world(vertex)
-        return r_int(x * scale), r_int(y * scale)
+        return r_int(x * scale) + offset[0], r_int(y * scale) + offset[1]
 
     points = map(get_point, poly.get_vertices())
-    pygame.draw.polygon(surface, color, list(points))
+    return pygame.draw.polygon(surface, color, list(points))
+
+
+def _get_fps_text(fps, ups):
+    return "{:.2f} FPS; {:.2f} UPS".format(fps, ups)
 
 
 def _draw_fps(fps, ups, font, color, position, surface):
-    text = "{:.2f} FPS; {:.2f} UPS".format(fps, ups)
-    s_text = font.render(text, True, color)
-    surface.blit(s_text, position)
\ No newline at end of file
+    s_text = font.render(_get_fps_text(fps, ups), True, color)
+    surface.blit(s_text, position)
+
+
+def _draw_timings(timer: PhaseTimer, font, color, position, surface):
+    x, y = position
+    for line in timer.format_lines():
+        s_text = font.render(line, True, color)
+        surface.blit(s_text, (x, y))
+        y += s_text.get_height()
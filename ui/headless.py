@@ -0,0 +1,103 @@
+from sim import simulation
+from ui.phase_timer import PhaseTimer
+import signal
+import time
+
+
+PHASES = ("input", "tick", "post_tick", "reset")
+
+
+def run(sim: simulation.Simulation, inputs_functions, post_tick_functions, pef_brain,
+        max_steps=None, max_seconds=None, report_interval=10.0, save_on_exit=True, timings_file=None):
+    """
+    Runs the simulation without a window, as fast as possible.
+    Does not import pygame, so it works on machines without a display.
+
+    :param inputs_functions: same as for custom_ui.run; only the first one is used
+    :param post_tick_functions: same as for custom_ui.run; only the first one is used
+    :param max_steps: stop after this many simulation steps (None for no limit)
+    :param max_seconds: stop after this many wall-clock seconds (None for no limit)
+    :param report_interval: seconds between two steps/sec reports
+    :param save_on_exit: save pef_brain when the run ends or is interrupted with Ctrl+C
+    :param timings_file: if given, the per-phase timings are written there at the end
+    """
+    dt = 1 / 60
+
+    reset_deferred = False
+
+    def defer_reset():
+        nonlocal reset_deferred
+        reset_deferred = True
+
+    def check_defer_reset():
+        nonlocal reset_deferred
+        if reset_deferred:
+            sim.reset()
+            reset_deferred = False
+
+    sim.on_goal.append(lambda _: defer_reset())
+    sim.on_oob.append(lambda: defer_reset())
+
+    interrupted = False
+
+    # noinspection PyUnusedLocal
+    def on_interrupt(signum, frame):
+        nonlocal interrupted
+        if interrupted:
+            # second Ctrl+C: give up on the graceful exit
+            raise KeyboardInterrupt
+        print("Interrupted, stopping after the current step")
+        interrupted = True
+
+    inputs_function = inputs_functions[0]
+    post_tick_function = post_tick_functions[0]
+
+    timer = PhaseTimer(PHASES)
+    steps = 0
+    start_time = time.perf_counter()
+    last_report_time = start_time
+    last_report_steps = 0
+
+    old_handler = signal.signal(signal.SIGINT, on_interrupt)
+    try:
+        while not interrupted:
+            if max_steps is not None and steps >= max_steps:
+                break
+
+            timer.begin()
+            for side, input in inputs_function(dt):
+                sim.apply_inputs(side, input)
+            timer.lap("input")
+            sim.tick(dt)
+            timer.lap("tick")
+            post_tick_function()
+            timer.lap("post_tick")
+            check_defer_reset()
+            timer.lap("reset")
+            steps += 1
+
+            now = time.perf_counter()
+            if max_seconds is not None and now - start_time >= max_seconds:
+                break
+            if now - last_report_time >= report_interval:
+                print("{} steps; {:.2f} steps/sec".format(
+                    steps, (steps - last_report_steps) / (now - last_report_time)))
+                for line in timer.format_lines():
+                    print("  " + line)
+                if pef_brain.learner is not None:
+                    print("learner: {}".format(pef_brain.learner.stats()))
+                last_report_time = now
+                last_report_steps = steps
+    finally:
+        signal.signal(signal.SIGINT, old_handler)
+
+    elapsed = time.perf_counter() - start_time
+    print("Done: {} steps in {:.2f} s ({:.2f} steps/sec)".format(steps, elapsed, steps / max(elapsed, 1e-9)))
+    for line in timer.format_lines():
+        print("  " + line)
+    if timings_file is not None:
+        timer.dump(timings_file)
+
+    pef_brain.stop_learner()
+    if save_on_exit:
+        pef_brain.save()
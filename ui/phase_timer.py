@@ -0,0 +1,86 @@
+import numpy as np
+import json
+import time
+
+
+class PhaseTimer:
+    """
+    Has:
+        For each phase of a loop, a ring buffer with its last durations (in seconds)
+        and the total time spent in it
+    Timing is done with laps: lap(phase) charges the time since the previous lap to phase,
+    so each phase costs a single perf_counter call.
+    """
+
+    def __init__(self, phases, window: int = 600):
+        """
+        :param phases: the names of the phases, in the order they are shown
+        :param window: number of durations kept for each phase
+        """
+        self.phases = list(phases)
+        self.window = window
+        self.durations = np.zeros((len(self.phases), window))
+        self.counts = np.zeros(len(self.phases), dtype=np.int64)
+        self.totals = np.zeros(len(self.phases))
+        self.__idxs = {phase: idx for idx, phase in enumerate(self.phases)}
+        self.__last = time.perf_counter()
+
+    def begin(self):
+        """
+        Starts a new lap without charging the elapsed time to any phase
+        """
+        self.__last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        idx = self.__idxs[phase]
+        self.durations[idx, self.counts[idx] % self.window] = now - self.__last
+        self.counts[idx] += 1
+        self.totals[idx] += now - self.__last
+        self.__last = now
+
+    def samples(self, phase):
+        """
+        :return: the last durations of phase, in seconds, in no particular order
+        """
+        idx = self.__idxs[phase]
+        return self.durations[idx, :min(self.counts[idx], self.window)]
+
+    def histogram(self, phase, bins: int = 20):
+        """
+        :return: a tuple (counts, bin edges in seconds) of the last durations of phase
+        """
+        return np.histogram(self.samples(phase), bins=bins)
+
+    def summary(self):
+        """
+        :return: for each phase with samples, a dict with its mean, median and 99th percentile durations
+                 (in milliseconds) in the window, its total count and its share of the total time of all phases
+                 (phases run at different rates, e.g. several steps per render, so the means alone do not give it)
+        """
+        total = self.totals.sum() or 1
+        return {phase: dict(mean_ms=float(self.samples(phase).mean()) * 1e3,
+                            p50_ms=float(np.percentile(self.samples(phase), 50)) * 1e3,
+                            p99_ms=float(np.percentile(self.samples(phase), 99)) * 1e3,
+                            count=int(self.counts[self.__idxs[phase]]),
+                            share=float(self.totals[self.__idxs[phase]] / total))
+                for phase in self.phases if len(self.samples(phase)) > 0}
+
+    def format_lines(self):
+        """
+        :return: one line of text for each phase, e.g. for an overlay
+        """
+        return ["{:<10} {:8.3f} ms  p99 {:8.3f} ms  {:5.1%}".format(phase, stats["mean_ms"], stats["p99_ms"],
+                                                                    stats["share"])
+                for phase, stats in self.summary().items()]
+
+    def dump(self, file):
+        """
+        Writes the summary and the histogram of each phase as JSON
+        """
+        data = {}
+        for phase, stats in self.summary().items():
+            counts, edges = self.histogram(phase)
+            data[phase] = dict(stats, histogram=dict(counts=counts.tolist(), edges_ms=(edges * 1e3).tolist()))
+        with open(file, "wt") as fd:
+            json.dump(data, fd, indent=4)
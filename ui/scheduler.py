@@ -0,0 +1,98 @@
+import math
+import time
+
+
+class FrameScheduler:
+    """
+    Has:
+        A target render rate, which gives the time budget of a frame
+        Moving averages of the cost of one simulation step and of one render
+        A render interval: when a render and the minimum steps do not fit in a frame,
+        only every render_interval-th frame is rendered and the others only run steps
+        The achieved updates (steps) and renders per second
+    Fills each frame with as many fixed-dt steps as fit in its budget.
+    """
+
+    def __init__(self, target_fps: float = 30, min_steps: int = 1, max_render_interval: int = 60,
+                 smoothing: float = 0.1, report_interval: float = 1.0):
+        """
+        :param target_fps: renders per second to aim for
+        :param min_steps: steps run in every frame, even when over budget
+        :param max_render_interval: never render less often than every max_render_interval frames
+        :param smoothing: weight of the newest measure in the moving averages
+        :param report_interval: seconds over which ups and fps are measured
+        """
+        self.target_fps = target_fps
+        self.min_steps = min_steps
+        self.max_render_interval = max_render_interval
+        self.smoothing = smoothing
+        self.report_interval = report_interval
+
+        self.step_cost = 0.0
+        self.render_cost = 0.0
+        self.render_interval = 1
+        self.frames = 0
+        self.frames_since_render = 0
+        self.frame_start = time.perf_counter()
+        self.frame_steps = 0
+        self.rendering = True
+
+        self.ups = 0.0
+        self.fps = 0.0
+        self.__report_start = self.frame_start
+        self.__report_steps = 0
+        self.__report_renders = 0
+
+    @property
+    def budget(self):
+        """
+        Seconds available for a frame
+        """
+        return 1 / self.target_fps
+
+    def start_frame(self, rendering: bool = True):
+        """
+        :param rendering: False if nothing is rendered at all, so no time is kept for it
+        :return: True if this frame must be rendered
+        """
+        self.frame_start = time.perf_counter()
+        self.frame_steps = 0
+        self.rendering = rendering and self.frames_since_render + 1 >= self.render_interval
+        return self.rendering
+
+    def can_step(self):
+        """
+        :return: True if one more step fits in the budget of the frame (keeping time for the render, if any)
+        """
+        if self.frame_steps < self.min_steps:
+            return True
+        reserved = self.render_cost if self.rendering else 0
+        return time.perf_counter() - self.frame_start + self.step_cost + reserved <= self.budget
+
+    def record_step(self, seconds):
+        self.step_cost += self.smoothing * (seconds - self.step_cost)
+        self.frame_steps += 1
+        self.__report_steps += 1
+
+    def record_render(self, seconds):
+        self.render_cost += self.smoothing * (seconds - self.render_cost)
+        self.__report_renders += 1
+
+    def end_frame(self):
+        now = time.perf_counter()
+        if self.rendering:
+            self.frames_since_render = 0
+            # a rendered frame takes this many budgets: render once in as many frames
+            rendered_frame_cost = self.min_steps * self.step_cost + self.render_cost
+            self.render_interval = max(1, min(math.ceil(rendered_frame_cost / self.budget), self.max_render_interval))
+        else:
+            self.frames_since_render += 1
+        self.frames += 1
+
+        elapsed = now - self.__report_start
+        if elapsed >= self.report_interval:
+            self.ups = self.__report_steps / elapsed
+            self.fps = self.__report_renders / elapsed
+            self.__report_start = now
+            self.__report_steps = 0
+            self.__report_renders = 0